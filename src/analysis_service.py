@@ -0,0 +1,234 @@
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import click
+import numpy as np
+import xarray as xr
+import regionmask
+import geopandas as gpd
+from aiohttp import web
+from shapely.geometry import shape
+
+from utils.data import RasterData
+from utils.cache import ChunkCache
+from utils.raster import ZarrData
+from utils.tiles import TileQuery
+from utils.calculations import ZonalStatistics
+
+
+def _to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+def read_geometries(geojson: Dict) -> List:
+    """Geometries of a GeoJSON geometry, Feature or FeatureCollection"""
+    if geojson.get('type') == 'FeatureCollection':
+        return [shape(feature['geometry']) for feature in geojson['features']]
+    elif geojson.get('type') == 'Feature':
+        return [shape(geojson['geometry'])]
+    return [shape(geojson)]
+
+
+class Dataset:
+    """A raster group opened once, with its overviews and tile query kept in memory"""
+    def __init__(self, dataset: str, group: str, factor: int = 16, in_s3: bool = False,
+                 mask_size: int = 2**28):
+        self.raster_metadata = RasterData(dataset, group)
+        zarr_data = ZarrData(self.raster_metadata, in_s3=in_s3,
+                             chunk_cache=ChunkCache() if in_s3 else None)
+        self.raster_data = zarr_data.read_as_xarray()
+        overviews = zarr_data.read_overviews()
+        self.tile_query = TileQuery(self.raster_data, overviews, self.raster_metadata, factor) \
+            if factor in overviews else None
+
+        # Bounded in-memory LRU of the masks of the geometries of the requests
+        self.mask_size = mask_size
+        self.masks = OrderedDict()
+        self._masks_size = 0
+        self._lock = threading.Lock()
+
+    def _mask(self, gdf: gpd.GeoDataFrame, window: xr.Dataset) -> np.ndarray:
+        """Geometry rasterized on the grid of its bounding box window, kept in memory"""
+        key = hashlib.sha256(gdf.geometry.iloc[0].wkb + window['lon'].values.tobytes() +
+                             window['lat'].values.tobytes()).hexdigest()
+        with self._lock:
+            if key in self.masks:
+                self.masks.move_to_end(key)
+                return self.masks[key]
+
+        if window.sizes['lat'] and window.sizes['lon']:
+            mask = regionmask.mask_geopandas(gdf, window['lon'], window['lat'],
+                                             numbers='index').transpose('lat', 'lon').values
+        else:
+            mask = np.full((window.sizes['lat'], window.sizes['lon']), np.nan)
+
+        with self._lock:
+            if key not in self.masks and mask.nbytes <= self.mask_size:
+                self.masks[key] = mask
+                self._masks_size += mask.nbytes
+                while self._masks_size > self.mask_size:
+                    _, old_mask = self.masks.popitem(last=False)
+                    self._masks_size -= old_mask.nbytes
+        return mask
+
+    def compute(self, geometries: List, data_types: List[str]) -> Dict[str, List[Dict]]:
+        """Rows of every geometry, with its position in the list as index"""
+        if self.tile_query:
+            data = {data_type: [] for data_type in data_types}
+            for index, geometry in enumerate(geometries):
+                for data_type, df in self.tile_query.query(geometry, data_types).items():
+                    data[data_type] += df.assign(index=index).to_dict('records')
+            return data
+
+        # Without overviews reduce the pixels of each geometry, which are rasterized on their
+        # own as they can overlap. Only the window of the geometry is rasterized.
+        data = {data_type: [] for data_type in data_types}
+        for index, geometry in enumerate(geometries):
+            gdf = gpd.GeoDataFrame({'index': [index]}, geometry=[geometry], crs='EPSG:4326')
+            xmin, ymin, xmax, ymax = geometry.bounds
+            window = self.raster_data.sel(lon=slice(xmin, xmax), lat=slice(ymax, ymin))
+            window['request'] = (('lat', 'lon'), self._mask(gdf, window))
+            zonal_statistics = ZonalStatistics(window, {'request': gdf}, self.raster_metadata)
+            values = zonal_statistics.compute_all(method='polygon', data_types=data_types)
+            for data_type in data_types:
+                data[data_type] += values[data_type]['request'].to_dict('records')
+        return data
+
+
+class AnalysisService:
+    """Batches the requests of each dataset and computes them in a thread pool with a
+    limited number of concurrent batches"""
+    def __init__(self, datasets: Dict[Tuple[str, str], Dataset], workers: int = 4,
+                 batch_size: int = 16, batch_timeout: float = 0.02):
+        self.datasets = datasets
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.semaphore = asyncio.Semaphore(workers)
+        self.queues = {key: asyncio.Queue() for key in datasets}
+        self.tasks = []
+
+    async def start(self, app: web.Application):
+        self.tasks = [asyncio.create_task(self._batches(key)) for key in self.queues]
+
+    async def stop(self, app: web.Application):
+        for task in self.tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def _batches(self, key: Tuple[str, str]):
+        queue = self.queues[key]
+        while True:
+            batch = [await queue.get()]
+            # Wait a little for other requests of the same dataset
+            deadline = asyncio.get_running_loop().time() + self.batch_timeout
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.semaphore.acquire()
+            asyncio.create_task(self._compute(key, batch))
+
+    async def _compute(self, key: Tuple[str, str], batch: List[Tuple]):
+        try:
+            # One call for all the geometries of the batch
+            geometries = [geometry for geometries, _, _ in batch for geometry in geometries]
+            data_types = sorted(
+                {data_type for _, data_types, _ in batch for data_type in data_types})
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(self.executor, self.datasets[key].compute,
+                                              geometries, data_types)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.semaphore.release()
+
+        # Split the rows back by request, skipping the ones whose client disconnected
+        start = 0
+        for geometries, request_data_types, future in batch:
+            indexes = range(start, start + len(geometries))
+            start += len(geometries)
+            if future.done():
+                continue
+            future.set_result({
+                data_type: [dict(row, index=row['index'] - indexes.start)
+                            for row in data[data_type] if row['index'] in indexes]
+                for data_type in request_data_types})
+
+    async def analysis(self, request: web.Request) -> web.Response:
+        key = (request.match_info['dataset'], request.match_info['group'])
+        if key not in self.queues:
+            raise web.HTTPNotFound(text=f"{key[0]}/{key[1]} is not served")
+
+        data_types = request.query.get('data_type', 'change,time_series').split(',')
+        if not all(data_type in ['change', 'time_series'] for data_type in data_types):
+            raise web.HTTPBadRequest(text="data_type must be 'change' and/or 'time_series'")
+        try:
+            geometries = read_geometries(await request.json())
+        except Exception as e:
+            raise web.HTTPBadRequest(text=f"Invalid GeoJSON: {str(e)}")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[key].put((geometries, data_types, future))
+        data = await future
+
+        return web.json_response(data, dumps=lambda x: json.dumps(x, default=_to_json))
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'datasets': [f"{dataset}/{group}" for dataset, group in self.datasets],
+            'queued': {f"{dataset}/{group}": queue.qsize()
+                       for (dataset, group), queue in self.queues.items()}})
+
+
+def make_app(service: AnalysisService) -> web.Application:
+    app = web.Application()
+    app.add_routes([web.post('/analysis/{dataset}/{group}', service.analysis),
+                    web.get('/health', service.health)])
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    return app
+
+
+@click.command()
+@click.argument('groups', type=lambda s: [tuple(x.split('/')) for x in s.split(',')])
+@click.option('--host', default='0.0.0.0', help='Host to listen on.')
+@click.option('--port', '-p', default=8080, type=int, help='Port to listen on.')
+@click.option('--workers', '-w', default=4, type=int,
+              help='Number of batches computed concurrently.')
+@click.option('--batch_size', '-bs', default=16, type=int,
+              help='Maximum number of requests per batch.')
+@click.option('--batch_timeout', '-bt', default=0.02, type=float,
+              help='Seconds to wait for more requests before computing a batch.')
+@click.option('--factor', '-f', default=16, type=int, help='Overview factor of the tiles.')
+@click.option('--in_s3', is_flag=True, help='Read the Zarr stores from S3.')
+def main(groups, host, port, workers, batch_size, batch_timeout, factor, in_s3):
+    """
+    Serve on-the-fly zonal statistics of GeoJSON geometries for dataset/group pairs,
+    e.g. experimental/concentration,global/recent
+    """
+    print("Opening datasets!")
+    datasets = {(dataset, group): Dataset(dataset, group, factor, in_s3)
+                for dataset, group in groups}
+    service = AnalysisService(datasets, workers, batch_size, batch_timeout)
+    web.run_app(make_app(service), host=host, port=port)
+
+
+if __name__ == '__main__':
+    main()
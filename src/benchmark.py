@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import resource
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime
+
+import click
+import zarr
+import xarray as xr
+import geopandas as gpd
+
+from utils.data import RasterData, LandCoverData
+from utils.cache import MaskCache
+from utils.calculations import ZonalStatistics, PostProcessing, LandCoverStatistics
+from utils.synthetic import synthetic_raster, synthetic_land_cover, synthetic_polygons, \
+    synthetic_transitions
+from utils.util import get_recent_lc_statistics, sum_dicts
+from utils.instrumentation import InstrumentedStore
+
+RESULTS_PATH = '../data/benchmarks/'
+ENGINES = ['zonal_polygon', 'zonal_label', 'land_cover_recent_polygon', 'land_cover_recent_label',
+           'land_cover_future_polygon', 'land_cover_future_label', 'get_recent_lc_statistics',
+           'sum_dicts']
+SCENARIOS = ['crop_I', 'rewilding']
+
+
+class Stages:
+    """Wall time of the stages of an engine, summed over repeated calls"""
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def __call__(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - start
+
+
+def peak_rss() -> int:
+    """Peak resident memory in bytes of the current process. ru_maxrss is inherited from the
+    parent through fork and exec, so the high water mark of the process is used on Linux"""
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_fixtures(folder: str, settings: dict):
+    """Synthetic raster stores and vector layers of the benchmark"""
+    dataset, group = settings['group'].split('/')
+    raster_metadata = RasterData(dataset, group)
+    chunks = settings['chunks']
+
+    ds = synthetic_raster(raster_metadata, settings['width'], settings['height'],
+                          {'lat': chunks, 'lon': chunks}, seed=settings['seed'])
+    ds.to_zarr(os.path.join(folder, 'raster.zarr'), group=group, mode='w', consolidated=False)
+    zarr.consolidate_metadata(os.path.join(folder, 'raster.zarr'))
+
+    for group_type in ['recent', 'future']:
+        ds = synthetic_land_cover(group_type, settings['width'], settings['height'],
+                                  {'y': chunks, 'x': chunks}, SCENARIOS, seed=settings['seed'])
+        ds.to_zarr(os.path.join(folder, f'land-cover-{group_type}.zarr'), mode='w',
+                   consolidated=True)
+
+    gdf_1, gdf_0 = synthetic_polygons(settings['polygons'], settings['size'],
+                                      settings['antimeridian'], gid_0=raster_metadata.iso(),
+                                      seed=settings['seed'])
+    gdf_1.to_file(os.path.join(folder, 'political_boundaries_1.geojson'), driver='GeoJSON')
+    gdf_0.to_file(os.path.join(folder, 'political_boundaries_0.geojson'), driver='GeoJSON')
+
+
+def run_engine(engine: str, folder: str, settings: dict, run: int) -> dict:
+    """Run an engine on the fixtures, in a process of its own so that its peak RSS isn't
+    mixed with the one of the other engines"""
+    stages = Stages()
+    start = time.perf_counter()
+
+    with stages('read_vector'):
+        gdf_1 = gpd.read_file(os.path.join(folder, 'political_boundaries_1.geojson'))
+        gdf_0 = gpd.read_file(os.path.join(folder, 'political_boundaries_0.geojson'))
+    # Cold masks in every run
+    mask_cache = MaskCache(os.path.join(folder, f'masks_{engine}_{run}'))
+
+    store = None
+    if engine.startswith('zonal'):
+        dataset, group = settings['group'].split('/')
+        raster_metadata = RasterData(dataset, group)
+        store = InstrumentedStore(zarr.storage.DirectoryStore(os.path.join(folder, 'raster.zarr')))
+        ds = xr.open_zarr(store, group=group, consolidated=True)
+
+        zonal_statistics = ZonalStatistics(ds, {'political_boundaries_1': gdf_1}, raster_metadata,
+                                           mask_cache=mask_cache)
+        with stages('rasterize'):
+            zonal_statistics.rasterize_vector_data()
+        with stages('level_1'):
+            data = zonal_statistics.compute_all(method=engine.rsplit('_', 1)[1])
+        with stages('level_0'):
+            post_processing = PostProcessing(raster_metadata, {'political_boundaries_0': gdf_0})
+            for data_type in data:
+                post_processing.compute_level_0_data(data[data_type], data_type,
+                                                     zonal_statistics.accumulators)
+
+    elif engine.startswith('land_cover'):
+        _, _, group_type, method = engine.split('_')
+        store = InstrumentedStore(zarr.storage.DirectoryStore(
+            os.path.join(folder, f'land-cover-{group_type}.zarr')))
+        ds = xr.open_zarr(store, consolidated=True)
+
+        lc_statistics = LandCoverStatistics(group_type, ds, LandCoverData(),
+                                            SCENARIOS if group_type == 'future' else None,
+                                            mask_cache=mask_cache, pixel_area=6.25)
+        with stages('level_1'):
+            lc_statistics.compute_level_1_data({'political_boundaries_1': gdf_1}, method=method)
+        with stages('level_0'):
+            lc_statistics.compute_level_0_data({'political_boundaries_0': gdf_0})
+
+    elif engine == 'get_recent_lc_statistics':
+        store = InstrumentedStore(zarr.storage.DirectoryStore(
+            os.path.join(folder, 'land-cover-recent.zarr')))
+        ds = xr.open_zarr(store, consolidated=True)
+
+        # Geometries crossing the antimeridian are skipped, their window is the whole globe
+        for index, geometry in zip(gdf_1['index'], gdf_1.geometry):
+            xmin, ymin, xmax, ymax = geometry.bounds
+            if xmax - xmin > 180:
+                continue
+            with stages('rasterize'):
+                ds_index = ds.sel(x=slice(xmin, xmax), y=slice(ymax, ymin)).copy()
+                ds_index['mask'] = mask_cache.rasterize(gdf_1[gdf_1['index'] == index],
+                                                        ds_index['x'], ds_index['y'])
+            with stages('statistics'):
+                get_recent_lc_statistics(ds_index, LandCoverData())
+
+    elif engine == 'sum_dicts':
+        with stages('synthetic'):
+            dicts = synthetic_transitions(settings['polygons'], seed=settings['seed'])
+        with stages('sum'):
+            # Summed by parent
+            for _, positions in gdf_1.groupby('id_0').indices.items():
+                sum_dicts([dicts[n] for n in positions])
+
+    return {'engine': engine, 'run': run,
+            'wall_seconds': time.perf_counter() - start,
+            'stages': stages.seconds,
+            'bytes_read': store.bytes_read if store is not None else 0,
+            'peak_rss_bytes': peak_rss()}
+
+
+def compare(results: dict, baseline: dict, threshold: float = .1):
+    """Print the change of every engine against a previous benchmark"""
+    if results['settings'] != baseline['settings']:
+        print("Warning: the settings of the baseline are different!")
+    previous = {result['engine']: result for result in baseline['results']}
+    print(f"{'engine':<28}{'wall':>10}{'baseline':>10}{'ratio':>8}{'rss ratio':>11}")
+    for result in results['results']:
+        if result['engine'] not in previous:
+            continue
+        base = previous[result['engine']]
+        ratio = result['wall_seconds'] / base['wall_seconds']
+        rss_ratio = result['peak_rss_bytes'] / base['peak_rss_bytes']
+        flag = '  <- slower' if ratio > 1 + threshold else ''
+        print(f"{result['engine']:<28}{result['wall_seconds']:>10.2f}{base['wall_seconds']:>10.2f}"
+              f"{ratio:>8.2f}{rss_ratio:>11.2f}{flag}")
+
+
+@click.command()
+@click.option('--engines', '-e', default=','.join(ENGINES), type=lambda s: s.split(','),
+              help='Comma separated engines to benchmark.')
+@click.option('--group', '-g', default='experimental/stocks',
+              help='dataset/group whose depths and time steps the synthetic raster has.')
+@click.option('--width', default=1440, type=int, help='Number of pixels of the global grid in x.')
+@click.option('--height', default=720, type=int, help='Number of pixels of the global grid in y.')
+@click.option('--chunks', '-c', default=360, type=int, help='Chunk size in x and y.')
+@click.option('--polygons', '-p', default=100, type=int, help='Number of level 1 polygons.')
+@click.option('--size', '-s', default=5., type=float, help='Size of the polygons in degrees.')
+@click.option('--antimeridian', '-a', default=2, type=int,
+              help='Number of polygons crossing the antimeridian.')
+@click.option('--runs', '-r', default=1, type=int,
+              help='Runs of every engine, the fastest one is reported.')
+@click.option('--seed', default=0, type=int, help='Seed of the synthetic data.')
+@click.option('--output', '-o', default=None,
+              help='JSON file to save the results to, by default a timestamped file in '
+                   f'{RESULTS_PATH}.')
+@click.option('--baseline', '-b', default=None,
+              help='JSON file of a previous benchmark to compare the results with.')
+def main(engines, group, width, height, chunks, polygons, size, antimeridian, runs, seed, output,
+         baseline):
+    """
+    Benchmark the zonal and land cover engines on synthetic raster and vector data
+    """
+    settings = {'group': group, 'width': width, 'height': height, 'chunks': chunks,
+                'polygons': polygons, 'size': size, 'antimeridian': antimeridian, 'seed': seed}
+    print('Settings:', settings)
+
+    # Spawn fresh interpreters so that peak RSS starts from scratch for every run
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        print("Writing synthetic data!")
+        write_fixtures(folder, settings)
+
+        for engine in engines:
+            engine_runs = []
+            for run in range(runs):
+                with context.Pool(1) as pool:
+                    engine_runs.append(pool.apply(run_engine, (engine, folder, settings, run)))
+            result = min(engine_runs, key=lambda x: x['wall_seconds'])
+            print(f"{engine}: {result['wall_seconds']:.2f} s, "
+                  f"{result['peak_rss_bytes'] / 2**20:.0f} MB peak RSS, "
+                  f"{result['bytes_read'] / 2**20:.0f} MB read, " +
+                  ', '.join(f"{stage} {seconds:.2f} s"
+                            for stage, seconds in result['stages'].items()))
+            results.append(result)
+
+    results = {'date': datetime.now().isoformat(), 'settings': settings, 'results': results}
+    if output is None:
+        os.makedirs(RESULTS_PATH, exist_ok=True)
+        output = os.path.join(RESULTS_PATH, f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Results saved to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
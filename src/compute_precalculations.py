@@ -1,9 +1,23 @@
 import click
 import pandas as pd
 
-from utils.data import VectorData, RasterData
-from utils.calculations import ZonalStatistics, PostProcessing
-from utils.raster import ZarrData
+from utils import instrumentation
+from utils.calculations import PostProcessing
+from utils.checkpoint import Checkpoints
+from utils.data import RasterData, VectorData
+from utils.manifest import (
+    Manifest,
+    fingerprint,
+    geometry_fingerprints,
+    has_level_1,
+    layer_fingerprint,
+    merge_rows,
+    raster_fingerprint,
+    read_level_1,
+    write_level_1,
+)
+from utils.parallel import make_work_units, merge_work_units, run_work_units, unit_key
+from utils.precalculations import FORMATS, write_precalculations
 
 
 @click.command()
@@ -11,10 +25,45 @@ from utils.raster import ZarrData
 @click.argument('vector_prefixes', type=lambda s: s.split(','))
 @click.option('--vector_path', '-vp', default='../data/processed/vector_data/',
               help='Path to vector data.')
-def main(datasets, vector_prefixes, vector_path):
+@click.option('--method', '-m', default='polygon', type=click.Choice(['polygon', 'label']),
+              help='Reduce each polygon window separately or all labels in one pass over the '
+                   'chunks.')
+@click.option('--workers', '-w', default=1, type=int,
+              help='Number of processes computing work units in parallel.')
+@click.option('--chunk_size', '-cs', default=None, type=int,
+              help='Number of geometries per work unit. By default one unit per vector layer.')
+@click.option('--scheduler', '-s', default=None,
+              help='Address of a dask distributed scheduler to run the work units on.')
+@click.option('--tolerance', '-t', default=None, type=float,
+              help='Compute large geometries from the coarsest overview whose boundary pixels are '
+                   'at most this fraction of their area. By default only full resolution is used.')
+@click.option('--memory_budget', '-mb', default=None, type=int,
+              help='Megabytes of raster values a polygon window can load at once, larger windows '
+                   'are read tile by tile.')
+@click.option('--coverage', '-c', default=None, type=int,
+              help='Weight the pixels by their area covered by each geometry, computed on a grid '
+                   'of coverage x coverage sub-pixels. Requires --method label.')
+@click.option('--formats', '-f', default=','.join(FORMATS), type=lambda s: s.split(','),
+              help='Comma separated output formats (parquet and/or csv).')
+@click.option('--full', is_flag=True,
+              help='Recompute all the geometries instead of only the ones whose inputs changed '
+                   'since the previous run.')
+@click.option('--resume', is_flag=True,
+              help='Resume a failed run, skipping the work units it already computed.')
+@click.option('--instrumentation', '-i', 'instrumentation_path', default=None,
+              help='JSON lines file to append per stage timings and I/O to, INSTRUMENTATION_PATH '
+                   'by default. A summary is printed at the end of the run.')
+def main(datasets, vector_prefixes, vector_path, method, workers, chunk_size, scheduler, tolerance,
+         memory_budget, coverage, formats, full, resume, instrumentation_path):
     """
     Compute precalculations
     """
+    if coverage and method != 'label':
+        raise click.BadParameter("requires --method label", param_hint="'--coverage'")
+    if coverage and tolerance is not None:
+        raise click.BadParameter("can't be used with --tolerance", param_hint="'--coverage'")
+
+    instrumentation.configure(instrumentation_path)
     print('Datasets:', datasets)
     print('Vector prefixes:', vector_prefixes)
 
@@ -29,46 +78,115 @@ def main(datasets, vector_prefixes, vector_path):
     vector_data_0 = vector.read_data(suffix='_0.geojson')
     vector_data_1 = vector.read_data(suffix='_1.geojson')
 
+    # Only recompute the geometries whose inputs changed since the previous run
+    manifest = Manifest()
+    settings = {'method': method, 'tolerance': tolerance, 'coverage': coverage}
+
+    # Split the computation in (dataset, group, vector layer, geometries chunk) work units
+    units = {}
+    changes = {}
     for dataset in datasets:
-        print(f"{dataset.title()}")
         for group in groups[dataset]:
-            print(group)
-            # Read raster data
-            print("Reading raster data!")
             raster_metadata = RasterData(dataset, group)
-            zarr_data = ZarrData(raster_metadata)
-            raster_data = zarr_data.read_as_xarray()
-
-            # Rasterize vector data
-            print("Rasterizing vector data!")
-            zonal_statistics = ZonalStatistics(raster_data, vector_data_1, raster_metadata)
-            zonal_statistics.rasterize_vector_data()
-
-            # Compute Zonal Statistics
-            data = {}
-            post_processing = PostProcessing(raster_metadata, vector_data_0)
-            for data_type in ['change', 'time_series']:
-                print(f"Compute {data_type} values!")
-                # compute level 1 geometries' values
-                print("Level 1 geometries.")
-                data[data_type] = zonal_statistics.compute(data_type=data_type)
-
-                # compute level 0 geometries' values
-                print("Level 0 geometries.")
-                data[data_type] = post_processing.compute_level_0_data(data[data_type],
-                                                                       data_type=data_type)
-            # Save data
-            print("Saving the data!")
-            for data_type, values in data.items():
-                data_type_data = {}
-                for key, value in data[data_type].items():
-                    prefix = key.rsplit('_', 1)[0]
-                    if prefix not in data_type_data:
-                        data_type_data[prefix] = value
-                    data_type_data[prefix] = pd.concat([data_type_data[prefix], value])
-
-                for geom_type, df in data_type_data.items():
-                    df.to_csv(f"../data/processed/precalculations/{geom_type}_{data_type}_{dataset}_{group}.csv")
+            raster = raster_fingerprint(raster_metadata)
+
+            group_changes = {}
+            for geom_name, gdf in vector_data_1.items():
+                key = manifest.key(dataset, group, geom_name)
+                gdf_0 = vector_data_0[geom_name.replace('_1', '_0')]
+                layer = fingerprint(raster, settings, layer_fingerprint(gdf_0))
+                geometries = geometry_fingerprints(gdf)
+                changed = list(gdf['index']) if full else \
+                    manifest.changed_indexes(key, layer, geometries, gdf['index'])
+                # Without the rows of the previous run everything is recomputed
+                if not has_level_1(geom_name, dataset, group):
+                    changed = list(gdf['index'])
+                if changed:
+                    group_changes[geom_name] = (key, layer, geometries, changed)
+
+            if not group_changes:
+                print(f"{dataset}/{group} is up to date, skipping!")
+                continue
+            print(f"{dataset}/{group}: " + ', '.join(
+                f"{len(changed)}/{len(vector_data_1[geom_name])} {geom_name} geometries changed"
+                for geom_name, (_, _, _, changed) in group_changes.items()))
+
+            changes[(dataset, group)] = group_changes
+            changed_vector_data = {geom_name: vector_data_1[geom_name][
+                vector_data_1[geom_name]['index'].isin(changed)]
+                for geom_name, (_, _, _, changed) in group_changes.items()}
+            units[(dataset, group)] = make_work_units(
+                dataset,
+                group,
+                vector_path,
+                changed_vector_data,
+                chunk_size=chunk_size,
+                method=method,
+                tolerance=tolerance,
+                memory_budget=memory_budget and memory_budget * 2**20,
+                coverage=coverage,
+            )
+
+    # Compute level 1 geometries' values for all data types from a single read
+    print(f"Computing {sum(len(x) for x in units.values())} work units with {workers} workers!")
+    all_units = [unit for group_units in units.values() for unit in group_units]
+    # Results of the units are flushed to disk as they finish
+    checkpoints = Checkpoints('precalculations', resume=resume)
+    all_results = iter(run_work_units(all_units, workers=workers, scheduler=scheduler,
+                                      checkpoints=checkpoints))
+
+    for (dataset, group), group_units in units.items():
+        print(f"{dataset.title()}")
+        print(group)
+        raster_metadata = RasterData(dataset, group)
+        data, accumulators = merge_work_units(group_units, [next(all_results) for _ in group_units])
+
+        # Merge with the rows of the geometries that didn't change. Their accumulators are
+        # rebuilt from the rows, the ones of fully recomputed layers are kept.
+        group_changes = changes[(dataset, group)]
+        for geom_name, (_, _, _, changed) in group_changes.items():
+            gdf = vector_data_1[geom_name]
+            if len(changed) < len(gdf):
+                accumulators.pop(geom_name, None)
+            for data_type in data:
+                previous = read_level_1(geom_name, data_type, dataset, group) \
+                    if len(changed) < len(gdf) else None
+                data[data_type][geom_name] = merge_rows(previous, data[data_type][geom_name], gdf,
+                                                        changed)
+                write_level_1(data[data_type][geom_name], geom_name, data_type, dataset, group)
+
+        post_processing = PostProcessing(raster_metadata,
+                                         {geom_name.replace('_1', '_0'): vector_data_0[
+                                             geom_name.replace('_1', '_0')]
+                                          for geom_name in group_changes},
+                                         weighted=coverage is not None)
+        for data_type in data:
+            # compute level 0 geometries' values
+            print(f"Level 0 geometries ({data_type}).")
+            data[data_type] = post_processing.compute_level_0_data(data[data_type],
+                                                                   data_type=data_type,
+                                                                   accumulators=accumulators)
+        # Save data
+        print("Saving the data!")
+        for data_type, values in data.items():
+            data_type_data = {}
+            for key, value in values.items():
+                prefix = key.rsplit('_', 1)[0]
+                data_type_data.setdefault(prefix, []).append(value)
+
+            for geom_type, dfs in data_type_data.items():
+                path = "../data/processed/precalculations/" \
+                    f"{geom_type}_{data_type}_{dataset}_{group}"
+                write_precalculations(pd.concat(dfs), path, formats=formats, index=True)
+
+        for key, layer, geometries, _ in group_changes.values():
+            manifest.update(key, layer, geometries)
+        manifest.save()
+        for unit in group_units:
+            checkpoints.remove(unit_key(unit))
+
+    checkpoints.clear()
+    instrumentation.report()
 
 
 if __name__ == '__main__':
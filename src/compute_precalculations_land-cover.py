@@ -1,13 +1,15 @@
 import os 
-import ast
 
 import pandas as pd
 from dotenv import load_dotenv
 from dask.distributed import Client
 
 from utils.data import VectorData, LandCoverData, LandCoverRasterData
+from utils.cache import ChunkCache
+from utils.checkpoint import Checkpoints
+from utils import instrumentation
 from utils.calculations import LandCoverStatistics
-from utils.util import multiply_dict_values
+from utils.precalculations import read_precalculations, write_precalculations
 
 # Load .env VARIABLEs
 load_dotenv()
@@ -22,9 +24,22 @@ SCENARIOS = ['crop_I', 'crop_MG', 'crop_MGI', 'grass_part', 'grass_full', 'rewil
 READ_DATA_FROM = 's3'#local_dir'
 VARIABLE = 'stocks'
 GROUP_TYPE = 'future'#'recent'
+GROUP_TYPES = ['recent', 'future']
+METHOD = 'label'#'polygon'
 PIX_HA = 6.25
+FORMATS = ['parquet', 'csv']
+MEMORY_BUDGET = 2**29
+# Supersampling factor of the coverage fractions of the pixels (e.g. 4), if set the stocks change
+# is weighted by the geodesic area covered by each geometry instead of PIX_HA
+COVERAGE = None
+# Reuse the statistics checkpointed by a previous run that failed
+RESUME = False
+# JSON lines file of the per stage timings and I/O, INSTRUMENTATION_PATH by default
+INSTRUMENTATION_PATH = None
 
 def main():
+    # Before starting the workers, which inherit the settings
+    instrumentation.configure(INSTRUMENTATION_PATH)
     # Start distributed scheduler locally
     client = Client()  # start distributed scheduler locally. 
     client
@@ -39,22 +54,27 @@ def main():
     print("Reading raster data!")
     lc_metadata = LandCoverData()
     raster = LandCoverRasterData(group_type=GROUP_TYPE, data_from=READ_DATA_FROM, 
-                                 path=RASTER_PATH, scenarios=SCENARIOS)
+                                 path=RASTER_PATH, scenarios=SCENARIOS,
+                                 chunk_cache=ChunkCache() if READ_DATA_FROM == 's3' else None,
+                                 lazy_scenarios=True)
     raster_data = raster.read_data() 
 
     # Compute Land Cover Statistics
     data = {}
-    lc_statistics = LandCoverStatistics(GROUP_TYPE, raster_data, lc_metadata, SCENARIOS)
-    try:
-        # compute level 1 geometries' values
-        print("Level 1 geometries.")
-        data.update(lc_statistics.compute_level_1_data(vector_data_1))
-        # compute level 0 geometries' values
-        print("Level 0 geometries.")
+    lc_statistics = LandCoverStatistics(GROUP_TYPE, raster_data, lc_metadata, SCENARIOS,
+                                        pixel_area=PIX_HA, scenario_reader=raster.read_scenario,
+                                        memory_budget=MEMORY_BUDGET, coverage=COVERAGE)
+    # Statistics are flushed to disk as they are computed, if the run fails it can be
+    # resumed with RESUME = True
+    checkpoints = Checkpoints(f"land_cover_{GROUP_TYPE}", resume=RESUME)
+    # compute level 1 geometries' values
+    print("Level 1 geometries.")
+    data.update(lc_statistics.compute_level_1_data(vector_data_1, method=METHOD,
+                                                   checkpoints=checkpoints))
+    # compute level 0 geometries' values
+    print("Level 0 geometries.")
+    with instrumentation.stage('land_cover_level_0', group_type=GROUP_TYPE):
         data.update(lc_statistics.compute_level_0_data(vector_data_0))
-    except Exception as e:
-        # Handle any exceptions that occur during the computation
-        print(f"An error occurred during the computation: {str(e)}")
     
     # Save data
     print("Saving the data!")
@@ -63,72 +83,27 @@ def main():
         df = df.sort_values(['id_0', 'id'])
         df['variable'] = VARIABLE
         df['group_type'] = GROUP_TYPE
-        df.to_csv(f"{FOLDER_PATH}{geom_type}_land_cover_{GROUP_TYPE}.csv", index=False)
-        
-    client.close()
-
-    # Multiply values with PIX_HA
-    # Get the list of files in the folder
-    files = os.listdir(FOLDER_PATH)
-    # Iterate over the files and extract the prefix
-    data_frames = {}
-    for file in files:
-        if "land_cover" in file:
-            prefix = file.split("_land_cover")[0]
-            if prefix not in data_frames:
-                data_frames[prefix] = []
-            data_frames[prefix].append(file)
-
-    for prefix, files in data_frames.items():
-        for file in files:
-            file_path = os.path.join(FOLDER_PATH, file)
-            df = pd.read_csv(file_path)
-            multiply_values = lambda dictionary: {key: {nested_key: value * PIX_HA for nested_key, value in nested_dict.items()} for key, nested_dict in ast.literal_eval(dictionary).items()}
-
-            if 'recent' in file:
-                df = df[~pd.isna(df['land_cover_groups'])]
-                if 'featurecla' in df.columns:
-                    df = df[~pd.isna(df['featurecla'])]
-                # Use map and lambda to update the column
-                df['land_cover_groups'] = df['land_cover_groups'].map(multiply_values)
-                df['land_cover_group_2018'] = df['land_cover_group_2018'].map(multiply_values)
-                # Use apply to update the column
-                df['land_cover'] = df['land_cover'].apply(lambda x: multiply_dict_values(ast.literal_eval(x), PIX_HA))
-            elif 'future' in file:
-                df = df[~pd.isna(df['land_cover_groups'])]
-                if 'featurecla' in df.columns:
-                    df = df[~pd.isna(df['featurecla'])]
-                # Use map and lambda to update the column
-                df['land_cover_groups'] = df['land_cover_groups'].map(multiply_values)
-                # Use apply to update the column
-                df['land_cover'] = df['land_cover'].apply(lambda x: multiply_dict_values(ast.literal_eval(x), PIX_HA))
+        # Drop geometries without land cover statistics
+        df = df[~pd.isna(df['land_cover_groups'])]
+        if 'featurecla' in df.columns:
+            df = df[~pd.isna(df['featurecla'])]
+        write_precalculations(df, f"{FOLDER_PATH}{geom_type}_land_cover_{GROUP_TYPE}", FORMATS)
 
-            df.to_csv(file_path, index=False)
-
-    
-    # Concatenate datasets
-    # Get the list of files in the folder
-    files = os.listdir(FOLDER_PATH)
-    # Iterate over the files and extract the prefix
-    data_frames = {}
-    for file in files:
-        if "land_cover" in file:
-            prefix = file.split("_land_cover")[0]
-            if prefix not in data_frames:
-                data_frames[prefix] = []
-            data_frames[prefix].append(file)
-    # Concatenate and save the data frames for each prefix
-    for prefix, files in data_frames.items():
+        # Concatenate with the data of the other group types already computed
         dfs = []
-        for file in files:
-            file_path = os.path.join(FOLDER_PATH, file)
-            df = pd.read_csv(file_path)
-            dfs.append(df)
-        concatenated_df = pd.concat(dfs)
-        
-        concatenated_df.sort_values(['id_0', 'id'])
-        output_file = prefix + "_land_cover.csv"
-        concatenated_df.to_csv(os.path.join(FOLDER_PATH, output_file), index=False)
+        for group_type in GROUP_TYPES:
+            file_path = f"{FOLDER_PATH}{geom_type}_land_cover_{group_type}.{FORMATS[0]}"
+            if group_type == GROUP_TYPE:
+                dfs.append(df)
+            elif os.path.exists(file_path):
+                dfs.append(read_precalculations(file_path))
+        write_precalculations(pd.concat(dfs), f"{FOLDER_PATH}{geom_type}_land_cover", FORMATS)
+
+    checkpoints.clear()
+    # The chunks read by the dask workers are emitted by them and added up in the report
+    client.run(instrumentation.flush)
+    instrumentation.report()
+    client.close()
     
     
 if __name__ == '__main__':
@@ -1,12 +1,16 @@
 import click
 
-from utils.raster import GeoTiffConverter
+from utils.raster import GeoTiffConverter, CHUNK_LAYOUTS
 from utils.data import RasterData
 
 
 @click.command()
 @click.argument('datasets', type=lambda s: s.split(','))
-def convert_to_zarr(datasets):
+@click.option('--workers', '-w', default=8, type=int,
+              help='Number of rows of Zarr chunks read and written concurrently.')
+@click.option('--layout', '-l', default='map', type=click.Choice(list(CHUNK_LAYOUTS)),
+              help='Chunk layout of the Zarr arrays.')
+def convert_to_zarr(datasets, workers, layout):
     """
     Convert GeoTIFFs to Zarr.
     """
@@ -22,8 +26,8 @@ def convert_to_zarr(datasets):
             # Create an instance of a GeoTiffData Data Class with all data information
             geotiff_data = RasterData(dataset, group)
             # Save GeoTIFFs as Zarr
-            geotiff_converter = GeoTiffConverter(geotiff_obj=geotiff_data)
-            geotiff_converter.convert_to_zarr()
+            geotiff_converter = GeoTiffConverter(geotiff_obj=geotiff_data, layout=layout)
+            geotiff_converter.convert_to_zarr(workers=workers)
 
 
 if __name__ == '__main__':
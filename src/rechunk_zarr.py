@@ -0,0 +1,32 @@
+import click
+
+from utils.raster import ZarrData, CHUNK_LAYOUTS
+from utils.data import RasterData
+
+
+@click.command()
+@click.argument('datasets', type=lambda s: s.split(','))
+@click.option('--layout', '-l', default='time_series', type=click.Choice(list(CHUNK_LAYOUTS)),
+              help='Chunk layout of the new Zarr arrays.')
+@click.option('--in_s3', is_flag=True, help='Read the Zarr stores from S3.')
+def rechunk(datasets, layout, in_s3):
+    """
+    Rechunk existing Zarr stores into <store>_<layout>.zarr.
+    """
+    groups = {'global': ['historic', 'recent'],
+              'scenarios': ['crop_I', 'crop_MG', 'crop_MGI', 'grass_part', 'grass_full',
+                            'rewilding', 'degradation_ForestToGrass', 'degradation_ForestToCrop',
+                            'degradation_NoDeforestation'],
+              'experimental': ['stocks', 'concentration']}
+
+    for dataset in datasets:
+        print(dataset)
+        for group in groups[dataset]:
+            print(group)
+            raster_data = RasterData(dataset, group)
+            store = raster_data.local_path().replace('.zarr', f'_{layout}.zarr')
+            ZarrData(raster_data, in_s3=in_s3).rechunk(layout, store)
+
+
+if __name__ == '__main__':
+    rechunk()
@@ -0,0 +1,248 @@
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Dict, List
+
+import zarr
+import regionmask
+import xarray as xr
+import geopandas as gpd
+from dotenv import load_dotenv
+
+from utils.coverage import MEMORY_BUDGET, write_coverage
+
+# Load .env variables
+load_dotenv()
+
+
+class MaskCache:
+    """Rasterized vector data stored as Zarr arrays on disk.
+
+    Masks are keyed by a hash of the geometries and index values of the GeoDataFrame
+    plus the coordinates of the target grid, so any change in the vector data or in the
+    raster grid produces a new mask.
+    """
+    path = os.getenv('MASK_CACHE_PATH', '../data/processed/masks/')
+
+    def __init__(self, path: str = None):
+        if path:
+            self.path = path
+
+    @staticmethod
+    def key(gdf: gpd.GeoDataFrame, x: xr.DataArray, y: xr.DataArray,
+            index_column_name: str = 'index') -> str:
+        sha = hashlib.sha256()
+        sha.update(index_column_name.encode())
+        sha.update(gdf[index_column_name].to_numpy().astype('float64').tobytes())
+        for wkb in gdf.geometry.to_wkb():
+            sha.update(wkb)
+        for coords in [x, y]:
+            sha.update(coords.name.encode())
+            sha.update(coords.values.astype('float64').tobytes())
+        return sha.hexdigest()
+
+    def rasterize(self, gdf: gpd.GeoDataFrame, x: xr.DataArray, y: xr.DataArray,
+                  index_column_name: str = 'index') -> xr.DataArray:
+        """Rasterize a GeoDataFrame on the x, y grid, reusing the mask stored on disk if any"""
+        store = os.path.join(self.path, self.key(gdf, x, y, index_column_name) + '.zarr')
+
+        if not os.path.exists(store):
+            mask = regionmask.mask_geopandas(gdf, x, y, numbers=index_column_name)
+
+            # Write to a temporary store first so that concurrent processes never read
+            # a partially written mask
+            os.makedirs(self.path, exist_ok=True)
+            tmp_store = f"{store}.{os.getpid()}.tmp"
+            mask.to_dataset(name='mask').to_zarr(tmp_store, mode='w', consolidated=True)
+            try:
+                os.rename(tmp_store, store)
+            except OSError:
+                # Another process has already stored the same mask
+                shutil.rmtree(tmp_store, ignore_errors=True)
+
+        return xr.open_zarr(store, consolidated=True)['mask']
+
+    def coverage(self, gdf: gpd.GeoDataFrame, x: xr.DataArray, y: xr.DataArray,
+                 index_column_name: str = 'index', supersample: int = 4,
+                 memory_budget: int = MEMORY_BUDGET) -> xr.Dataset:
+        """Labels and coverage fractions of the pixels of the x, y grid, see
+        utils.coverage.write_coverage, reusing the ones stored on disk if any"""
+        key = self.key(gdf, x, y, index_column_name)
+        store = os.path.join(self.path, f"{key}_coverage_{supersample}.zarr")
+
+        if not os.path.exists(store):
+            os.makedirs(self.path, exist_ok=True)
+            tmp_store = f"{store}.{os.getpid()}.tmp"
+            write_coverage(gdf, x, y, tmp_store, index_column_name, supersample, memory_budget)
+            try:
+                os.rename(tmp_store, store)
+            except OSError:
+                shutil.rmtree(tmp_store, ignore_errors=True)
+
+        return xr.open_zarr(store, consolidated=True)
+
+
+class DiskLRUStore(MutableMapping):
+    """Read-through cache of the values of a (remote) Zarr store in a directory on disk.
+
+    Values are stored in one file per key and the least recently used ones are removed
+    when the directory grows beyond max_size bytes. Writes go to the wrapped store.
+    Metadata keys (.zmetadata, .zarray, ...) are always read from the wrapped store so that
+    a rewritten store is never read with stale metadata.
+    """
+    def __init__(self, store: MutableMapping, path: str, max_size: int):
+        self.store = store
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._sizes = OrderedDict()
+        self._current_size = 0
+
+        # Files left by previous runs, oldest first
+        os.makedirs(path, exist_ok=True)
+        entries = [entry for entry in os.scandir(path) if not entry.name.endswith('.tmp')]
+        for entry in sorted(entries, key=lambda x: x.stat().st_mtime):
+            self._sizes[entry.name] = entry.stat().st_size
+            self._current_size += entry.stat().st_size
+
+    def __getstate__(self):
+        # Dask workers get their own lock, counters and index of the directory
+        return self.store, self.path, self.max_size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @staticmethod
+    def _file_name(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _put(self, name: str, value):
+        size = len(value)
+        if size > self.max_size:
+            return
+
+        tmp_file = os.path.join(self.path, f"{name}.{threading.get_ident()}.tmp")
+        with open(tmp_file, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_file, os.path.join(self.path, name))
+
+        with self._lock:
+            self._current_size += size - self._sizes.pop(name, 0)
+            self._sizes[name] = size
+            while self._current_size > self.max_size:
+                old_name, old_size = self._sizes.popitem(last=False)
+                self._current_size -= old_size
+                try:
+                    os.remove(os.path.join(self.path, old_name))
+                except FileNotFoundError:
+                    pass
+
+    def _drop(self, name: str):
+        with self._lock:
+            self._current_size -= self._sizes.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def __getitem__(self, key: str):
+        if key.rsplit('/', 1)[-1].startswith('.'):
+            return self.store[key]
+
+        name = self._file_name(key)
+        with self._lock:
+            cached = name in self._sizes
+            if cached:
+                self._sizes.move_to_end(name)
+
+        if cached:
+            try:
+                with open(os.path.join(self.path, name), 'rb') as f:
+                    value = f.read()
+                with self._lock:
+                    self.hits += 1
+                return value
+            except FileNotFoundError:
+                # Evicted in the meantime
+                pass
+
+        value = self.store[key]
+        with self._lock:
+            self.misses += 1
+        self._put(name, value)
+        return value
+
+    def __setitem__(self, key: str, value):
+        self.store[key] = value
+        self._drop(self._file_name(key))
+
+    def __delitem__(self, key: str):
+        del self.store[key]
+        self._drop(self._file_name(key))
+
+    def __contains__(self, key) -> bool:
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def listdir(self, path: str = '') -> List[str]:
+        return zarr.storage.listdir(self.store, path)
+
+
+class ChunkCache:
+    """Bounded in-memory and on-disk LRU caches of the chunks read from remote Zarr stores.
+
+    Polygon windows of neighbouring geometries share most of their chunks, with the caches
+    each chunk is only fetched once from S3 as long as it is not evicted. The on-disk cache
+    of each store is kept in its own directory and persists between runs. The directory is
+    keyed by the consolidated metadata of the store, which has the time its groups were
+    written (utils.raster.mark_written), so a converted or rechunked store starts a new cache.
+    Chunks rewritten without updating the metadata are only read again once the directory of
+    the store is removed.
+    """
+    path = os.getenv('CHUNK_CACHE_PATH', '../data/processed/chunks/')
+
+    def __init__(self, path: str = None, memory_size: int = 2**30, disk_size: int = 2**34):
+        if path:
+            self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.stores = {}
+        self.disk_stores = {}
+
+    @staticmethod
+    def _version(store: MutableMapping) -> bytes:
+        """Consolidated metadata of the store, with the time its groups were written, empty
+        if it isn't consolidated"""
+        try:
+            return store['.zmetadata']
+        except KeyError:
+            return b''
+
+    def wrap(self, store: MutableMapping) -> zarr.LRUStoreCache:
+        """Store reading through the in-memory and on-disk caches"""
+        root = str(getattr(store, 'root', store))
+        if root not in self.stores:
+            sha = hashlib.sha256(root.encode())
+            sha.update(self._version(store))
+            path = os.path.join(self.path, sha.hexdigest())
+            self.disk_stores[root] = DiskLRUStore(store, path, self.disk_size)
+            self.stores[root] = zarr.LRUStoreCache(self.disk_stores[root],
+                                                   max_size=self.memory_size)
+        return self.stores[root]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Hits and misses of the memory and disk caches of every store"""
+        return {root: {'memory_hits': store.hits, 'memory_misses': store.misses,
+                       'disk_hits': self.disk_stores[root].hits,
+                       'disk_misses': self.disk_stores[root].misses}
+                for root, store in self.stores.items()}
@@ -1,221 +1,469 @@
-from typing import Dict, List
+import time
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
-import regionmask
 import xarray as xr
 import geopandas as gpd
-import dask.array as da
 from tqdm import tqdm
 from shapely.affinity import translate
 
 from utils.data import RasterData, LandCoverData
-from utils.util import sum_dicts, sort_dict, \
-    remove_small_polygons, split_geometry_with_antimeridian, \
-    get_recent_lc_statistics, get_future_lc_statistics
+from utils.cache import MaskCache
+from utils.checkpoint import Checkpoints
+from utils.instrumentation import stage, iter_stages, timer, observe
+from utils.zonal import LabelAccumulator, iter_blocks, iter_tiles, overview_factors
+from utils.coverage import pixel_areas
+from utils.land_cover import LandCoverAccumulator, LandCoverCodes
+from utils.util import split_geometry_with_antimeridian
+
+
+# Bytes of raster values that a polygon window can load at once, larger windows are read
+# tile by tile
+MEMORY_BUDGET = 2**29
 
 
 class ZonalStatistics:
-    def __init__(self, raster_data: xr.Dataset, vector_data: Dict[str, gpd.GeoDataFrame], raster_metadata: RasterData):
+    def __init__(self, raster_data: xr.Dataset, vector_data: Dict[str, gpd.GeoDataFrame],
+                 raster_metadata: RasterData, mask_cache: MaskCache = None,
+                 overviews: Dict[int, xr.Dataset] = None,
+                 tolerance: float = None, memory_budget: int = MEMORY_BUDGET,
+                 coverage: int = None):
         self.raster_data = raster_data
         self.vector_data = vector_data
         self.raster_metadata = raster_metadata
+        self.mask_cache = mask_cache or MaskCache()
+        self.accumulators = {}
+        # Overview levels by coarsening factor (ZarrData.read_overviews) and the fraction of
+        # boundary pixels a geometry can have at the overview level it is computed from
+        self.overviews = overviews or {}
+        self.tolerance = tolerance
+        self.overview_masks = {}
+        self.memory_budget = memory_budget
+        # Supersampling factor of the coverage fractions of the pixels, if given the pixels
+        # are weighted by their covered area instead of assigned by their center
+        assert coverage is None or tolerance is None, "coverage can't be used with overviews"
+        self.coverage = coverage
+        self.coverages = {}
 
     def rasterize_vector_data(self, index_column_name: str = 'index',
                               x_coor_name: str = 'lon', y_coor_name: str = 'lat'):
         """Rasterize a GeoDataFrame using xarray Dataset
         as a reference and add it as a new variable"""
-        for mask_name, gdf in tqdm(self.vector_data.items()):
-            mask = regionmask.mask_geopandas(
+        for mask_name, gdf in tqdm(iter_stages('rasterize', self.vector_data),
+                                   total=len(self.vector_data)):
+            # The coverage mode only uses the coverage fractions
+            if self.coverage:
+                self.coverages[mask_name] = self.mask_cache.coverage(
+                    gdf, self.raster_data[x_coor_name], self.raster_data[y_coor_name],
+                    index_column_name, self.coverage, self.memory_budget)
+                continue
+
+            mask = self.mask_cache.rasterize(
                 gdf,
                 self.raster_data[x_coor_name],
                 self.raster_data[y_coor_name],
-                numbers=index_column_name
+                index_column_name
             )
 
             self.raster_data[mask_name] = mask
 
+            # Masks of the overview levels, only used with a tolerance
+            if self.tolerance is not None:
+                for factor, overview in self.overviews.items():
+                    self.overview_masks[(mask_name, factor)] = self.mask_cache.rasterize(
+                        gdf, overview[x_coor_name], overview[y_coor_name], index_column_name)
+
         return self.raster_data
 
-    def compute(self, index_column_name: str = 'index', data_type: str = 'time_series') -> Dict[str, pd.DataFrame]:
+    def compute(self, index_column_name: str = 'index', data_type: str = 'time_series',
+                method: str = 'polygon') -> Dict[str, pd.DataFrame]:
+        """Compute zonal statistics of one data type for every geometry of the vector data"""
         assert data_type in ['change', 'time_series'], "data_type must be 'change' or 'time_series'"
 
-        df_list = []
-        data = {}
-        for geom_name, gdf in self.vector_data.items():
-            print(f"computing {data_type} for vector data -> {geom_name}")
-            if self.raster_metadata.iso():
-                if 'political' in geom_name:
-                    gdf = gdf[gdf['gid_0'] == self.raster_metadata.iso()]
-                else:
-                    region = gpd.read_file(self.raster_metadata.geometry_path())
-                    geom = region.geometry.iloc[0]
-                    gdf = gdf[gdf.intersects(geom)]
+        return self.compute_all(index_column_name, method=method, data_types=[data_type])[data_type]
+
+    def compute_all(self, index_column_name: str = 'index', method: str = 'polygon',
+                    data_types: List[str] = ('change', 'time_series')
+                    ) -> Dict[str, Dict[str, pd.DataFrame]]:
+        """Compute the zonal statistics of several data types from a single read of the raster.
+
+        method='polygon' reduces the raster window of each geometry separately, while
+        method='label' walks each raster chunk once and reduces all the geometries at once
+        using the masks added by rasterize_vector_data.
+        """
+        assert all(data_type in ['change', 'time_series'] for data_type in data_types), \
+            "data_types must be 'change' and/or 'time_series'"
+        assert method in ['polygon', 'label'], "method must be 'polygon' or 'label'"
+        assert not self.coverage or method == 'label', "coverage requires method='label'"
+
+        variable = self.raster_metadata.variable()
+        times = self.raster_metadata.times()
+        years = self.raster_metadata.years()
+        depths = list(self.raster_metadata.depths().keys())
 
+        ds_var = self.raster_data[variable].sel(depth=depths)
+        ds_var = ds_var.transpose('depth', 'time', 'lat', 'lon')
+        time_index = self.raster_data.indexes['time']
+        time_indexes = (time_index.get_loc(times[0]), time_index.get_loc(times[-1]))
+        metadata = {"years": [years[0], years[-1]],
+                    "variable": variable,
+                    "group_type": self.raster_metadata.dataset}
+
+        data = {data_type: {} for data_type in data_types}
+        for geom_name, gdf in iter_stages('compute', self.vector_data, method=method,
+                                          data_types=data_types):
+            print(f"computing {', '.join(data_types)} for vector data -> {geom_name}")
+            gdf = self.raster_metadata.filter_vector_data(geom_name, gdf)
             indexes = gdf[index_column_name].tolist()
-            times = self.raster_metadata.times()
-            years = self.raster_metadata.years()
-            depths = list(self.raster_metadata.depths().keys())
-
-            for index in tqdm(indexes):
-                geom = gdf[gdf[index_column_name] == index]['geometry'].iloc[0]
-                xmin, ymax, xmax, ymin = geom.bounds
-                ds_index = self.raster_data.sel(lon=slice(xmin, xmax), lat=slice(ymin, ymax)).copy()
-                ds_index = ds_index.where(ds_index[geom_name].isin(index))
-
-                for n, depth in enumerate(depths):
-                    try:
-                        if (self.raster_metadata.dataset == 'experimental') and (
-                                self.raster_metadata.group == 'stocks'):
-                            ds_var = ds_index.where(ds_index[geom_name].isin(index)).sel(
-                                depth=depth)[self.raster_metadata.variable()] / 10.
-                        else:
-                            ds_var = ds_index.where(ds_index[geom_name].isin(index)).sel(
-                                depth=depth)[self.raster_metadata.variable()]
-
-                        if data_type == 'change':
-                            # Get difference between two dates
-                            diff = ds_var.loc[dict(time=times[-1])] - ds_var.loc[dict(time=times[0])]
-
-                            if len(depths) == len(self.raster_metadata.n_binds()):
-                                h, bins = da.histogram(diff, bins=self.raster_metadata.n_binds()[n],
-                                                       range=self.raster_metadata.bind_ranges()[n])
-                            else:
-                                h, bins = da.histogram(diff, bins=self.raster_metadata.n_binds()[0],
-                                                       range=self.raster_metadata.bind_ranges()[0])
-
-                            # Get values
-                            sum_diff = diff.sum().values
-                            count_diff = diff.count().values
-                            if count_diff != 0:
-                                mean_diff = sum_diff / count_diff
-                            else:
-                                mean_diff = sum_diff
-
-                            # Save values
-                            df_list.append({
-                                "index": index,
-                                "counts": h.compute().tolist(),
-                                "bins": bins.tolist(),
-                                "sum_diff": sum_diff,
-                                "count_diff": count_diff,
-                                "mean_diff": mean_diff,
-                                "depth": depth,
-                                "years": [years[0], years[-1]],
-                                "variable": self.raster_metadata.variable(),
-                                "group_type": self.raster_metadata.dataset
-                            })
-
-                        elif data_type == 'time_series':
-                            # Get values
-                            sums = ds_var.sum(['lon', 'lat']).values
-                            counts = ds_var.count(['lon', 'lat']).values
-                            if all(elem == 0 for elem in counts):
-                                values = sums
-                            else:
-                                values = sums / counts
-
-                            # Save values
-                            df_list.append({
-                                "index": index,
-                                "sum_values": sums.tolist(),
-                                "count_values": counts.tolist(),
-                                "mean_values": values.tolist(),
-                                "depth": depth,
-                                "years": [years[0], years[-1]],
-                                "variable": self.raster_metadata.variable(),
-                                "group_type": self.raster_metadata.dataset
-                            })
-
-                    except Exception as e:
-                        pass
-            df = pd.DataFrame(df_list)
-            data[geom_name] = pd.merge(gdf.drop(columns='geometry'), df, how='left', on='index')
+
+            # Large geometries are computed from the coarsest overview within the tolerance
+            factors = self._overview_factors(gdf)
+            accumulators = []
+            for factor in np.unique(factors):
+                gdf_level = gdf[factors == factor]
+                accumulator = LabelAccumulator(gdf_level[index_column_name], len(depths),
+                                               ds_var.sizes['time'], data_types=data_types,
+                                               bins=self.raster_metadata.bins(),
+                                               time_indexes=time_indexes,
+                                               weighted=bool(self.coverage))
+                if factor > 1:
+                    self._accumulate_overview(accumulator, factor, depths, geom_name)
+                elif self.coverage:
+                    self._accumulate_by_coverage(accumulator, ds_var, self.coverages[geom_name])
+                elif method == 'label':
+                    mask = self.raster_data[geom_name].transpose('lat', 'lon')
+                    self._accumulate_by_label(accumulator, ds_var, mask)
+                else:
+                    mask = self.raster_data[geom_name].transpose('lat', 'lon')
+                    self._accumulate_by_polygon(accumulator, ds_var, mask, gdf_level,
+                                                index_column_name)
+                accumulators.append(accumulator)
+
+            accumulator = accumulators[0] if len(accumulators) == 1 else \
+                LabelAccumulator.combine(accumulators)
+            self.accumulators[geom_name] = accumulator
+
+            with timer('frame'):
+                for data_type in data_types:
+                    records = accumulator.to_records(data_type, indexes, depths, metadata)
+                    df = pd.DataFrame(records) if records else pd.DataFrame(columns=['index'])
+                    data[data_type][geom_name] = pd.merge(gdf.drop(columns='geometry'), df,
+                                                          how='left', on='index')
 
         return data
 
+    def _overview_factors(self, gdf: gpd.GeoDataFrame) -> np.ndarray:
+        """Overview factor each geometry is computed from, 1 for full resolution"""
+        if not self.overviews or self.tolerance is None:
+            return np.ones(len(gdf), dtype='int64')
+
+        resolution = abs(float(self.raster_data['lon'][1] - self.raster_data['lon'][0]))
+        return overview_factors(gdf, resolution, list(self.overviews), self.tolerance)
+
+    def _accumulate_overview(self, accumulator: LabelAccumulator, factor: int, depths: List[str],
+                             geom_name: str):
+        """Accumulate the coarse pixels of an overview level using the masks added by
+        rasterize_vector_data"""
+        overview = self.overviews[factor].sel(depth=depths)
+        mask = self.overview_masks[(geom_name, factor)].transpose('lat', 'lon')
+        dims = {'sum': ('depth', 'time', 'lat', 'lon'),
+                'count': ('depth', 'time', 'lat', 'lon'),
+                'sum_diff': ('depth', 'lat', 'lon'),
+                'count_diff': ('depth', 'lat', 'lon'),
+                'hist': ('depth', 'bin', 'lat', 'lon')}
+        for y_slice, x_slice in tqdm(list(iter_blocks(overview['sum']))):
+            labels_block = mask[y_slice, x_slice].values
+            # Skip chunks without any of the geometries (e.g. oceans)
+            if not accumulator.has_labels(labels_block):
+                continue
+
+            block = overview.isel(lat=y_slice, lon=x_slice).load()
+            accumulator.update_aggregates({name: block[name].transpose(*dims[name]).values
+                                           for name in dims}, labels_block)
+
+    def _read_values(self, ds_var: xr.DataArray) -> np.ndarray:
+        """Load a (depth, time, lat, lon) window of the variable in memory"""
+        with timer('read'):
+            values = ds_var.values
+        if self.raster_metadata.unit_divisor() != 1:
+            values = values / self.raster_metadata.unit_divisor()
+
+        return values
+
+    def _accumulate_by_polygon(self, accumulator: LabelAccumulator, ds_var: xr.DataArray,
+                               mask: xr.DataArray, gdf: gpd.GeoDataFrame,
+                               index_column_name: str = 'index'):
+        # Pixels that fit in the memory budget, counting the values of all depths and times
+        # and the temporary arrays of LabelAccumulator.update
+        pixel_bytes = ds_var.sizes['depth'] * ds_var.sizes['time'] * 8 * 4
+        max_pixels = max(1, self.memory_budget // pixel_bytes)
+
+        for index, geom in tqdm(list(zip(gdf[index_column_name], gdf['geometry']))):
+            start = time.perf_counter()
+            xmin, ymax, xmax, ymin = geom.bounds
+            window = dict(lon=slice(xmin, xmax), lat=slice(ymin, ymax))
+            labels_window = mask.sel(**window)
+            ds_window = ds_var.sel(**window)
+
+            if labels_window.size <= max_pixels:
+                # Read the window once for all depths, times and data types
+                labels_window = labels_window.values
+                labels_window = np.where(labels_window == index, labels_window, np.nan)
+                accumulator.update(self._read_values(ds_window), labels_window)
+                observe('polygon', time.perf_counter() - start)
+                continue
+
+            # Large geometries are read tile by tile and added to the same accumulator
+            for y_slice, x_slice in iter_tiles(ds_window, max_pixels=max_pixels):
+                labels_block = labels_window[y_slice, x_slice].values
+                labels_block = np.where(labels_block == index, labels_block, np.nan)
+                if np.isnan(labels_block).all():
+                    continue
+                accumulator.update(self._read_values(ds_window[:, :, y_slice, x_slice]),
+                                   labels_block)
+            observe('polygon', time.perf_counter() - start)
+
+    def _accumulate_by_label(self, accumulator: LabelAccumulator, ds_var: xr.DataArray,
+                             mask: xr.DataArray):
+        for y_slice, x_slice in tqdm(list(iter_blocks(ds_var))):
+            labels_block = mask[y_slice, x_slice].values
+            # Skip chunks without any of the geometries (e.g. oceans)
+            if not accumulator.has_labels(labels_block):
+                continue
+
+            accumulator.update(self._read_values(ds_var[:, :, y_slice, x_slice]), labels_block)
+
+    def _accumulate_by_coverage(self, accumulator: LabelAccumulator, ds_var: xr.DataArray,
+                                coverage: xr.Dataset):
+        """Add every layer of labels of the chunks weighted by the area of the pixels
+        covered by each label"""
+        lat = ds_var['lat'].values
+        areas = pixel_areas(lat, float(ds_var['lon'][1] - ds_var['lon'][0]),
+                            float(lat[1] - lat[0]))
+        coverage = coverage.transpose('layer', 'lat', 'lon')
+
+        for y_slice, x_slice in tqdm(list(iter_blocks(ds_var))):
+            layers = coverage.isel(lat=y_slice, lon=x_slice).load()
+            labels = layers['label'].values
+            # Skip chunks without any of the geometries (e.g. oceans)
+            if not accumulator.has_labels(labels):
+                continue
+
+            values = self._read_values(ds_var[:, :, y_slice, x_slice])
+            weights = layers['fraction'].values * areas[y_slice, None]
+            for labels_block, weights_block in zip(labels, weights):
+                accumulator.update(values, labels_block, weights_block)
+
 
 class PostProcessing:
-    def __init__(self, raster_metadata: RasterData, vector_data: Dict[str, gpd.GeoDataFrame]):
+    def __init__(self, raster_metadata: RasterData, vector_data: Dict[str, gpd.GeoDataFrame],
+                 weighted: bool = False):
         self.raster_metadata = raster_metadata
         self.vector_data = vector_data
+        # Whether the child level rows are area weighted (coverage mode)
+        self.weighted = weighted
+        self.accumulators = {}
 
-    def compute_level_0_data(self, data: Dict[str, pd.DataFrame], data_type: str = 'time_series'
+    def compute_level_0_data(self, data: Dict[str, pd.DataFrame], data_type: str = 'time_series',
+                             accumulators: Dict[str, LabelAccumulator] = None
                              ) -> Dict[str, pd.DataFrame]:
+        with stage('level_0', data_type=data_type, geom_names=list(self.vector_data)):
+            return self.compute_parent_level_data(data, data_type, accumulators,
+                                                  child_level='_1', parent_level='_0',
+                                                  parent_column_name='id_0')
+
+    def compute_parent_level_data(self, data: Dict[str, pd.DataFrame],
+                                  data_type: str = 'time_series',
+                                  accumulators: Dict[str, LabelAccumulator] = None,
+                                  child_level: str = '_1', parent_level: str = '_0',
+                                  parent_column_name: str = 'id_0') -> Dict[str, pd.DataFrame]:
+        """Reduce the statistics of the child geometries into the ones of their parents.
+
+        The accumulators of the child level (e.g. ZonalStatistics.accumulators) are summed by
+        parent id. If they are not given they are rebuilt from the child level rows.
+        """
         assert data_type in ['change', 'time_series'], "data_type must be 'change' or 'time_series'"
 
         depths = list(self.raster_metadata.depths().keys())
 
         for geom_name, gdf in self.vector_data.items():
-            geom_name_1 = geom_name.replace('_0', '_1')
-            df = data[geom_name_1]
+            geom_name_child = geom_name.replace(parent_level, child_level)
+            df = data[geom_name_child]
             print(f"computing {data_type} for vector data -> {geom_name}")
             df = df[df['id'].notna()]
-            df = df.astype({'id': int, 'id_0': int})
-
-            if self.raster_metadata.iso() and ('political' in geom_name):
-                gdf = gdf[gdf['gid_0'] == self.raster_metadata.iso()]
-            else:
-                region = gpd.read_file(self.raster_metadata.geometry_path())
-                geom = region.geometry.iloc[0]
-                gdf = gdf[gdf.intersects(geom)]
-
-            df_final = pd.DataFrame()
-            for depth in tqdm(depths):
-                df_tmp = df[df['depth'] == depth].copy()
-
-                if not df_tmp.empty:
-                    if data_type == 'change':
-                        df_tmp = df_tmp.astype({'sum_diff': 'float64', 'count_diff': 'float64', 'mean_diff': 'float64'})
-                        df_tmp['counts'] = df_tmp['counts'].apply(lambda x: np.array(x))
-                        df_counts = df_tmp[['id_0', 'counts']].groupby('id_0').sum().reset_index()
-                        df_counts['bins'] = [df_tmp['bins'].iloc[0]] * len(df_counts)
+            df = df.astype({'id': int, parent_column_name: int})
 
-                        df_diff = df_tmp[['id_0', 'sum_diff', 'count_diff']].groupby('id_0').sum().reset_index()
-                        df_diff['mean_diff'] = df_diff['sum_diff'] / df_diff['count_diff']
+            gdf = self.raster_metadata.filter_vector_data(geom_name, gdf)
 
-                        df_depth = pd.merge(df_counts, df_diff, on='id_0', how='left')
-
-                    elif data_type == 'time_series':
-                        df_tmp['sum_values'] = df_tmp['sum_values'].apply(lambda x: np.array(x))
-                        df_tmp['count_values'] = df_tmp['count_values'].apply(lambda x: np.array(x))
-                        df_depth = df_tmp[['id_0', 'sum_values', 'count_values']].groupby(
-                            'id_0').sum().reset_index()
-                        df_depth['mean_values'] = df_depth['sum_values'] / df_depth['count_values']
-
-                    df_depth['depth'] = depth
-                    df_depth['years'] = [df_tmp['years'].iloc[0]] * len(df_depth)
-                    df_depth['variable'] = df_tmp['variable'].iloc[0]
-                    df_depth['group_type'] = df_tmp['group_type'].iloc[0]
+            if accumulators and geom_name_child in accumulators:
+                accumulator = accumulators[geom_name_child]
+            else:
+                accumulator = LabelAccumulator.from_frame(df, depths, [data_type],
+                                                          self.raster_metadata.bins(),
+                                                          weighted=self.weighted)
 
-                    df_final = pd.concat([df_final, df_depth])
+            # Sum the child arrays by parent id
+            self.accumulators[geom_name] = accumulator.aggregate(df['index'],
+                                                                 df[parent_column_name])
+            df_final = self._parent_level_frame(self.accumulators[geom_name], data_type,
+                                                parent_column_name)
 
-            df_final = pd.merge(gdf.drop(columns='geometry').astype({'id_0': int}),
-                                df_final.astype({'id_0': int}), on='id_0', how='left')
+            df_final = pd.merge(gdf.drop(columns='geometry').astype({parent_column_name: int}),
+                                df_final.astype({parent_column_name: int}), on=parent_column_name,
+                                how='left')
 
             data[geom_name] = df_final
 
         return data
 
+    def _parent_level_frame(self, accumulator: LabelAccumulator, data_type: str,
+                            parent_column_name: str = 'id_0') -> pd.DataFrame:
+        depths = list(self.raster_metadata.depths().keys())
+        years = self.raster_metadata.years()
+        ids = accumulator.labels.astype(int)
+
+        df_list = []
+        for n, depth in enumerate(depths):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if data_type == 'change':
+                    df_depth = pd.DataFrame({
+                        parent_column_name: ids,
+                        "counts": accumulator.hist[n].tolist(),
+                        "bins": [accumulator.bins[n].tolist()] * len(ids),
+                        "sum_diff": accumulator.sum_diff[n],
+                        "count_diff": accumulator.count_diff[n],
+                        "mean_diff": accumulator.sum_diff[n] / accumulator.count_diff[n]
+                    })
+                elif data_type == 'time_series':
+                    sums = accumulator.sums[n].T
+                    counts = accumulator.counts[n].T
+                    df_depth = pd.DataFrame({
+                        parent_column_name: ids,
+                        "sum_values": sums.tolist(),
+                        "count_values": counts.tolist(),
+                        "mean_values": (sums / counts).tolist()
+                    })
+
+            df_depth['depth'] = depth
+            df_depth['years'] = [[years[0], years[-1]]] * len(df_depth)
+            df_depth['variable'] = self.raster_metadata.variable()
+            df_depth['group_type'] = self.raster_metadata.dataset
+            df_list.append(df_depth)
+
+        return pd.concat(df_list)
+
 
 class LandCoverStatistics:
     def __init__(self, group_type: str, raster_data: xr.Dataset, 
-                raster_metadata: LandCoverData, scenarios: List['str']):
+                raster_metadata: LandCoverData, scenarios: List['str'],
+                mask_cache: MaskCache = None,
+                pixel_area: float = 1, scenario_reader: Callable[[str], xr.DataArray] = None,
+                memory_budget: int = MEMORY_BUDGET, coverage: int = None):
         self.group_type = group_type
         self.raster_data = raster_data
         self.raster_metadata = raster_metadata
         self.scenarios = scenarios
+        self.mask_cache = mask_cache or MaskCache()
+        # Area of a pixel (e.g. in ha) the per pixel stocks change is scaled by
+        self.pixel_area = pixel_area
+        # Opens the stocks change of a future scenario missing from the raster data,
+        # e.g. LandCoverRasterData.read_scenario
+        self.scenario_reader = scenario_reader
+        self.opened_scenarios = {}
+        # Bytes of raster values read at once
+        self.memory_budget = memory_budget
+        # Supersampling factor of the coverage fractions of the pixels, if given the stocks
+        # change of the pixels is weighted by their covered area instead of pixel_area
+        self.coverage = coverage
+        # Transition matrices of every vector layer, the nested dictionaries of the
+        # statistics are only built from them for the output rows
+        self.accumulators = {}
+
+    def _scenario(self, scenario: str) -> xr.DataArray:
+        """Stocks change of a future scenario, opened on demand if it isn't in the raster data"""
+        if scenario in self.raster_data:
+            return self.raster_data[scenario]
+        if scenario not in self.opened_scenarios:
+            self.opened_scenarios[scenario] = self.scenario_reader(scenario)
+        return self.opened_scenarios[scenario]
+
+    def _label_layers(self, mask: Union[xr.DataArray, xr.Dataset], y_slice: slice, x_slice: slice,
+                      x_coor_name: str = 'x', y_coor_name: str = 'y'
+                      ) -> List[Tuple[np.ndarray, Optional[np.ndarray]]]:
+        """(labels, weights) blocks of a rasterized mask, or of every layer of a coverage
+        dataset (MaskCache.coverage) weighted by the area covered by each label"""
+        if isinstance(mask, xr.DataArray):
+            return [(mask[y_slice, x_slice].values, None)]
+
+        layers = mask.isel({y_coor_name: y_slice, x_coor_name: x_slice}).load()
+        lat = mask[y_coor_name].values
+        areas = pixel_areas(lat[y_slice], float(mask[x_coor_name][1] - mask[x_coor_name][0]),
+                            float(lat[1] - lat[0]))
+        weights = layers['fraction'].values * areas[:, None]
+        return list(zip(layers['label'].values, weights))
+
+    def _accumulate_future(self, accumulator: LandCoverAccumulator, land_cover: xr.DataArray,
+                           mask: Union[xr.DataArray, xr.Dataset], x_coor_name: str = 'x',
+                           y_coor_name: str = 'y'):
+        """Add the chunks of a 2018 land cover window to the accumulator, reading the stocks
+        change of one scenario at a time so that only one of them is in memory"""
+        coords = {x_coor_name: land_cover[x_coor_name], y_coor_name: land_cover[y_coor_name]}
+        scenarios = {scenario: self._scenario(scenario).reindex(coords)
+                     .transpose(y_coor_name, x_coor_name) for scenario in self.scenarios}
+        land_cover = land_cover.transpose(y_coor_name, x_coor_name)
+        mask = mask.transpose(..., y_coor_name, x_coor_name)
+
+        # Land cover, labels and one scenario of every pixel, plus temporary arrays
+        max_pixels = max(1, self.memory_budget // (8 * 6))
+        for y_slice, x_slice in iter_tiles(land_cover, x_coor_name, y_coor_name, max_pixels):
+            layers = self._label_layers(mask, y_slice, x_slice, x_coor_name, y_coor_name)
+            # Skip chunks without any of the geometries (e.g. oceans)
+            if not any(accumulator.has_labels(labels_block) for labels_block, _ in layers):
+                continue
+
+            land_cover_block = land_cover[y_slice, x_slice].values
+            for scenario, values in scenarios.items():
+                values_block = values[y_slice, x_slice].values
+                for labels_block, weights in layers:
+                    accumulator.update_future(land_cover_block, {scenario: values_block},
+                                              labels_block, weights)
+
+    def _accumulate_recent(self, accumulator: LandCoverAccumulator, ds: xr.Dataset,
+                           mask: Union[xr.DataArray, xr.Dataset], x_coor_name: str = 'x',
+                           y_coor_name: str = 'y'):
+        """Add the chunks of a window of the 2000 and 2018 land cover and stocks to the
+        accumulator"""
+        ds = ds[['land-cover', 'stocks']]
+        mask = mask.transpose(..., y_coor_name, x_coor_name)
+
+        # Land cover and stocks of both years and the labels of every pixel, plus temporary arrays
+        max_pixels = max(1, self.memory_budget // (8 * 10))
+        for y_slice, x_slice in iter_tiles(ds['land-cover'], x_coor_name, y_coor_name, max_pixels):
+            layers = self._label_layers(mask, y_slice, x_slice, x_coor_name, y_coor_name)
+            # Skip chunks without any of the geometries (e.g. oceans)
+            if not any(accumulator.has_labels(labels_block) for labels_block, _ in layers):
+                continue
+
+            # Read all the variables of the chunk once
+            ds_block = ds.isel({y_coor_name: y_slice, x_coor_name: x_slice}).load()
+            for labels_block, weights in layers:
+                accumulator.update_recent(
+                    ds_block['land-cover'].transpose('time', y_coor_name, x_coor_name).values,
+                    ds_block['stocks'].transpose('time', y_coor_name, x_coor_name).values,
+                    labels_block, weights)
         
     def _rasterize_vector_data(self, ds: xr.Dataset, gdf: gpd.GeoDataFrame,
                             index_column_name: str = 'index', 
                             x_coor_name: str = 'x', y_coor_name: str = 'y') -> xr.Dataset:
         """Rasterize a GeoDataFrame using xarray Dataset
         as a reference and add it as a new variable"""
-        mask = regionmask.mask_geopandas(
+        mask = self.mask_cache.rasterize(
             gdf,
             ds[x_coor_name],
             ds[y_coor_name],
-            numbers=index_column_name
+            index_column_name
         )
 
         ds['mask'] = mask
@@ -223,158 +471,195 @@ class LandCoverStatistics:
         return ds
         
 
+    def _rasterize_window(self, ds: xr.Dataset, gdf: gpd.GeoDataFrame, *args) -> xr.Dataset:
+        """_rasterize_vector_data of the window of a geometry, None if the window has no pixels
+        (i.e. the geometry is outside of the raster)"""
+        if not ds.sizes['x'] or not ds.sizes['y']:
+            return None
+        return self._rasterize_vector_data(ds, gdf, *args)
+
     def compute_level_1_data(self, vector_data_1: Dict[str, gpd.GeoDataFrame], 
                 index_column_name: str = 'index',
                 x_coor_name: str = 'x', 
-                y_coor_name: str = 'y') -> Dict[str, pd.DataFrame]:
+                y_coor_name: str = 'y',
+                method: str = 'polygon',
+                checkpoints: Checkpoints = None,
+                chunk_size: int = 100) -> Dict[str, pd.DataFrame]:
+        """Compute land cover statistics for every geometry of the vector data.
+
+        method='polygon' rasterizes and reduces the raster window of each geometry
+        separately, while method='label' rasterizes the whole layer once and reduces all
+        the geometries in one pass over the chunks.
+
+        With checkpoints the matrices of every chunk of chunk_size geometries (of every
+        layer with method='label') are flushed to disk as they finish, and the ones of a
+        previous run are reused.
+        """
+        assert method in ['polygon', 'label'], "method must be 'polygon' or 'label'"
+        assert not self.coverage or method == 'label', "coverage requires method='label'"
         
         self.vector_data = vector_data_1
+        # Areas are already in the weights of the coverage fractions
+        pixel_area = 1 if self.coverage else self.pixel_area
         
         self.level_1_data = {}
         for geom_name, gdf in self.vector_data.items():
             print(f"Computing land cover statistics for vector data -> {geom_name}")
-            indexes = gdf[index_column_name].tolist()
-
-            df_list = []
-            for index in tqdm(indexes):
-                gdf_index  = gdf[gdf['index'] == index].copy()
-        
-                # Get bounds
-                xmin_180, ymin, xmax_180, ymax = gdf_index.to_crs("+proj=latlong +datum=WGS84 +lon_0=180")['geometry'].iloc[0].bounds
-                geom = gdf_index['geometry'].iloc[0]
-                xmin, ymin, xmax, ymax = geom.bounds
-                
-                # Take care of the antimeridian
-                if not round(xmin_180) <= -179 and not round(xmax_180) >= 179:
-                    if round(xmin) <= -175 and round(xmax) >= 175:
-                        # Split the geometry with the antimeridian.
-                        gdf_split = split_geometry_with_antimeridian(gdf_index)
-                        
-                        ds_list = []
-                        for side in ['left', 'right']:
-                            gdf_side = gdf_split[gdf_split['side'] == side].drop(columns="side")
-                            geom = gdf_side['geometry'].iloc[0]
-                            xmin, ymin, xmax, ymax = geom.bounds
-                            ds_side = self.raster_data.sel(x=slice(xmin, xmax), y=slice(ymax, ymin)) 
-                            # Rasterize vector data
-                            ds_list.append(self._rasterize_vector_data(ds_side, 
-                                                                        gdf_side.drop(columns="index").reset_index(),
-                                                                        'index', 'x', 'y'))
-
-                        # Combine the two datasets using combine_by_coords
-                        ds_index = xr.combine_by_coords(ds_list)
-
-                    else:
-                        ds_index = self.raster_data.sel(x=slice(xmin, xmax), y=slice(ymax, ymin)).copy()
-                        # Rasterize vector data
-                        ds_index = self._rasterize_vector_data(ds_index, 
-                                                                        gdf_index.drop(columns="index").reset_index(), 
-                                                                        'index', 'x', 'y')
-                else:
-                        ds_index = self.raster_data.sel(x=slice(xmin, xmax), y=slice(ymax, ymin)).copy()
-                        # Rasterize vector data
-                        ds_index = self._rasterize_vector_data(ds_index, 
-                                                                        gdf_index.drop(columns="index").reset_index(), 
-                                                                        'index', 'x', 'y')
-                # Filter by geometry
-                ds_index = ds_index.where(ds_index['mask'].isin(index))                
-                
-                # Get statistics
-                try:
-                    if self.group_type == 'recent':
-                        data = get_recent_lc_statistics(ds_index, self.raster_metadata) 
-                    elif self.group_type == 'future':
-                        data = get_future_lc_statistics(ds_index, self.raster_metadata, self.scenarios) 
-                        
-                    # Save values
-                    data["index"] = index
-                    df_list.append(data)
-                except Exception as e:
-                        pass
-                    
-            df = pd.DataFrame(df_list)
+            if method == 'label':
+                chunks = [(f"{self.group_type}_{geom_name}", partial(
+                    self._compute_by_label, gdf, index_column_name, x_coor_name, y_coor_name))]
+            else:
+                chunks = [(f"{self.group_type}_{geom_name}_{start}", partial(
+                    self._compute_by_polygon, gdf.iloc[start:start + chunk_size],
+                    index_column_name)) for start in range(0, len(gdf), chunk_size)]
+
+            accumulators = []
+            with stage('land_cover_level_1', geom_name=geom_name, method=method,
+                       group_type=self.group_type, geometries=len(gdf)):
+                for key, compute in chunks:
+                    accumulators.append(checkpoints.compute(key, compute) if checkpoints
+                                        else compute())
+            accumulator = accumulators[0] if len(accumulators) == 1 else \
+                LandCoverAccumulator.combine(accumulators)
+            self.accumulators[geom_name] = accumulator
+
+            # Geometries whose statistics failed have no matrices and are left empty
+            indexes = gdf[index_column_name][accumulator.contains(gdf[index_column_name])]
+            df = pd.DataFrame([dict(accumulator.statistics(index, pixel_area), index=index)
+                               for index in indexes])
             self.level_1_data[geom_name] = pd.merge(gdf.drop(columns='geometry'), df, how='left', on='index').drop(columns='index')    
                 
         return self.level_1_data 
+
+    def _compute_by_polygon(self, gdf: gpd.GeoDataFrame,
+                            index_column_name: str = 'index') -> LandCoverAccumulator:
+        indexes = gdf[index_column_name].tolist()
+        codes = LandCoverCodes(self.raster_metadata)
+
+        accumulators = [LandCoverAccumulator([], codes, self.group_type, self.scenarios)]
+        for index in tqdm(indexes):
+            start = time.perf_counter()
+            gdf_index  = gdf[gdf['index'] == index].copy()
+    
+            # Get bounds
+            gdf_180 = gdf_index.to_crs("+proj=latlong +datum=WGS84 +lon_0=180")
+            xmin_180, ymin, xmax_180, ymax = gdf_180['geometry'].iloc[0].bounds
+            geom = gdf_index['geometry'].iloc[0]
+            xmin, ymin, xmax, ymax = geom.bounds
+            
+            # Take care of the antimeridian
+            if not round(xmin_180) <= -179 and not round(xmax_180) >= 179:
+                if round(xmin) <= -175 and round(xmax) >= 175:
+                    # Split the geometry with the antimeridian.
+                    gdf_split = split_geometry_with_antimeridian(gdf_index)
+                    
+                    ds_list = []
+                    for side in ['left', 'right']:
+                        gdf_side = gdf_split[gdf_split['side'] == side].drop(columns="side")
+                        geom = gdf_side['geometry'].iloc[0]
+                        xmin, ymin, xmax, ymax = geom.bounds
+                        ds_side = self.raster_data.sel(x=slice(xmin, xmax), y=slice(ymax, ymin)) 
+                        if not ds_side.sizes['x'] or not ds_side.sizes['y']:
+                            continue
+                        # Rasterize vector data
+                        ds_list.append(self._rasterize_vector_data(ds_side, 
+                                                                    gdf_side.drop(columns="index").reset_index(),
+                                                                    'index', 'x', 'y'))
+
+                    # Combine the two datasets using combine_by_coords
+                    ds_index = xr.combine_by_coords(ds_list) if ds_list else None
+
+                else:
+                    ds_index = self.raster_data.sel(x=slice(xmin, xmax), y=slice(ymax, ymin)).copy()
+                    # Rasterize vector data
+                    ds_index = self._rasterize_window(ds_index, 
+                                                                    gdf_index.drop(columns="index").reset_index(), 
+                                                                    'index', 'x', 'y')
+            else:
+                    ds_index = self.raster_data.sel(x=slice(xmin, xmax), y=slice(ymax, ymin)).copy()
+                    # Rasterize vector data
+                    ds_index = self._rasterize_window(ds_index, 
+                                                                    gdf_index.drop(columns="index").reset_index(), 
+                                                                    'index', 'x', 'y')
+            # Get statistics, streaming the window tile by tile (and scenario by scenario)
+            # instead of building a DataFrame with every pixel of the geometry
+            # Geometries without pixels in the raster are left without statistics
+            if ds_index is not None:
+                accumulator = LandCoverAccumulator([index], codes, self.group_type, self.scenarios)
+                if self.group_type == 'recent':
+                    self._accumulate_recent(accumulator, ds_index, ds_index['mask'])
+                elif self.group_type == 'future':
+                    self._accumulate_future(accumulator, ds_index['land-cover'].isel(time=0),
+                                            ds_index['mask'])
+                accumulators.append(accumulator)
+            observe('land_cover_polygon', time.perf_counter() - start)
+
+        return LandCoverAccumulator.combine(accumulators)
+
+    def _compute_by_label(self, gdf: gpd.GeoDataFrame, index_column_name: str = 'index',
+                          x_coor_name: str = 'x', y_coor_name: str = 'y') -> LandCoverAccumulator:
+        indexes = gdf[index_column_name].tolist()
+
+        # Rasterize the whole layer once, geometries crossing the antimeridian are split by
+        # the rasterization itself as there is no bounding box to slice
+        if self.coverage:
+            mask = self.mask_cache.coverage(gdf, self.raster_data[x_coor_name],
+                                            self.raster_data[y_coor_name], index_column_name,
+                                            self.coverage, self.memory_budget)
+        else:
+            mask = self.mask_cache.rasterize(gdf, self.raster_data[x_coor_name],
+                                             self.raster_data[y_coor_name], index_column_name)
+            mask = mask.transpose(y_coor_name, x_coor_name)
+        accumulator = LandCoverAccumulator(indexes, LandCoverCodes(self.raster_metadata),
+                                           self.group_type, self.scenarios)
+        if self.group_type == 'future':
+            self._accumulate_future(accumulator, self.raster_data['land-cover'].isel(time=0),
+                                    mask, x_coor_name, y_coor_name)
+        else:
+            self._accumulate_recent(accumulator, self.raster_data, mask, x_coor_name, y_coor_name)
+
+        return accumulator
     
     
-    def compute_level_0_data(self, vector_data_0: Dict[str, gpd.GeoDataFrame]):
+    def compute_level_0_data(self, vector_data_0: Dict[str, gpd.GeoDataFrame],
+                             index_column_name: str = 'index',
+                             parent_column_name: str = 'id_0') -> Dict[str, pd.DataFrame]:
+        """Land cover statistics of the level 0 geometries.
+
+        The transition matrices of the level 1 geometries are summed by parent id and only
+        the parent matrices are converted to nested dictionaries.
+        """
+        # Areas are already in the weights of the coverage fractions
+        pixel_area = 1 if self.coverage else self.pixel_area
+        columns = ['land_cover_groups', 'land_cover_group_2018', 'land_cover'] \
+            if self.group_type == 'recent' else ['land_cover', 'land_cover_groups']
+
         level_0_data = {}
-        for geom_name, df in self.level_1_data.items():
+        for geom_name in self.level_1_data:
             geom_name_0 = geom_name.replace('_1', '_0')
             print(f"Computing land cover statistics for vector data -> {geom_name_0}")
             
             gdf = vector_data_0[geom_name_0]
             
+            df = self.vector_data[geom_name]
             df = df[df['id'].notna()]
-            df = df.astype({'id': int, 'id_0': int})
-            ids = list(df['id_0'].unique())
+
+            # Sum the child matrices by parent id
+            accumulator = self.accumulators[geom_name].aggregate(df[index_column_name],
+                                                                 df[parent_column_name])
+            self.accumulators[geom_name_0] = accumulator
             
-            df_final = pd.DataFrame()
             df_list = []
-            for id in tqdm(ids):
-                data_tmp = {'id_0': [id]}
-                df_tmp = df[df['id_0'] == id]
-                
-                if self.group_type == 'recent':
-                    # Land cover groups
-                    for column in ['land_cover_groups', 'land_cover_group_2018']:
-                        # sum dictionaries
-                        list_dicts = list(df_tmp[column])
-                        all_empty = all(not d for d in list_dicts)
-                        if all_empty:
-                            data_tmp[column] = [{}]
-                        else:
-                            if len(list_dicts) > 1:
-                                result_dict = sum_dicts(list_dicts) 
-                            else:
-                                result_dict = list_dicts[0]          
-                            # sort dictionary
-                            data_tmp[column] = [sort_dict(result_dict)]
-                        
-                    # Land cover 
-                    list_dicts = list(list(df_tmp['land_cover']))
-                    land_cover_dict = {}
-                    if data_tmp['land_cover_groups']:
-                        for key in list(data_tmp['land_cover_groups'][0].keys()):
-                            filtered_list = [d[key] for d in list_dicts if key in d]
-                            if len(filtered_list) > 1:
-                                result_dict = sum_dicts(filtered_list)
-                                land_cover_dict[key] = sort_dict(result_dict)
-                            else:
-                                land_cover_dict[key] = filtered_list[0]
-                                
-                        data_tmp['land_cover'] = [land_cover_dict]
-                    else:
-                        data_tmp['land_cover'] = [{}]
-                elif self.group_type == 'future':
-                    # Land cover 
-                    for column in ['land_cover', 'land_cover_groups']:
-                        # sum dictionaries
-                        list_dicts = list(df_tmp[column])
-                        all_empty = all(not d for d in list_dicts)
-                        if all_empty:
-                            data_tmp[column] = [{}]
-                        else:
-                            if len(list_dicts) > 1:
-                                result_dict = sum_dicts(list_dicts)   
-                            else:
-                                result_dict = list_dicts[0]        
-                            # sort dictionary
-                            data_tmp[column] = [sort_dict(result_dict)]
-                    
-                df_list.append(pd.DataFrame(data_tmp))
-                
-            df_final = pd.concat(df_list)
+            for id in tqdm(accumulator.labels):
+                data = accumulator.statistics(id, pixel_area)
+                df_list.append({parent_column_name: int(id),
+                                **{column: data[column] for column in columns}})
+            df_final = pd.DataFrame(df_list, columns=[parent_column_name] + columns)
             
-            df_final = pd.merge(gdf.drop(columns='geometry').astype({'id_0': int}),
-                                df_final.astype({'id_0': int}), on='id_0', how='left')
+            df_final = pd.merge(gdf.drop(columns='geometry').astype({parent_column_name: int}),
+                                df_final.astype({parent_column_name: int}), on=parent_column_name,
+                                how='left')
 
             level_0_data[geom_name_0] = df_final.drop(columns='index')
             
-            return level_0_data
-                    
-                
-                
-                
-            
\ No newline at end of file
+        return level_0_data
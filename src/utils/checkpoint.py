@@ -0,0 +1,58 @@
+import os
+import pickle
+import shutil
+from typing import Any, Callable
+
+from dotenv import load_dotenv
+
+# Load .env variables
+load_dotenv()
+
+
+class Checkpoints:
+    """Results of the work units of a run, flushed to disk as soon as each unit finishes.
+
+    With resume=True the results of a previous (failed) run are kept and the units that
+    already finished are loaded instead of computed again. Otherwise the checkpoints of
+    previous runs are discarded. Resuming assumes the inputs didn't change in between.
+    """
+    path = os.getenv('CHECKPOINT_PATH', '../data/processed/checkpoints/')
+
+    def __init__(self, name: str, path: str = None, resume: bool = False):
+        self.folder = os.path.join(path or self.path, name)
+        if not resume:
+            shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.pkl")
+
+    def done(self, key: str) -> bool:
+        return os.path.exists(self._file(key))
+
+    def load(self, key: str) -> Any:
+        with open(self._file(key), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, key: str, value: Any):
+        # Write to a temporary file first so that a killed process never leaves a partial shard
+        tmp_file = f"{self._file(key)}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self._file(key))
+
+    def remove(self, key: str):
+        if self.done(key):
+            os.remove(self._file(key))
+
+    def compute(self, key: str, function: Callable[[], Any]) -> Any:
+        """Result of a finished unit, or computed and saved if it hasn't finished yet"""
+        if self.done(key):
+            return self.load(key)
+        value = function()
+        self.save(key, value)
+        return value
+
+    def clear(self):
+        """Remove the checkpoints once the run has finished"""
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,63 @@
+import os
+import threading
+from typing import Dict
+
+import s3fs
+from dotenv import load_dotenv
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+# Load .env variables
+load_dotenv()
+
+# Size of the connection pools of the S3 and GCS clients
+S3_MAX_CONNECTIONS = int(os.getenv('S3_MAX_CONNECTIONS', 32))
+GCS_MAX_CONNECTIONS = int(os.getenv('GCS_MAX_CONNECTIONS', 32))
+
+# Clients already created by the current process, by credentials
+_lock = threading.Lock()
+_s3_filesystems: Dict[tuple, s3fs.S3FileSystem] = {}
+_gcs_clients: Dict[tuple, storage.Client] = {}
+
+
+def s3_filesystem(key: str = None, secret: str = None) -> s3fs.S3FileSystem:
+    """S3 file system shared by all the readers and writers of the process"""
+    key = key or os.getenv("S3_ACCESS_KEY_ID")
+    secret = secret or os.getenv("S3_SECRET_ACCESS_KEY")
+    # Connections can't be shared with forked processes
+    registry_key = (os.getpid(), key, secret)
+    with _lock:
+        if registry_key not in _s3_filesystems:
+            _s3_filesystems[registry_key] = s3fs.S3FileSystem(
+                key=key, secret=secret,
+                config_kwargs={'max_pool_connections': S3_MAX_CONNECTIONS})
+        return _s3_filesystems[registry_key]
+
+
+def s3_map(root: str, key: str = None, secret: str = None) -> s3fs.S3Map:
+    """Zarr store of an S3 path using the shared file system"""
+    return s3fs.S3Map(root=root, s3=s3_filesystem(key, secret), check=False)
+
+
+def gcs_client(key_file: str = None) -> storage.Client:
+    """Google Cloud Storage client shared by all the readers of the process"""
+    key_file = key_file or os.getenv('PRIVATEKEY_PATH')
+    registry_key = (os.getpid(), key_file)
+    with _lock:
+        if registry_key not in _gcs_clients:
+            client = storage.Client.from_service_account_json(key_file)
+            # The default pool keeps only 10 connections, less than the download threads
+            adapter = HTTPAdapter(pool_connections=GCS_MAX_CONNECTIONS,
+                                  pool_maxsize=GCS_MAX_CONNECTIONS)
+            client._http.mount('https://', adapter)
+            _gcs_clients[registry_key] = client
+        return _gcs_clients[registry_key]
+
+
+def configure_gdal():
+    """GDAL options for GeoTIFFs read from GCS with /vsigs/: reuse the HTTP connections and
+    don't list the bucket directory on every open"""
+    os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+    os.environ.setdefault('GDAL_HTTP_MULTIPLEX', 'YES')
+    os.environ.setdefault('GDAL_HTTP_VERSION', '2')
+    os.environ.setdefault('GDAL_HTTP_MAX_RETRY', '3')
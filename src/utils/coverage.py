@@ -0,0 +1,139 @@
+from typing import Iterator, Tuple
+
+import zarr
+import numpy as np
+import dask.array as da
+import regionmask
+import xarray as xr
+import geopandas as gpd
+
+# WGS84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.
+FLATTENING = 1 / 298.257223563
+
+# Bytes a strip of sub-pixels can take, counting the rasterized labels and the sorted, boolean
+# and integer copies of coverage_layers
+MEMORY_BUDGET = 2**29
+BYTES_PER_SUB_PIXEL = 64
+
+
+def _authalic_q(lat: np.ndarray) -> np.ndarray:
+    """q function of the area of the ellipsoid between the equator and a latitude"""
+    e = np.sqrt(FLATTENING * (2 - FLATTENING))
+    sin = np.sin(np.radians(lat))
+    return sin / (1 - (e * sin) ** 2) + np.log((1 + e * sin) / (1 - e * sin)) / (2 * e)
+
+
+def pixel_areas(lat: np.ndarray, x_resolution: float, y_resolution: float) -> np.ndarray:
+    """Area in hectares of the pixels of every row of a regular lon/lat grid, i.e. the
+    area of the WGS84 ellipsoid between the meridians and parallels of the pixel edges"""
+    semi_minor_axis = SEMI_MAJOR_AXIS * (1 - FLATTENING)
+    lat = np.asarray(lat, dtype='float64')
+    north = np.clip(lat + abs(y_resolution) / 2, -90, 90)
+    south = np.clip(lat - abs(y_resolution) / 2, -90, 90)
+    areas = semi_minor_axis ** 2 * np.radians(abs(x_resolution)) / 2 * \
+        (_authalic_q(north) - _authalic_q(south))
+    return areas / 1e4
+
+
+def strip_rows(n_x: int, supersample: int = 4, memory_budget: int = MEMORY_BUDGET) -> int:
+    """Number of rows of pixels of a strip of coverage_layers within the memory budget"""
+    return max(1, memory_budget // (n_x * supersample ** 2 * BYTES_PER_SUB_PIXEL))
+
+
+def coverage_layers(gdf: gpd.GeoDataFrame, x: xr.DataArray, y: xr.DataArray,
+                    index_column_name: str = 'index', supersample: int = 4, rows: int = 256
+                    ) -> Iterator[Tuple[slice, np.ndarray, np.ndarray]]:
+    """Fractions of the pixels covered by each geometry, from the geometries rasterized on
+    a grid of supersample x supersample sub-pixels.
+
+    Geometries must not overlap. A pixel can be covered by several geometries, so for
+    every strip of rows it yields (rows slice, labels, fractions) with (layer, y, x)
+    arrays of the labels covering each pixel and their fractions, NaN and 0 where there
+    are less geometries than layers.
+    """
+    dx = float(x[1] - x[0])
+    dy = float(y[1] - y[0])
+    offsets = (np.arange(supersample) + .5) / supersample - .5
+    sub_x = (x.values[:, None] + offsets[None, :] * dx).ravel()
+    n_sub = supersample ** 2
+
+    for start in range(0, len(y), rows):
+        y_strip = y.values[start:start + rows]
+        sub_y = (y_strip[:, None] + offsets[None, :] * dy).ravel()
+        sub = regionmask.mask_geopandas(gdf, sub_x, sub_y, numbers=index_column_name).values
+
+        # Labels of the sub-pixels of each pixel, sorted so that equal labels are contiguous
+        n_pixels = len(y_strip) * len(x)
+        sub = sub.reshape(len(y_strip), supersample, len(x), supersample)
+        sub = sub.transpose(0, 2, 1, 3).reshape(n_pixels, n_sub)
+        sub = np.sort(np.where(np.isnan(sub), np.inf, sub), axis=1)
+
+        # Each run of equal labels is a layer of the pixel
+        starts = np.ones(sub.shape, dtype=bool)
+        starts[:, 1:] = sub[:, 1:] != sub[:, :-1]
+        layers = np.cumsum(starts, axis=1) - 1
+        n_layers = layers[:, -1].max() + 1
+
+        pixels = np.broadcast_to(np.arange(n_pixels)[:, None], sub.shape)
+        counts = np.bincount((layers * n_pixels + pixels).ravel(), minlength=n_layers * n_pixels)
+        fractions = (counts / n_sub).reshape(n_layers, n_pixels).astype('float32')
+        labels = np.full((n_layers, n_pixels), np.nan, dtype='float32')
+        labels[layers[starts], pixels[starts]] = sub[starts]
+
+        # Sub-pixels outside all the geometries
+        outside = np.isinf(labels)
+        labels[outside] = np.nan
+        fractions[outside] = 0
+
+        shape = (n_layers, len(y_strip), len(x))
+        yield slice(start, start + len(y_strip)), labels.reshape(shape), fractions.reshape(shape)
+
+
+def write_coverage(gdf: gpd.GeoDataFrame, x: xr.DataArray, y: xr.DataArray, store: str,
+                   index_column_name: str = 'index', supersample: int = 4,
+                   memory_budget: int = MEMORY_BUDGET):
+    """Write the (layer, y, x) labels and coverage fractions of the pixels to a Zarr store,
+    see coverage_layers, one strip of rows at a time.
+
+    The store is created with one layer per sub-pixel, the most a pixel can have, and the
+    layers no strip used are dropped at the end. Labels are float32 with NaN where there
+    are no geometries.
+    """
+    rows = min(len(y), strip_rows(len(x), supersample, memory_budget))
+    # Chunks of about 2**20 pixels aligned with the strips
+    chunks = (1, rows, max(1, min(len(x), 2**20 // rows)))
+    dims = ('layer', y.name, x.name)
+    shape = (supersample ** 2, len(y), len(x))
+
+    template = xr.Dataset(
+        {'label': (dims, da.full(shape, np.nan, dtype='float32', chunks=chunks)),
+         'fraction': (dims, da.zeros(shape, dtype='float32', chunks=chunks))},
+        coords={y.name: y.values, x.name: x.values})
+    template.to_zarr(store, mode='w', compute=False, consolidated=False)
+
+    strip_layers = []
+    for rows_slice, labels, fractions in coverage_layers(gdf, x, y, index_column_name,
+                                                         supersample, rows):
+        strip = xr.Dataset({'label': (dims, labels), 'fraction': (dims, fractions)},
+                           coords={y.name: y.values[rows_slice], x.name: x.values})
+        strip.to_zarr(store, region={'layer': slice(0, len(labels)), y.name: rows_slice,
+                                     x.name: slice(0, len(x))})
+        strip_layers.append((rows_slice, len(labels)))
+
+    # Fractions are 0 in the layers of the strips with less layers than the others, their
+    # labels are already NaN (the fill value)
+    n_layers = max(n for _, n in strip_layers)
+    for rows_slice, n in strip_layers:
+        if n < n_layers:
+            zeros = np.zeros((n_layers - n, rows_slice.stop - rows_slice.start, len(x)),
+                             dtype='float32')
+            xr.Dataset({'fraction': (dims, zeros)}).to_zarr(
+                store, region={'layer': slice(n, n_layers), y.name: rows_slice,
+                               x.name: slice(0, len(x))})
+
+    # Drop the layers that no pixel has
+    group = zarr.open_group(store, mode='r+')
+    for name in ['label', 'fraction']:
+        group[name].resize(n_layers, len(y), len(x))
+    zarr.consolidate_metadata(store)
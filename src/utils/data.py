@@ -6,10 +6,12 @@ from dataclasses import dataclass
 import numpy as np
 import xarray as xd
 import pandas as pd
+import shapely
 import geopandas as gpd
 from tqdm import tqdm
 
 from utils.util import read_zarr_from_s3, read_zarr_from_local_dir
+from utils.cache import ChunkCache
 
 warnings.filterwarnings('ignore', 'GeoSeries.notna', UserWarning)
 
@@ -20,6 +22,10 @@ class LandCoverRasterData:
     data_from: str = 'local_dir' 
     path: str = None
     scenarios: List = None
+    # utils.cache.ChunkCache of the chunks read from S3, if any
+    chunk_cache: ChunkCache = None
+    # Don't add the future scenarios to the dataset, see LandCoverStatistics.scenario_reader
+    lazy_scenarios: bool = False
 
     def read_data(self) -> xd.Dataset:
         if self.group_type == 'recent':
@@ -30,7 +36,8 @@ class LandCoverRasterData:
             if self.data_from == 's3':
                 ds = read_zarr_from_s3(access_key_id = os.getenv("S3_ACCESS_KEY_ID"), 
                                     secret_accsess_key = os.getenv("S3_SECRET_ACCESS_KEY"),
-                                    dataset = dataset, group = group) 
+                                    dataset = dataset, group = group,
+                                    chunk_cache = self.chunk_cache)
             elif self.data_from == 'local_dir':
                 ds = read_zarr_from_local_dir(path=os.path.join(self.path, file), group = group)
                 
@@ -42,7 +49,7 @@ class LandCoverRasterData:
             if self.data_from == 's3':
                 ds_lc = read_zarr_from_s3(access_key_id = os.getenv("S3_ACCESS_KEY_ID"), 
                                         secret_accsess_key = os.getenv("S3_SECRET_ACCESS_KEY"),
-                                        dataset = dataset) 
+                                        dataset = dataset, chunk_cache = self.chunk_cache) 
             elif self.data_from == 'local_dir':
                 ds_lc = read_zarr_from_local_dir(path=os.path.join(self.path, file))
                 
@@ -54,28 +61,35 @@ class LandCoverRasterData:
             if self.data_from == 's3':
                 ds = read_zarr_from_s3(access_key_id = os.getenv("S3_ACCESS_KEY_ID"), 
                                         secret_accsess_key = os.getenv("S3_SECRET_ACCESS_KEY"),
-                                        dataset = dataset) 
+                                        dataset = dataset, chunk_cache = self.chunk_cache) 
             elif self.data_from == 'local_dir':
                 ds = read_zarr_from_local_dir(path=os.path.join(self.path, file))
                 
             ds = ds.sel(time=['2018-12-31T00:00:00.000000000'])
 
-            # Read future dataset
-            group = 'future'
-            for n, scenario in enumerate(self.scenarios):
-                if self.data_from == 's3':
-                    ds_future = read_zarr_from_s3(access_key_id = os.getenv("S3_ACCESS_KEY_ID"), 
-                                        secret_accsess_key = os.getenv("S3_SECRET_ACCESS_KEY"),
-                                        dataset = scenario, group = group) 
-                elif self.data_from == 'local_dir':
-                    ds_future = read_zarr_from_local_dir(path=os.path.join(self.path, scenario+'.zarr'), group = group)
-                    
-                ds_future = ds_future.drop_dims('depth').sel(time=['2018-12-31T00:00:00.000000000', '2038-12-31T00:00:00.000000000'])
-  
-                ds[scenario] = ds_future['stocks'].isel(time=1) - \
-                    ds_future['stocks'].isel(time=0)
+            # Read future dataset, lazy scenarios are only opened by read_scenario
+            if not self.lazy_scenarios:
+                for scenario in self.scenarios:
+                    ds[scenario] = self.read_scenario(scenario)
                     
         return ds
+
+    def read_scenario(self, scenario: str) -> xd.DataArray:
+        """Stocks change between 2018 and 2038 of a future scenario"""
+        group = 'future'
+        if self.data_from == 's3':
+            ds_future = read_zarr_from_s3(access_key_id = os.getenv("S3_ACCESS_KEY_ID"), 
+                                secret_accsess_key = os.getenv("S3_SECRET_ACCESS_KEY"),
+                                dataset = scenario, group = group, chunk_cache = self.chunk_cache) 
+        elif self.data_from == 'local_dir':
+            ds_future = read_zarr_from_local_dir(path=os.path.join(self.path, scenario+'.zarr'),
+                                                 group = group)
+            
+        ds_future = ds_future.drop_dims('depth').sel(time=['2018-12-31T00:00:00.000000000',
+                                                           '2038-12-31T00:00:00.000000000'])
+
+        stocks = ds_future['stocks']
+        return (stocks.isel(time=1) - stocks.isel(time=0)).rename(scenario)
     
     
 @dataclass
@@ -108,6 +122,9 @@ class RasterData:
     dataset: str
     group: str
 
+    # Prepared region geometries by path, read once per process (not a dataclass field)
+    _regions = {}
+
     def variable(self):
         return {'historic': 'stocks', 'recent': 'stocks',
                 'crop_I': 'stocks', 'crop_MG': 'stocks', 'crop_MGI': 'stocks', 'grass_part': 'stocks',
@@ -246,6 +263,37 @@ class RasterData:
                 'experimental': {'stocks': -32768., 'concentration': 0}
                 }[self.dataset][self.group]
 
+    def scale_factor(self):
+        """Scale factor of the int16 encoding of the values in Zarr, None to keep them as they
+        are. Values must be multiples of it within the int16 range, see raster.check_quantization"""
+        return {'global': {'historic': 1., 'recent': 0.1},
+                'scenarios': {'crop_I': 0.1,
+                              'crop_MG': 0.1,
+                              'crop_MGI': 0.1,
+                              'grass_part': 0.1,
+                              'grass_full': 0.1,
+                              'rewilding': 0.1,
+                              'degradation_ForestToGrass': 0.1,
+                              'degradation_ForestToCrop': 0.1,
+                              'degradation_NoDeforestation': 0.1},
+                'experimental': {'stocks': 1., 'concentration': None}
+                }[self.dataset][self.group]
+
+    def unit_divisor(self):
+        """Divisor that converts the stored values to the units of the statistics"""
+        return {'global': {'historic': 1., 'recent': 1.},
+                'scenarios': {'crop_I': 1.,
+                              'crop_MG': 1.,
+                              'crop_MGI': 1.,
+                              'grass_part': 1.,
+                              'grass_full': 1.,
+                              'rewilding': 1.,
+                              'degradation_ForestToGrass': 1.,
+                              'degradation_ForestToCrop': 1.,
+                              'degradation_NoDeforestation': 1.},
+                'experimental': {'stocks': 10., 'concentration': 1.}
+                }[self.dataset][self.group]
+
     def delta_years(self, year_name: str):
         return {'global': {},
                 'scenarios': {'2018': '00', '2023': '05', '2028': '10', '2033': '15', '2038': '20'},
@@ -261,6 +309,34 @@ class RasterData:
                 'scenarios': None,
                 'experimental': '../data/processed/vector_data/argentina.geojson'}[self.dataset]
 
+    def region(self):
+        """Geometry of the region of ISO-restricted datasets, prepared for repeated predicates"""
+        path = self.geometry_path()
+        if path is None:
+            return None
+        if path not in RasterData._regions:
+            geometry = gpd.read_file(path).geometry.iloc[0]
+            shapely.prepare(geometry)
+            RasterData._regions[path] = geometry
+        return RasterData._regions[path]
+
+    def filter_vector_data(self, geom_name: str, gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """Keep only the geometries within the region of ISO-restricted datasets.
+
+        Political boundaries are filtered by gid_0. Other layers are filtered by intersection
+        with the region: candidates are selected by bounding box with an STRtree of the layer
+        and only those are tested against the prepared region geometry.
+        """
+        if not self.iso():
+            return gdf
+        if 'political' in geom_name:
+            return gdf[gdf['gid_0'] == self.iso()]
+
+        region = self.region()
+        geometries = np.asarray(gdf.geometry.array)
+        candidates = np.sort(shapely.STRtree(geometries).query(region))
+        return gdf.iloc[candidates[shapely.intersects(region, geometries[candidates])]]
+
     def n_binds(self):
         return {'global': {'historic': [40, 40, 60], 'recent': [10]},
                 'scenarios': {'crop_I': [30],
@@ -289,6 +365,18 @@ class RasterData:
                 'experimental': {'stocks': [[-50, 50]], 'concentration': [[-10, 10]]}
                 }[self.dataset][self.group]
 
+    def bins(self):
+        """Histogram bin edges of the change values for each depth"""
+        depths = list(self.depths().keys())
+        n_binds = self.n_binds()
+        bind_ranges = self.bind_ranges()
+        if len(depths) != len(n_binds):
+            n_binds = n_binds[:1] * len(depths)
+            bind_ranges = bind_ranges[:1] * len(depths)
+
+        return [np.linspace(bind_range[0], bind_range[1], n_bind + 1)
+                for n_bind, bind_range in zip(n_binds, bind_ranges)]
+
     def get_file_name(self, year_name, depth_name):
         if self.dataset == 'scenarios':
             file_name = self.file_prefix() + self.group + self.file_infix() + self.delta_years(year_name) + self.file_suffix()
@@ -0,0 +1,288 @@
+import os
+import json
+import atexit
+import time
+import uuid
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+import zarr
+import numpy as np
+from dotenv import load_dotenv
+
+# Load .env variables
+load_dotenv()
+
+# Upper edges in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = [.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5, 10, 30, 60, np.inf]
+# Seconds between the 'io' events of the chunks read outside of the stages of a process
+IO_INTERVAL = 1
+
+# JSON lines file the events are appended to, instrumentation is disabled if it isn't set.
+# Both settings are environment variables so that worker processes inherit them.
+_path = os.getenv('INSTRUMENTATION_PATH')
+_run = os.getenv('INSTRUMENTATION_RUN')
+
+# Totals of the current process, stages report their increase while they run
+_lock = threading.Lock()
+_io = {'bytes': 0, 'chunks': 0}
+_timers: Dict[str, float] = {}
+_latencies: Dict[str, np.ndarray] = {}
+# Chunks read outside of the stages of this process (e.g. by a dask worker) not emitted yet
+_pending = {'bytes': 0, 'chunks': 0, 'since': 0., 'time': 0.}
+# Number of stages running in the current process
+_depth = 0
+
+
+def configure(path: str = None) -> bool:
+    """Append the events of this run and of its worker processes to a JSON lines file,
+    INSTRUMENTATION_PATH by default. Returns whether instrumentation is enabled."""
+    global _path, _run
+    _path = path or os.getenv('INSTRUMENTATION_PATH')
+    if _path:
+        _run = uuid.uuid4().hex[:12]
+        os.environ['INSTRUMENTATION_PATH'] = _path
+        os.environ['INSTRUMENTATION_RUN'] = _run
+        os.makedirs(os.path.dirname(_path) or '.', exist_ok=True)
+    return enabled()
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def emit(event: str, **fields):
+    """Append an event to the JSON lines file"""
+    if not enabled():
+        return
+    line = json.dumps({'event': event, 'run': _run, 'pid': os.getpid(), 'time': time.time(),
+                       **fields}, default=str)
+    with _lock, open(_path, 'a') as f:
+        f.write(line + '\n')
+
+
+def _snapshot() -> tuple:
+    with _lock:
+        return dict(_io), dict(_timers), \
+            {name: counts.copy() for name, counts in _latencies.items()}
+
+
+@contextmanager
+def stage(name: str, **fields) -> Iterator[Dict]:
+    """Time a stage of the pipeline and emit it with the bytes and chunks read, the time
+    of the timers and the latencies observed while it ran. Fields can be added to the
+    yielded dictionary."""
+    global _depth
+    if not enabled():
+        yield {}
+        return
+
+    io, timers, latencies = _snapshot()
+    start = time.perf_counter()
+    extra = {}
+    _depth += 1
+    try:
+        yield extra
+    finally:
+        _depth -= 1
+        seconds = time.perf_counter() - start
+        io_end, timers_end, latencies_end = _snapshot()
+        emit('stage', stage=name, seconds=seconds, depth=_depth, **fields, **extra,
+             bytes_read=io_end['bytes'] - io['bytes'],
+             chunks_read=io_end['chunks'] - io['chunks'],
+             timers={key: value - timers.get(key, 0) for key, value in timers_end.items()
+                     if value > timers.get(key, 0)},
+             latencies={key: (value - latencies.get(key, 0)).tolist()
+                        for key, value in latencies_end.items()
+                        if (value - latencies.get(key, 0)).any()})
+
+
+def iter_stages(name: str, vector_data: Dict, **fields) -> Iterator:
+    """Iterate over the (geom_name, gdf) items of vector data, each iteration of the loop timed
+    as a stage"""
+    for geom_name, gdf in vector_data.items():
+        with stage(name, geom_name=geom_name, geometries=len(gdf), **fields):
+            yield geom_name, gdf
+
+
+@contextmanager
+def timer(name: str):
+    """Add the time of a block to a total reported by the enclosing stages, for blocks run
+    too many times to emit an event each (e.g. every chunk read)"""
+    if not enabled():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _timers[name] = _timers.get(name, 0) + seconds
+
+
+def observe(name: str, seconds: float):
+    """Add a latency (e.g. of a polygon) to a histogram of LATENCY_BUCKETS"""
+    if not enabled():
+        return
+    with _lock:
+        if name not in _latencies:
+            _latencies[name] = np.zeros(len(LATENCY_BUCKETS), dtype='int64')
+        _latencies[name][np.searchsorted(LATENCY_BUCKETS, seconds)] += 1
+
+
+def _read(nbytes: int):
+    """Count a chunk read. The reads outside of the stages of this process are emitted as 'io'
+    events, which report() adds to the stages running in the main process at the time."""
+    now = time.time()
+    pending = None
+    with _lock:
+        _io['bytes'] += nbytes
+        _io['chunks'] += 1
+        if _depth:
+            return
+        if _pending['chunks'] and now - _pending['since'] > IO_INTERVAL:
+            pending = dict(_pending)
+            _pending.update(bytes=0, chunks=0)
+        if not _pending['chunks']:
+            _pending['since'] = now
+        _pending['bytes'] += nbytes
+        _pending['chunks'] += 1
+        _pending['time'] = now
+    if pending:
+        emit('io', time=pending['time'], bytes_read=pending['bytes'],
+             chunks_read=pending['chunks'])
+
+
+def flush():
+    """Emit the chunks read outside of the stages of this process not emitted yet, e.g. with
+    client.run(flush) on the workers of a dask cluster before the report"""
+    with _lock:
+        pending = dict(_pending)
+        _pending.update(bytes=0, chunks=0)
+    if pending['chunks']:
+        emit('io', time=pending['time'], bytes_read=pending['bytes'],
+             chunks_read=pending['chunks'])
+
+
+atexit.register(flush)
+
+
+class InstrumentedStore(MutableMapping):
+    """Zarr store that counts the bytes and the chunks read from the wrapped store"""
+    def __init__(self, store):
+        self.store = store
+        self.bytes_read = 0
+        self.chunks_read = 0
+
+    @property
+    def root(self):
+        """Root of the wrapped store, which utils.cache.ChunkCache keys its caches by"""
+        return self.store.root
+
+    def __getitem__(self, key):
+        value = self.store[key]
+        # Metadata keys (.zarray, .zattrs, ...) aren't chunks
+        if not key.rsplit('/', 1)[-1].startswith('.'):
+            with _lock:
+                self.bytes_read += len(value)
+                self.chunks_read += 1
+            _read(len(value))
+        return value
+
+    def __setitem__(self, key, value):
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+
+def instrument_store(store):
+    """The store (or local path) wrapped in an InstrumentedStore if instrumentation is enabled"""
+    if not enabled():
+        return store
+    if isinstance(store, (str, os.PathLike)):
+        store = zarr.storage.DirectoryStore(os.fspath(store))
+    return InstrumentedStore(store)
+
+
+def _percentile(counts: np.ndarray, q: float) -> float:
+    """Upper edge of the bucket of a percentile of a latency histogram"""
+    position = int(np.searchsorted(np.cumsum(counts), q * counts.sum()))
+    return LATENCY_BUCKETS[min(position, len(LATENCY_BUCKETS) - 1)]
+
+
+def _new_summary() -> Dict:
+    return {'count': 0, 'seconds': 0, 'bytes_read': 0, 'chunks_read': 0, 'timers': {}}
+
+
+def report(path: str = None) -> Dict:
+    """Summary of the stages of the run (of all its processes), printed and emitted as a
+    'summary' event"""
+    path = path or _path
+    if not path or not os.path.exists(path):
+        return {}
+
+    stages = {}
+    latencies = {}
+    # Stages of this process, and the chunks read outside of stages (e.g. by dask workers)
+    intervals = []
+    io = []
+    with open(path) as f:
+        for line in f:
+            event = json.loads(line)
+            if event['run'] != _run or event['event'] not in ['stage', 'io']:
+                continue
+            if event['event'] == 'io':
+                io.append(event)
+                continue
+            summary = stages.setdefault(event['stage'], _new_summary())
+            summary['count'] += 1
+            for key in ['seconds', 'bytes_read', 'chunks_read']:
+                summary[key] += event[key]
+            for key, value in event['timers'].items():
+                summary['timers'][key] = summary['timers'].get(key, 0) + value
+            # Nested stages report the latencies of their parents again
+            if event['depth'] == 0:
+                for key, value in event['latencies'].items():
+                    latencies[key] = latencies.get(key, 0) + np.array(value)
+            if event['pid'] == os.getpid():
+                intervals.append((event['time'] - event['seconds'], event['time'], summary))
+
+    # Chunks read by other processes are added to the stages running here at the time
+    for event in io:
+        summaries = [summary for start, end, summary in intervals
+                     if start <= event['time'] <= end]
+        for summary in summaries or [stages.setdefault('(outside stages)', _new_summary())]:
+            summary['bytes_read'] += event['bytes_read']
+            summary['chunks_read'] += event['chunks_read']
+
+    histograms = {key: {'count': int(counts.sum()), 'p50': _percentile(counts, .5),
+                        'p95': _percentile(counts, .95), 'p99': _percentile(counts, .99),
+                        'buckets': counts.tolist()}
+                  for key, counts in latencies.items()}
+
+    print(f"{'stage':<28}{'count':>8}{'seconds':>10}{'MB read':>10}{'chunks':>9}  timers")
+    for name, summary in sorted(stages.items(), key=lambda x: -x[1]['seconds']):
+        timers = ', '.join(f"{key} {value:.1f} s" for key, value in summary['timers'].items())
+        print(f"{name:<28}{summary['count']:>8}{summary['seconds']:>10.1f}"
+              f"{summary['bytes_read'] / 2**20:>10.1f}{summary['chunks_read']:>9}  {timers}")
+    for name, histogram in histograms.items():
+        print(f"{name} latency: {histogram['count']} geometries, p50 <= {histogram['p50']} s, "
+              f"p95 <= {histogram['p95']} s, p99 <= {histogram['p99']} s")
+
+    summary = {'stages': stages, 'latencies': histograms, 'buckets': LATENCY_BUCKETS}
+    emit('summary', **summary)
+    return summary
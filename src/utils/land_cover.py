@@ -0,0 +1,244 @@
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from utils.zonal import label_positions
+
+
+class LandCoverCodes:
+    """Land cover codes of LandCoverData as positions of fixed-shape arrays"""
+    def __init__(self, raster_metadata):
+        child_parent = raster_metadata.child_parent()
+        self.children = list(child_parent.keys())
+        self.parents = list(raster_metadata.parent_labels().keys())
+
+        # Lookup table from land cover code to child position
+        self.lookup = np.full(max(int(code) for code in self.children) + 1, -1, dtype='int64')
+        self.lookup[[int(code) for code in self.children]] = np.arange(len(self.children))
+
+        # One-hot matrix from child positions to parent positions
+        self.child_to_parent = np.array([self.parents.index(child_parent[code])
+                                         for code in self.children])
+        self.parent_matrix = np.zeros((len(self.children), len(self.parents)))
+        self.parent_matrix[np.arange(len(self.children)), self.child_to_parent] = 1
+
+    def positions(self, codes: np.ndarray) -> np.ndarray:
+        """Child positions of an array of land cover codes, -1 for unknown codes or nodata"""
+        codes = np.asarray(codes, dtype='float64')
+        positions = np.full(codes.shape, -1, dtype='int64')
+        known = ~np.isnan(codes) & (codes >= 0) & (codes < len(self.lookup))
+        positions[known] = self.lookup[codes[known].astype('int64')]
+        return positions
+
+
+def land_cover_transitions(lc_from: np.ndarray, lc_to: np.ndarray, values: np.ndarray,
+                           codes: LandCoverCodes, labels: np.ndarray = None, n_labels: int = 1,
+                           weights: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum of values, multiplied by the weights of the pixels if any, and number of pixels
+    of every (label, from code, to code) transition.
+
+    Only pixels whose land cover changed and whose value is valid and non-zero are
+    counted. Returns two arrays of shape (n_labels, n_codes, n_codes).
+    """
+    n_codes = len(codes.children)
+    i = codes.positions(lc_from).ravel()
+    j = codes.positions(lc_to).ravel()
+    values = np.asarray(values, dtype='float64').ravel()
+    labels = np.zeros(len(values), dtype='int64') if labels is None else np.asarray(labels).ravel()
+
+    keep = (i >= 0) & (j >= 0) & (i != j) & ~np.isnan(values) & (values != 0)
+    flat = (labels[keep] * n_codes + i[keep]) * n_codes + j[keep]
+    size = n_labels * n_codes * n_codes
+
+    if weights is not None:
+        values = values * np.asarray(weights, dtype='float64').ravel()
+    sums = np.bincount(flat, weights=values[keep], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    shape = (n_labels, n_codes, n_codes)
+
+    return sums.reshape(shape), counts.reshape(shape)
+
+
+def _nested_dict(sums: np.ndarray, counts: np.ndarray, from_keys: List[str],
+                 to_keys: List[str]) -> Dict[str, Dict[str, float]]:
+    """{to code: {from code: value}} of the transitions with pixels, with both levels
+    sorted by value in ascending order"""
+    data = {}
+    for j in np.flatnonzero(counts.sum(axis=0)):
+        records = [(from_keys[i], float(sums[i, j])) for i in np.flatnonzero(counts[:, j])]
+        data[to_keys[j]] = dict(sorted(records, key=lambda x: x[1]))
+
+    return dict(sorted(data.items(), key=lambda x: sum(x[1].values())))
+
+
+def recent_lc_statistics(sums: np.ndarray, counts: np.ndarray, codes: LandCoverCodes) -> Dict:
+    """Nested dictionaries of recent land cover statistics from a (from code, to code)
+    transition matrix"""
+    parent_matrix = codes.parent_matrix
+    data = {
+        'land_cover_groups': _nested_dict(parent_matrix.T @ sums @ parent_matrix,
+                                          parent_matrix.T @ counts @ parent_matrix,
+                                          codes.parents, codes.parents),
+        'land_cover': _nested_dict(sums, counts, codes.children, codes.children),
+        'land_cover_group_2018': _nested_dict(sums @ parent_matrix, counts @ parent_matrix,
+                                              codes.children, codes.parents)
+    }
+
+    # Reorganize land cover data by the parent of the 2018 land cover
+    land_cover_dict = {}
+    for parent_id in data['land_cover_groups']:
+        land_cover_dict[parent_id] = {
+            child_id: values for child_id, values in data['land_cover'].items()
+            if codes.parents[codes.child_to_parent[codes.children.index(child_id)]] == parent_id}
+
+    data['land_cover'] = land_cover_dict
+
+    return data
+
+
+def future_lc_statistics(sums: np.ndarray, counts: np.ndarray, codes: LandCoverCodes,
+                         scenarios: List[str]) -> Dict:
+    """Nested dictionaries of future land cover statistics from (scenario, code) sums"""
+    parents = [codes.parents[parent] for parent in codes.child_to_parent]
+    data = {}
+    for name, matrix, keys, group_keys in [
+            ('land_cover', None, codes.children, parents),
+            ('land_cover_groups', codes.parent_matrix, codes.parents, codes.parents)]:
+        scenario_sums = sums if matrix is None else sums @ matrix
+        scenario_counts = counts if matrix is None else counts @ matrix
+
+        data_tmp = {}
+        for n, scenario in enumerate(scenarios):
+            # Same order as a groupby by land cover group and code before sorting by value
+            present = sorted(np.flatnonzero(scenario_counts[n]),
+                             key=lambda i: (group_keys[i], keys[i]))
+            data_tmp[scenario] = {keys[i]: float(scenario_sums[n, i]) for i in present}
+
+        # Sort secondary keys by value and scenarios by their total
+        for scenario in data_tmp:
+            data_tmp[scenario] = dict(sorted(data_tmp[scenario].items(), key=lambda x: x[1]))
+        data[name] = dict(sorted(data_tmp.items(), key=lambda x: sum(x[1].values())))
+
+    return data
+
+
+class LandCoverAccumulator:
+    """Per-label land cover statistics accumulated block by block.
+
+    For the recent group it holds a (label, lc 2000, lc 2018) matrix of stocks change
+    and for the future group a (label, scenario, lc 2018) matrix of stocks change.
+    """
+    def __init__(self, labels: Sequence, codes: LandCoverCodes, group_type: str = 'recent',
+                 scenarios: List[str] = None):
+        assert group_type in ['recent', 'future'], "group_type must be 'recent' or 'future'"
+
+        self.labels = np.unique(np.asarray(labels, dtype='float64'))
+        self.codes = codes
+        self.group_type = group_type
+        self.scenarios = scenarios or []
+
+        n_codes = len(codes.children)
+        if group_type == 'recent':
+            shape = (len(self.labels), n_codes, n_codes)
+        else:
+            shape = (len(self.labels), len(self.scenarios), n_codes)
+        self.sums = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype='int64')
+
+    @classmethod
+    def combine(cls, accumulators: List['LandCoverAccumulator']) -> 'LandCoverAccumulator':
+        """Merge accumulators of the same raster, e.g. computed for chunks of geometries"""
+        first = accumulators[0]
+        labels = np.concatenate([accumulator.labels for accumulator in accumulators])
+        result = cls(labels, first.codes, first.group_type, first.scenarios)
+        for accumulator in accumulators:
+            result._add(accumulator, np.searchsorted(result.labels, accumulator.labels))
+        return result
+
+    def _add(self, other: 'LandCoverAccumulator', positions: np.ndarray):
+        """Add the matrices of other at the given label positions"""
+        np.add.at(self.sums, positions, other.sums)
+        np.add.at(self.counts, positions, other.counts)
+
+    def aggregate(self, labels: Sequence, parents: Sequence) -> 'LandCoverAccumulator':
+        """Sum the matrices of the labels into the ones of their parents, e.g. the level 1
+        geometries into their level 0 geometries"""
+        labels = np.asarray(labels, dtype='float64')
+        parents = np.asarray(parents, dtype='float64')
+        _, first = np.unique(labels, return_index=True)
+        labels, parents = labels[first], parents[first]
+
+        known = np.isin(labels, self.labels) & ~np.isnan(parents)
+        labels, parents = labels[known], parents[known]
+
+        result = LandCoverAccumulator(parents, self.codes, self.group_type, self.scenarios)
+        children = np.searchsorted(self.labels, labels)
+        positions = np.searchsorted(result.labels, parents)
+        np.add.at(result.sums, positions, self.sums[children])
+        np.add.at(result.counts, positions, self.counts[children])
+        return result
+
+    def contains(self, labels: Sequence) -> np.ndarray:
+        """Whether each of the labels has matrices in the accumulator"""
+        return np.isin(np.asarray(labels, dtype='float64'), self.labels)
+
+    def has_labels(self, labels_block: np.ndarray) -> bool:
+        return len(label_positions(self.labels, labels_block)[0]) > 0
+
+    def update_recent(self, land_cover: np.ndarray, stocks: np.ndarray, labels_block: np.ndarray,
+                      weights: np.ndarray = None):
+        """Add (time, y, x) blocks of land cover and stocks for 2000 and 2018, with the stocks
+        change of each pixel multiplied by its (y, x) weight if any"""
+        pixels, positions = label_positions(self.labels, labels_block)
+        if not len(pixels):
+            return
+
+        land_cover = land_cover.reshape(2, -1)[:, pixels]
+        stocks = np.asarray(stocks, dtype='float64').reshape(2, -1)[:, pixels]
+        if weights is not None:
+            weights = np.asarray(weights, dtype='float64').ravel()[pixels]
+
+        # Only allocate matrices for the labels present in the block
+        block_labels, local_positions = np.unique(positions, return_inverse=True)
+        sums, counts = land_cover_transitions(land_cover[0], land_cover[1], stocks[1] - stocks[0],
+                                              self.codes, local_positions, len(block_labels),
+                                              weights)
+        self.sums[block_labels] += sums
+        self.counts[block_labels] += counts
+
+    def update_future(self, land_cover: np.ndarray, scenario_values: Dict[str, np.ndarray],
+                      labels_block: np.ndarray, weights: np.ndarray = None):
+        """Add a (y, x) block of 2018 land cover and the stocks change of some scenarios, with
+        the stocks change of each pixel multiplied by its (y, x) weight if any"""
+        pixels, positions = label_positions(self.labels, labels_block)
+        if not len(pixels):
+            return
+
+        n_codes = len(self.codes.children)
+        codes = self.codes.positions(land_cover.ravel()[pixels])
+        known = codes >= 0
+        flat = positions[known] * n_codes + codes[known]
+        size = len(self.labels) * n_codes
+        counts = np.bincount(flat, minlength=size).reshape(len(self.labels), n_codes)
+        if weights is not None:
+            weights = np.asarray(weights, dtype='float64').ravel()[pixels][known]
+
+        for scenario, values in scenario_values.items():
+            n = self.scenarios.index(scenario)
+            values = np.asarray(values, dtype='float64').ravel()[pixels][known]
+            if weights is not None:
+                values = values * weights
+            valid = ~np.isnan(values)
+            self.sums[:, n] += np.bincount(flat[valid], weights=values[valid],
+                                           minlength=size).reshape(len(self.labels), n_codes)
+            self.counts[:, n] += counts
+
+    def statistics(self, index, pixel_area: float = 1) -> Dict:
+        """Land cover statistics of a label as nested dictionaries, with the sums scaled by
+        the area of a pixel"""
+        position = np.searchsorted(self.labels, float(index))
+        sums = self.sums[position] * pixel_area
+        if self.group_type == 'recent':
+            return recent_lc_statistics(sums, self.counts[position], self.codes)
+        else:
+            return future_lc_statistics(sums, self.counts[position], self.codes, self.scenarios)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import zarr
+
+from utils.data import RasterData
+from utils.precalculations import read_precalculations, write_precalculations
+
+MANIFEST_PATH = '../data/processed/precalculations/manifest.json'
+# Level 1 rows of each vector layer, merged with the recomputed ones on incremental runs
+LEVEL_1_PATH = '../data/processed/precalculations/level_1/'
+
+
+def fingerprint(*parts) -> str:
+    """sha256 of bytes and JSON serializable parts"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True,
+                                                                      default=str).encode())
+    return digest.hexdigest()
+
+
+def raster_fingerprint(raster_metadata: RasterData, store=None) -> str:
+    """Hash of the consolidated metadata of the Zarr group and of the metadata the
+    statistics depend on (depths, years, histogram bins, scale)"""
+    if store is None:
+        store = zarr.storage.DirectoryStore(raster_metadata.local_path())
+    metadata = json.loads(store['.zmetadata'])['metadata']
+    group_metadata = {key: value for key, value in metadata.items()
+                      if key.startswith(f"{raster_metadata.group}/")}
+    return fingerprint(group_metadata, raster_metadata.variable(), raster_metadata.depths(),
+                       raster_metadata.years(), raster_metadata.n_binds(),
+                       raster_metadata.bind_ranges(), raster_metadata.scale_factor(),
+                       raster_metadata.unit_divisor())
+
+
+def geometry_fingerprints(gdf: gpd.GeoDataFrame,
+                          index_column_name: str = 'index') -> Dict[str, str]:
+    """Hash of the geometry and attributes of every row, by index"""
+    attributes = gdf.drop(columns='geometry').to_dict('records')
+    return {str(row[index_column_name]):
+            fingerprint(geometry.wkb if geometry is not None else b'', row)
+            for row, geometry in zip(attributes, gdf.geometry)}
+
+
+def layer_fingerprint(gdf: gpd.GeoDataFrame, index_column_name: str = 'index') -> str:
+    """Hash of a whole vector layer, e.g. the GeoJSON the level 0 geometries are read from"""
+    return fingerprint(geometry_fingerprints(gdf, index_column_name))
+
+
+def level_1_path(geom_name: str, data_type: str, dataset: str, group: str) -> str:
+    return os.path.join(LEVEL_1_PATH, f"{geom_name}_{data_type}_{dataset}_{group}")
+
+
+def has_level_1(geom_name: str, dataset: str, group: str,
+                data_types: List[str] = ('change', 'time_series')) -> bool:
+    return all(os.path.exists(f"{level_1_path(geom_name, data_type, dataset, group)}.parquet")
+               for data_type in data_types)
+
+
+def read_level_1(geom_name: str, data_type: str, dataset: str, group: str) -> pd.DataFrame:
+    """Level 1 rows of a vector layer saved by a previous run, None if there are none"""
+    path = level_1_path(geom_name, data_type, dataset, group)
+    return read_precalculations(path) if os.path.exists(f"{path}.parquet") else None
+
+
+def write_level_1(df: pd.DataFrame, geom_name: str, data_type: str, dataset: str, group: str):
+    os.makedirs(LEVEL_1_PATH, exist_ok=True)
+    write_precalculations(df, level_1_path(geom_name, data_type, dataset, group),
+                          formats=['parquet'])
+
+
+def merge_rows(previous: pd.DataFrame, new: pd.DataFrame, gdf: gpd.GeoDataFrame,
+               changed: List, index_column_name: str = 'index') -> pd.DataFrame:
+    """Rows of the geometries that didn't change from a previous run and the recomputed rows,
+    in the order of the geometries. Rows of geometries no longer in the layer are dropped."""
+    if previous is not None:
+        keep = previous[index_column_name].isin(gdf[index_column_name]) & \
+            ~previous[index_column_name].isin(changed)
+        df = pd.concat([previous[keep], new]) if len(new) else previous[keep]
+    else:
+        df = new
+
+    order = pd.Series(np.arange(len(gdf)), index=gdf[index_column_name].values)
+    df = df.iloc[np.argsort(df[index_column_name].map(order).values, kind='stable')]
+    return df.reset_index(drop=True)
+
+
+class Manifest:
+    """Fingerprints of the inputs of the precalculations of every (dataset, group, vector layer),
+    used to only recompute the geometries whose inputs changed since the previous run.
+
+    An entry holds the fingerprint of the raster group, settings and parent layer, which
+    invalidates the whole layer when it changes, and the fingerprint of every geometry.
+    """
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(dataset: str, group: str, geom_name: str) -> str:
+        return f"{dataset}/{group}/{geom_name}"
+
+    def changed_indexes(self, key: str, fingerprint: str, geometries: Dict[str, str],
+                        indexes: List) -> List:
+        """Indexes of the geometries to recompute, all of them if the layer fingerprint changed
+        or if geometries were removed from the layer"""
+        entry = self.entries.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint or \
+                not set(entry['geometries']) <= set(geometries):
+            return list(indexes)
+        return [index for index in indexes
+                if entry['geometries'].get(str(index)) != geometries[str(index)]]
+
+    def update(self, key: str, fingerprint: str, geometries: Dict[str, str]):
+        self.entries[key] = {'fingerprint': fingerprint, 'geometries': geometries}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
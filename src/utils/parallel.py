@@ -0,0 +1,194 @@
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+import geopandas as gpd
+import xarray as xr
+
+from utils.data import RasterData, VectorData
+from utils.raster import ZarrData
+from utils.calculations import ZonalStatistics, MEMORY_BUDGET
+from utils.zonal import LabelAccumulator
+from utils.checkpoint import Checkpoints
+
+# Raster datasets, vector layers and masks already read by the current process
+_raster_data: Dict[tuple, xr.Dataset] = {}
+_vector_data: Dict[tuple, gpd.GeoDataFrame] = {}
+_masks: Dict[tuple, Tuple[xr.DataArray, Dict[tuple, xr.DataArray], Dict[str, xr.Dataset]]] = {}
+_overviews: Dict[tuple, Dict[int, xr.Dataset]] = {}
+
+
+@dataclass
+class WorkUnit:
+    dataset: str
+    group: str
+    vector_path: str
+    geom_name: str
+    indexes: List
+    chunk: int = 0
+    method: str = 'polygon'
+    tolerance: Optional[float] = None
+    memory_budget: Optional[int] = None
+    coverage: Optional[int] = None
+
+
+def make_work_units(dataset: str, group: str, vector_path: str,
+                    vector_data: Dict[str, gpd.GeoDataFrame], chunk_size: Optional[int] = None,
+                    method: str = 'polygon', index_column_name: str = 'index',
+                    tolerance: Optional[float] = None, memory_budget: Optional[int] = None,
+                    coverage: Optional[int] = None) -> List[WorkUnit]:
+    """Split every vector layer of a dataset group into chunks of geometries"""
+    units = []
+    for geom_name, gdf in vector_data.items():
+        indexes = gdf[index_column_name].tolist()
+        size = chunk_size or max(len(indexes), 1)
+        for chunk, start in enumerate(range(0, max(len(indexes), 1), size)):
+            units.append(WorkUnit(dataset, group, vector_path, geom_name,
+                                  indexes[start:start + size], chunk, method, tolerance,
+                                  memory_budget, coverage))
+    return units
+
+
+def unit_key(unit: WorkUnit) -> str:
+    """Name of the checkpoint of a work unit"""
+    sha = hashlib.sha256(json.dumps(asdict(unit), sort_keys=True, default=str).encode())
+    return f"{unit.dataset}_{unit.group}_{unit.geom_name}_{unit.chunk}_{sha.hexdigest()[:16]}"
+
+
+def _read_raster_data(raster_metadata: RasterData) -> xr.Dataset:
+    key = (raster_metadata.dataset, raster_metadata.group)
+    if key not in _raster_data:
+        _raster_data[key] = ZarrData(raster_metadata).read_as_xarray()
+    return _raster_data[key]
+
+
+def _read_overviews(raster_metadata: RasterData) -> Dict[int, xr.Dataset]:
+    key = (raster_metadata.dataset, raster_metadata.group)
+    if key not in _overviews:
+        _overviews[key] = ZarrData(raster_metadata).read_overviews()
+    return _overviews[key]
+
+
+def _read_vector_data(vector_path: str, geom_name: str) -> gpd.GeoDataFrame:
+    key = (vector_path, geom_name)
+    if key not in _vector_data:
+        prefix, level = geom_name.rsplit('_', 1)
+        vector = VectorData(vector_path, [prefix])
+        _vector_data[key] = vector.read_data(suffix=f'_{level}.geojson')[geom_name]
+    return _vector_data[key]
+
+
+def compute_work_unit(unit: WorkUnit, index_column_name: str = 'index'
+                      ) -> Tuple[Dict[str, pd.DataFrame], LabelAccumulator]:
+    """Compute the level 1 change and time_series values of a work unit, together with
+    the accumulator they come from"""
+    raster_metadata = RasterData(unit.dataset, unit.group)
+    raster_data = _read_raster_data(raster_metadata).copy()
+    gdf = _read_vector_data(unit.vector_path, unit.geom_name)
+
+    # Rasterize the whole layer so that every pixel gets the same label in all the chunks
+    key = (unit.dataset, unit.group, unit.vector_path, unit.geom_name, unit.coverage)
+    overviews = _read_overviews(raster_metadata) if unit.tolerance is not None else None
+    zonal_statistics = ZonalStatistics(raster_data, {unit.geom_name: gdf}, raster_metadata,
+                                       overviews=overviews, tolerance=unit.tolerance,
+                                       memory_budget=unit.memory_budget or MEMORY_BUDGET,
+                                       coverage=unit.coverage)
+    if key not in _masks:
+        zonal_statistics.rasterize_vector_data(index_column_name)
+        # There is no center point mask in coverage mode
+        _masks[key] = (raster_data.get(unit.geom_name), dict(zonal_statistics.overview_masks),
+                       dict(zonal_statistics.coverages))
+    mask, zonal_statistics.overview_masks, zonal_statistics.coverages = _masks[key]
+    if mask is not None:
+        raster_data[unit.geom_name] = mask
+
+    # Only reduce the geometries of the chunk
+    zonal_statistics.vector_data = {
+        unit.geom_name: gdf[gdf[index_column_name].isin(unit.indexes)]}
+    data = zonal_statistics.compute_all(index_column_name, method=unit.method)
+
+    return ({data_type: values[unit.geom_name] for data_type, values in data.items()},
+            zonal_statistics.accumulators[unit.geom_name])
+
+
+def _save_as_completed(futures: Dict, checkpoints: Checkpoints, as_completed):
+    """Save the result of every (future: unit) as soon as it finishes. A failed unit doesn't
+    stop the others from being saved, its error is raised once all of them finished."""
+    error = None
+    for future in as_completed(futures):
+        try:
+            checkpoints.save(unit_key(futures[future]), future.result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+
+
+def run_work_units(units: List[WorkUnit], workers: int = 1, scheduler: Optional[str] = None,
+                   checkpoints: Optional[Checkpoints] = None
+                   ) -> Iterable[Tuple[Dict[str, pd.DataFrame], LabelAccumulator]]:
+    """Run the work units in a process pool, or in a dask distributed cluster if a
+    scheduler address is given. Results are returned in the order of the units.
+
+    With checkpoints every result is saved by the calling process as soon as its unit
+    finishes, so the workers (e.g. of a dask cluster) don't need access to the checkpoints.
+    The units already checkpointed by a previous run are skipped and the results are read
+    back lazily instead of being held in memory.
+    """
+    if checkpoints is None:
+        if scheduler:
+            from dask.distributed import Client
+
+            with Client(scheduler) as client:
+                futures = client.map(compute_work_unit, units, pure=False)
+                return client.gather(futures)
+        elif workers > 1:
+            # Spawn fresh interpreters, forking a process with running dask threads can deadlock
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                return list(executor.map(compute_work_unit, units))
+        return [compute_work_unit(unit) for unit in units]
+
+    pending = [unit for unit in units if not checkpoints.done(unit_key(unit))]
+    print(f"{len(units) - len(pending)} work units already computed!")
+
+    if scheduler:
+        from dask.distributed import Client, as_completed as dask_as_completed
+
+        with Client(scheduler) as client:
+            futures = dict(zip(client.map(compute_work_unit, pending, pure=False), pending))
+            _save_as_completed(futures, checkpoints, dask_as_completed)
+    elif workers > 1:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = {executor.submit(compute_work_unit, unit): unit for unit in pending}
+            _save_as_completed(futures, checkpoints, as_completed)
+    else:
+        for unit in pending:
+            checkpoints.save(unit_key(unit), compute_work_unit(unit))
+
+    return (checkpoints.load(unit_key(unit)) for unit in units)
+
+
+def merge_work_units(units: List[WorkUnit],
+                     results: List[Tuple[Dict[str, pd.DataFrame], LabelAccumulator]]
+                     ) -> Tuple[Dict[str, Dict[str, pd.DataFrame]], Dict[str, LabelAccumulator]]:
+    """Concatenate the chunks of each vector layer in the order they were split and
+    combine their accumulators"""
+    data = {}
+    accumulators = {}
+    for unit, (result, accumulator) in zip(units, results):
+        for data_type, df in result.items():
+            data.setdefault(data_type, {}).setdefault(unit.geom_name, []).append(df)
+        accumulators.setdefault(unit.geom_name, []).append(accumulator)
+
+    data = {data_type: {geom_name: pd.concat(dfs) for geom_name, dfs in values.items()}
+            for data_type, values in data.items()}
+    accumulators = {geom_name: LabelAccumulator.combine(values)
+                    for geom_name, values in accumulators.items()}
+
+    return data, accumulators
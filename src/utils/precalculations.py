@@ -0,0 +1,118 @@
+import os
+import ast
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.instrumentation import stage
+
+FORMATS = ['parquet', 'csv']
+
+
+def _leaf_depth(value) -> int:
+    """Number of nested dictionary levels of a value"""
+    if isinstance(value, dict):
+        return 1 + max([_leaf_depth(item) for item in value.values()] + [0])
+    return 0
+
+
+def _map_type(values: pd.Series) -> pa.DataType:
+    """Arrow map type of a column of nested {str: ... {str: float}} dictionaries"""
+    depth = max([_leaf_depth(value) for value in values if isinstance(value, dict)] + [1])
+    map_type = pa.float64()
+    for _ in range(depth):
+        map_type = pa.map_(pa.string(), map_type)
+    return map_type
+
+
+def _to_dict(value):
+    """Nested dictionaries from the lists of (key, value) tuples of an Arrow map"""
+    if isinstance(value, list):
+        return {key: _to_dict(item) for key, item in value}
+    return value
+
+
+def to_arrow(df: pd.DataFrame) -> pa.Table:
+    """Arrow table with list columns as Arrow lists and dictionary columns as Arrow maps"""
+    arrays = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype != object:
+            arrays[str(column)] = pa.array(values, from_pandas=True)
+            continue
+
+        is_dict = values.map(lambda x: isinstance(x, dict))
+        is_list = values.map(lambda x: isinstance(x, (list, tuple, np.ndarray)))
+        if is_dict.any():
+            arrays[str(column)] = pa.array(values.where(is_dict, None).tolist(),
+                                           type=_map_type(values))
+        elif is_list.any():
+            arrays[str(column)] = pa.array([list(x) if listed else None
+                                            for x, listed in zip(values, is_list)])
+        else:
+            arrays[str(column)] = pa.array(values, from_pandas=True)
+
+    return pa.table(arrays)
+
+
+def from_arrow(table: pa.Table) -> pd.DataFrame:
+    """DataFrame with Arrow lists as Python lists and Arrow maps as nested dictionaries"""
+    df = table.to_pandas()
+    for field in table.schema:
+        if field.name not in df.columns:
+            continue
+        if pa.types.is_map(field.type):
+            df[field.name] = df[field.name].map(_to_dict)
+        elif pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+            df[field.name] = df[field.name].map(lambda x: x.tolist() if x is not None else None)
+    return df
+
+
+def write_precalculations(df: pd.DataFrame, path: str, formats: Sequence[str] = FORMATS,
+                          index: bool = False) -> List[str]:
+    """Save precalculations to path (without extension) in each of the given formats.
+
+    Parquet keeps list columns (counts, bins, sum_values, ...) and nested dictionary
+    columns (land_cover, ...) natively typed. CSV is kept for existing consumers, the
+    index is only written to CSV files.
+    """
+    assert all(file_format in FORMATS for file_format in formats), \
+        f"formats must be in {FORMATS}"
+
+    file_paths = []
+    for file_format in formats:
+        file_path = f"{path}.{file_format}"
+        with stage('write', path=file_path, rows=len(df)) as fields:
+            if file_format == 'parquet':
+                pq.write_table(to_arrow(df), file_path)
+            else:
+                df.to_csv(file_path, index=index)
+            fields['bytes_written'] = os.path.getsize(file_path)
+        file_paths.append(file_path)
+
+    return file_paths
+
+
+def read_precalculations(path: str) -> pd.DataFrame:
+    """Read precalculations saved by write_precalculations.
+
+    The path can be given with or without extension, Parquet is preferred if both exist.
+    Stringified lists and dictionaries of CSV files are parsed back.
+    """
+    root, extension = os.path.splitext(path)
+    if extension not in ['.parquet', '.csv']:
+        root = path
+        extension = '.parquet' if os.path.exists(f"{path}.parquet") else '.csv'
+
+    if extension == '.parquet':
+        return from_arrow(pq.read_table(f"{root}.parquet"))
+
+    df = pd.read_csv(f"{root}.csv")
+    for column in df.columns[df.dtypes == object]:
+        values = df[column].dropna()
+        if len(values) and values.map(lambda x: x[:1] in ['[', '{']).all():
+            df[column] = df[column].map(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
+    return df
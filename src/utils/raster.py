@@ -1,19 +1,42 @@
 import os
-from typing import Union
+from datetime import datetime, timezone
+from typing import Dict, List, Union
 from pathlib import Path
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import zarr
 import s3fs
 import rioxarray
 import numpy as np
 import xarray as xr
+import dask.array as da
+from tqdm import tqdm
+from numcodecs import Blosc
 from dotenv import load_dotenv
-from google.cloud import storage
 
 from utils.data import RasterData
+from utils.cache import ChunkCache
+from utils.clients import configure_gdal, gcs_client, s3_filesystem, s3_map
+from utils.instrumentation import stage, instrument_store
+from utils.zonal import coarsen_aggregates
 
 # Load .env variables
 load_dotenv()
+
+# Chunk sizes of the (depth, time, y, x) arrays, -1 for the whole axis.
+# 'map' reads whole maps of a year cheaply, 'time_series' reads all the years of small regions.
+CHUNK_LAYOUTS = {'map': {'depth': 1, 'time': 1, 'y': 1024, 'x': 1024},
+                 'balanced': {'depth': 1, 'time': 8, 'y': 512, 'x': 512},
+                 'time_series': {'depth': 1, 'time': -1, 'y': 256, 'x': 256}}
+COMPRESSOR = Blosc(cname='zstd', clevel=5, shuffle=Blosc.SHUFFLE)
+# Coarsening factors of the overview levels and size of the full resolution blocks they are
+# computed from, which must be a multiple of all the factors
+OVERVIEW_FACTORS = [4, 16, 64]
+OVERVIEW_BLOCK = 1024
+# Largest rounding error of the scaled int16 encoding as a fraction of the scale factor, values
+# with a finer precision than the scale factor of their group aren't quantized
+ROUNDING_TOLERANCE = 0.01
         
 
 class GCSGeoTiff:
@@ -25,7 +48,7 @@ class GCSGeoTiff:
         self.blob_name = blob_name
 
     def download(self, file_name):
-        storage_client = storage.Client.from_service_account_json(os.getenv('PRIVATEKEY_PATH'))
+        storage_client = gcs_client()
         bucket = storage_client.bucket(self.bucket_name)
         blob = bucket.blob(self.blob_name)
         blob.download_to_filename(file_name)
@@ -36,93 +59,354 @@ class GCSGeoTiff:
             )
         )
 
+    def open(self) -> xr.DataArray:
+        """Open the GeoTIFF file lazily, data is only read for the selected windows"""
+        configure_gdal()
+        return rioxarray.open_rasterio('gs://' + self.bucket_name + '/' + self.blob_name)
+
     def read_as_xarray(self):
         """Open the GeoTIFF file as an xarray dataset"""
+        configure_gdal()
         with rioxarray.open_rasterio('gs://' + self.bucket_name + '/' + self.blob_name) as dataset:
             return dataset
 
 
+def chunk_sizes(layout: Dict[str, int], sizes: Dict[str, int]) -> Dict[str, int]:
+    """Chunk size of every dimension, -1 or missing dimensions take the whole axis"""
+    return {dim: size if layout.get(dim, -1) == -1 else min(layout[dim], size)
+            for dim, size in sizes.items()}
+
+
+def zarr_encoding(raster_obj: RasterData) -> Dict:
+    """Compressor of the raster variable and, for stocks, its integer scale/offset encoding"""
+    encoding = {'compressor': COMPRESSOR}
+    if raster_obj.scale_factor():
+        encoding.update({'dtype': 'int16', 'scale_factor': raster_obj.scale_factor(),
+                         'add_offset': 0., '_FillValue': -32768})
+    return encoding
+
+
+def check_quantization(values: np.ndarray, scale_factor: float, add_offset: float = 0.,
+                       dtype: str = 'int16') -> np.ndarray:
+    """Raise a ValueError if the values don't fit in the scaled integer encoding, either out of
+    its range (the minimum is the fill value) or with a rounding error over ROUNDING_TOLERANCE.
+    Returns the values."""
+    scaled = (values - add_offset) / scale_factor
+    scaled = scaled[~np.isnan(scaled)]
+    if not scaled.size:
+        return values
+
+    info = np.iinfo(dtype)
+    rounded = np.round(scaled)
+    if rounded.min() < info.min + 1 or rounded.max() > info.max:
+        raise ValueError(f"values from {np.nanmin(values)} to {np.nanmax(values)} don't fit in "
+                         f"{np.dtype(dtype)} with a scale factor of {scale_factor}")
+    error = np.abs(rounded - scaled).max()
+    if error > ROUNDING_TOLERANCE:
+        raise ValueError(f"a scale factor of {scale_factor} rounds values by up to "
+                         f"{error * scale_factor:g}, use a smaller one or None to keep floats")
+    return values
+
+
+def encode(values: np.ndarray, z_array: zarr.Array) -> np.ndarray:
+    """Apply the scale/offset encoding of a Zarr array written by xarray"""
+    if 'scale_factor' not in z_array.attrs:
+        return values.astype(z_array.dtype)
+
+    scale_factor = z_array.attrs['scale_factor']
+    add_offset = z_array.attrs.get('add_offset', 0.)
+    check_quantization(values, scale_factor, add_offset, z_array.dtype)
+    encoded = np.round((values - add_offset) / scale_factor)
+    encoded[np.isnan(values)] = z_array.fill_value
+    return encoded.astype(z_array.dtype)
+
+
+def mark_written(store, group: str):
+    """Record when the data of a group was written in its attributes. Chunks can be rewritten
+    in place with the same metadata, and utils.cache.ChunkCache keys the chunks it keeps on disk
+    by the consolidated metadata of the store."""
+    z = zarr.open_group(store, mode='r+', path=group)
+    z.attrs['written'] = datetime.now(timezone.utc).isoformat()
+
+
+def overview_group(group: str, factor: int) -> str:
+    return f"{group}/overview_{factor}"
+
+
+def write_overviews(store, raster_obj: RasterData, factors: List[int] = OVERVIEW_FACTORS,
+                    workers: int = 8):
+    """Write coarsened sum, count and change histogram levels of a group into the store.
+
+    Every level is an {group}/overview_{factor} group with the aggregates of
+    factor x factor pixels, see utils.zonal.coarsen_aggregates.
+    """
+    assert OVERVIEW_BLOCK % max(factors) == 0, "OVERVIEW_BLOCK must be a multiple of the factors"
+
+    ds = xr.open_zarr(store=store, group=raster_obj.group)
+    xda = ds[raster_obj.variable()].sel(depth=list(raster_obj.depths().keys()))
+    xda = xda.transpose('depth', 'time', 'y', 'x')
+    n_depths, n_times, ny, nx = xda.shape
+    bins = raster_obj.bins()
+    n_bins = max(len(depth_bins) - 1 for depth_bins in bins)
+    time_index = ds.indexes['time']
+    times = raster_obj.times()
+    time_indexes = (time_index.get_loc(times[0]), time_index.get_loc(times[-1]))
+
+    # Allocate the levels, coarse pixel coordinates are the centers of the blocks
+    for factor in factors:
+        coords = {'depth': xda['depth'].values, 'time': xda['time'].values}
+        for dim in ['y', 'x']:
+            values = xda[dim].values
+            step = values[1] - values[0]
+            n_coarse = -(-len(values) // factor)
+            coords[dim] = values[0] + (np.arange(n_coarse) * factor + (factor - 1) / 2) * step
+        sizes = {**{dim: len(coords[dim]) for dim in coords}, 'bin': n_bins}
+        chunks = {'depth': 1, 'time': n_times, 'bin': n_bins, 'y': 256, 'x': 256}
+
+        def empty(dims, dtype):
+            return (dims, da.empty(tuple(sizes[dim] for dim in dims), dtype=dtype,
+                                   chunks=tuple(min(chunks[dim], sizes[dim]) for dim in dims)))
+
+        xds = xr.Dataset({'sum': empty(('depth', 'time', 'y', 'x'), 'float64'),
+                          'count': empty(('depth', 'time', 'y', 'x'), 'int32'),
+                          'sum_diff': empty(('depth', 'y', 'x'), 'float64'),
+                          'count_diff': empty(('depth', 'y', 'x'), 'int32'),
+                          'hist': empty(('depth', 'bin', 'y', 'x'), 'int32')},
+                         coords=coords, attrs={'factor': factor})
+        for name in xds.data_vars:
+            xds[name].encoding = {'compressor': COMPRESSOR}
+        xds.to_zarr(store=store, group=overview_group(raster_obj.group, factor), mode='w',
+                    compute=False, consolidated=False)
+
+    # Blocks of different tasks can share overview chunks
+    synchronizer = zarr.ThreadSynchronizer()
+    levels = {factor: zarr.open_group(store, mode='r+', synchronizer=synchronizer,
+                                      path=overview_group(raster_obj.group, factor))
+              for factor in factors}
+
+    def write_block(n: int, y_start: int, x_start: int):
+        y_slice = slice(y_start, y_start + OVERVIEW_BLOCK)
+        x_slice = slice(x_start, x_start + OVERVIEW_BLOCK)
+        values = xda[n:n + 1, :, y_slice, x_slice].values.astype('float64')
+        values = values / raster_obj.unit_divisor()
+
+        # Pad the blocks of the edges with nodata to a multiple of the factors
+        pad = [(0, 0), (0, 0), (0, -values.shape[2] % max(factors)),
+               (0, -values.shape[3] % max(factors))]
+        values = np.pad(values, pad, constant_values=np.nan)
+        for factor, level in levels.items():
+            aggregates = coarsen_aggregates(values, factor, bins[n:n + 1], time_indexes)
+            hist = aggregates['hist']
+            aggregates['hist'] = np.pad(hist, [(0, 0), (0, n_bins - hist.shape[1]), (0, 0), (0, 0)])
+            y_slice = slice(y_start // factor, y_start // factor + aggregates['sum'].shape[2])
+            x_slice = slice(x_start // factor, x_start // factor + aggregates['sum'].shape[3])
+            for name, array in aggregates.items():
+                ny_level, nx_level = level[name].shape[-2:]
+                array = array[..., :ny_level - y_slice.start, :nx_level - x_slice.start]
+                level[name][n:n + 1, ..., y_slice, x_slice] = array
+
+    tasks = [(n, y, x) for n in range(n_depths)
+             for y in range(0, ny, OVERVIEW_BLOCK) for x in range(0, nx, OVERVIEW_BLOCK)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_block, *task) for task in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+
+
 class GeoTiffConverter:
     s3_access_key_id = os.getenv("S3_ACCESS_KEY_ID")
     s3_secret_access_key = os.getenv("S3_SECRET_ACCESS_KEY")
 
-    def __init__(self, geotiff_obj: RasterData, save_in_s3: bool = False):
+    def __init__(self, geotiff_obj: RasterData, save_in_s3: bool = False, layout: str = 'map',
+                 chunks: Dict[str, int] = None):
+        assert layout in CHUNK_LAYOUTS, f"layout must be one of {list(CHUNK_LAYOUTS)}"
+
         self.geotiff_obj = geotiff_obj
         self.save_in_s3 = save_in_s3
+        # Chunks of the Zarr arrays, GeoTIFFs are read and written one chunk at a time
+        self.chunks = {**CHUNK_LAYOUTS[layout], **(chunks or {})}
         if save_in_s3:
-            self.s3 = s3fs.S3FileSystem(key=self.s3_access_key_id, secret=self.s3_secret_access_key)
+            self.s3 = s3_filesystem(self.s3_access_key_id, self.s3_secret_access_key)
+
+    def store(self):
+        return s3fs.S3Map(root=self.geotiff_obj.s3_path(), s3=self.s3,
+                          check=False) if self.save_in_s3 else self.geotiff_obj.local_path()
+
+    def geotiff_file(self, year: str, depth_name: str) -> GCSGeoTiff:
+        return GCSGeoTiff(os.path.join(self.geotiff_obj.gcp_path(),
+                                       self.geotiff_obj.get_file_name(year, depth_name)))
+
+    def _clean(self, xda: xr.DataArray) -> xr.DataArray:
+        """Drop band coordinate and attributes and replace nodata values with np.nan"""
+        xda = xda.squeeze().drop_vars("band")
+        xda.attrs = {}
+        if self.geotiff_obj.no_data():
+            xda = xda.where(xda != self.geotiff_obj.no_data())
+        return xda
+
+    def allocate_zarr(self) -> xr.Dataset:
+        """Create the Zarr group with its coordinates and empty (depth, time, y, x) arrays"""
+        years = self.geotiff_obj.years()
+        depths = self.geotiff_obj.depths()
 
-    def convert_to_zarr(self):
-        for i, year in enumerate(self.geotiff_obj.years()):
-            print(f'Year: {year}')
-            xds_depth_list = []
-            for j, (depth, depth_name) in enumerate(self.geotiff_obj.depths().items()):
-                print(f'Depth: {depth}')
+        # Grid and dtype from the first GeoTIFF, all the GeoTIFFs of a group share them
+        with self.geotiff_file(years[0], list(depths.values())[0]).open() as xda:
+            xda = self._clean(xda)
+            dtype = xda.isel(y=slice(0, 1), x=slice(0, 1)).values.dtype
+            coords = {'depth': np.array(list(depths.keys())),
+                      'time': self.geotiff_obj.times(),
+                      'y': xda['y'].values, 'x': xda['x'].values}
+            spatial_ref = xda['spatial_ref'] if 'spatial_ref' in xda.coords else None
+            grid_mapping = xda.encoding.get('grid_mapping')
 
-                # Read GeoTIFF
-                geotiff_file = GCSGeoTiff(
-                    os.path.join(self.geotiff_obj.gcp_path(), self.geotiff_obj.get_file_name(year, depth_name)))
+        # Decoded values are floats if they are stored with a scale/offset encoding
+        encoding = zarr_encoding(self.geotiff_obj)
+        if 'scale_factor' in encoding:
+            dtype = np.float32
+        if grid_mapping:
+            encoding['grid_mapping'] = grid_mapping
 
-                # Drop band coordinate and attributes
-                xda = geotiff_file.read_as_xarray().squeeze().drop_vars("band")
-                xda.attrs = {}
+        dims = ['depth', 'time', 'y', 'x']
+        chunks = chunk_sizes(self.chunks, {dim: len(coords[dim]) for dim in dims})
+        data = da.empty(tuple(len(coords[dim]) for dim in dims), dtype=dtype,
+                        chunks=tuple(chunks[dim] for dim in dims))
+        xds = xr.Dataset({self.geotiff_obj.variable(): (dims, data)}, coords=coords)
+        xds[self.geotiff_obj.variable()].encoding = encoding
+        if spatial_ref is not None:
+            xds = xds.assign_coords(spatial_ref=spatial_ref)
 
-                # Replace nodata values with np.nan
-                if self.geotiff_obj.no_data():
-                    xda = xda.where(xda != self.geotiff_obj.no_data())
+        # Only the metadata and the coordinates are written, the data is written by regions
+        xds.to_zarr(store=self.store(), group=self.geotiff_obj.group, mode='w', compute=False,
+                    consolidated=False)
 
-                # Add time coordinates
-                xda = xda.assign_coords({"time": self.geotiff_obj.times()[i]}).expand_dims(['time'])
+        return xds
 
-                # Convert to Dataset and add depth coordinates
-                xds = xr.Dataset({self.geotiff_obj.variable(): xda}, attrs=xda.attrs)
-                xds = xds.assign_coords({"depth": np.array([depth])})
+    def _write_chunks(self, depth_slice: slice, time_slice: slice, y_slice: slice):
+        """Stream the GeoTIFFs of a (depth, time) chunk into a row of Zarr chunks, reading
+        one window of every GeoTIFF at a time"""
+        z = zarr.open_group(self.store(), mode='r+', path=self.geotiff_obj.group)
+        z_array = z[self.geotiff_obj.variable()]
+        x_chunk = z_array.chunks[3]
 
-                xds_depth_list.append(xds)
+        years = self.geotiff_obj.years()[time_slice]
+        depth_names = list(self.geotiff_obj.depths().values())[depth_slice]
 
-            # Concatenate by depth
-            xds = xr.concat(xds_depth_list, dim='depth')
+        with ExitStack() as stack:
+            xdas = [[stack.enter_context(self.geotiff_file(year, depth_name).open())
+                     for year in years] for depth_name in depth_names]
+            for x_start in range(0, z_array.shape[3], x_chunk):
+                x_slice = slice(x_start, x_start + x_chunk)
+                # Windowed reads of the GeoTIFFs
+                block = np.stack([np.stack([self._clean(xda.isel(y=y_slice, x=x_slice)).values
+                                            for xda in depth_xdas]) for depth_xdas in xdas])
+                z_array[depth_slice, time_slice, y_slice, x_slice] = encode(block, z_array)
 
-            # Save xr.Dataset as Zarr
-            store = s3fs.S3Map(root=self.geotiff_obj.s3_path(), s3=self.s3,
-                               check=False) if self.save_in_s3 else self.geotiff_obj.local_path()
-            mode = "w" if i == 0 else "a"
-            append_dim = None if i == 0 else "time"
+    def convert_to_zarr(self, workers: int = 8, overview_factors: List[int] = OVERVIEW_FACTORS):
+        self.allocate_zarr()
 
-            xds.to_zarr(store=store, group=self.geotiff_obj.group, mode=mode, append_dim=append_dim, consolidated=True)
+        z = zarr.open_group(self.store(), mode='r', path=self.geotiff_obj.group)
+        shape = z[self.geotiff_obj.variable()].shape
+        chunks = z[self.geotiff_obj.variable()].chunks
+        # One task per row of Zarr chunks, so no chunk is written by two tasks
+        tasks = [(slice(d, d + chunks[0]), slice(t, t + chunks[1]), slice(y, y + chunks[2]))
+                 for d in range(0, shape[0], chunks[0])
+                 for t in range(0, shape[1], chunks[1])
+                 for y in range(0, shape[2], chunks[2])]
 
-            # consolidate metadata at root
-            zarr.consolidate_metadata(store)
-            c = self.s3.exists(f"{self.geotiff_obj.s3_path()}/.zmetadata") if self.save_in_s3 else os.path.exists(
-                f"{self.geotiff_obj.local_path()}/.zmetadata")
-            print(f"{self.geotiff_obj.s3_path() if self.save_in_s3 else self.geotiff_obj.local_path()} is consolidated? {c}")
-            with zarr.open(store, mode='r') as z:
-                print(z.tree())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._write_chunks, *task): task for task in tasks}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+
+        if overview_factors:
+            print("Writing overviews")
+            write_overviews(self.store(), self.geotiff_obj, overview_factors, workers)
+
+        # consolidate metadata at root once all the data is written
+        store = self.store()
+        mark_written(store, self.geotiff_obj.group)
+        zarr.consolidate_metadata(store)
+        path = self.geotiff_obj.s3_path() if self.save_in_s3 else self.geotiff_obj.local_path()
+        c = self.s3.exists(f"{path}/.zmetadata") if self.save_in_s3 else \
+            os.path.exists(f"{path}/.zmetadata")
+        print(f"{path} is consolidated? {c}")
+        with zarr.open(store, mode='r') as z:
+            print(z.tree())
 
 
 class ZarrData:
     s3_access_key_id = os.getenv("S3_ACCESS_KEY_ID")
     s3_secret_access_key = os.getenv("S3_SECRET_ACCESS_KEY")
 
-    def __init__(self, raster_obj: RasterData, in_s3: bool = False):
+    def __init__(self, raster_obj: RasterData, in_s3: bool = False, chunk_cache: ChunkCache = None):
         self.raster_obj = raster_obj
         self.in_s3 = in_s3
+        # Cache of the chunks read from S3, if any
+        self.chunk_cache = chunk_cache
+
+    def _s3_store(self):
+        store = s3_map(self.raster_obj.s3_path(), self.s3_access_key_id, self.s3_secret_access_key)
+        # Count the bytes fetched from S3 below the cache, if instrumented
+        store = instrument_store(store)
+        return self.chunk_cache.wrap(store) if self.chunk_cache else store
 
     def read_as_xarray(self):
-        if self.in_s3:
-            # Initilize the S3 file system
-            s3 = s3fs.S3FileSystem(key=self.s3_access_key_id, secret=self.s3_secret_access_key)
-            store = s3fs.S3Map(root=self.raster_obj.s3_path(), s3=s3, check=False)
-            # Read Zarr file
-            ds = xr.open_zarr(store=store, group=self.raster_obj.group, consolidated=True)
-            # Change dimension name
-            if self.raster_obj.group == 'concentration':
-                ds = ds.rename({'depht': 'depth'})
-        else:
-            # Read Zarr file
-            ds = xr.open_zarr(store=self.raster_obj.local_path(), group=self.raster_obj.group, consolidated=True)
+        with stage('read_as_xarray', dataset=self.raster_obj.dataset, group=self.raster_obj.group,
+                   in_s3=self.in_s3):
+            if self.in_s3:
+                store = self._s3_store()
+                # Read Zarr file
+                ds = xr.open_zarr(store=store, group=self.raster_obj.group, consolidated=True)
+                # Change dimension name
+                if self.raster_obj.group == 'concentration':
+                    ds = ds.rename({'depht': 'depth'})
+            else:
+                # Read Zarr file
+                ds = xr.open_zarr(store=instrument_store(self.raster_obj.local_path()),
+                                  group=self.raster_obj.group, consolidated=True)
 
         # Change coordinates names
         ds = ds.rename({'x': 'lon', 'y': 'lat'})
 
         return ds
+
+    def read_overviews(self) -> Dict[int, xr.Dataset]:
+        """Overview levels of the group by coarsening factor, see write_overviews"""
+        store = self._s3_store() if self.in_s3 else instrument_store(self.raster_obj.local_path())
+
+        overviews = {}
+        z = zarr.open_consolidated(store, mode='r')
+        for name, _ in z[self.raster_obj.group].groups():
+            if name.startswith('overview_'):
+                factor = int(name.split('_')[-1])
+                ds = xr.open_zarr(store=store, group=overview_group(self.raster_obj.group, factor),
+                                  consolidated=True)
+                overviews[factor] = ds.rename({'x': 'lon', 'y': 'lat'})
+
+        return overviews
+
+    def rechunk(self, layout: str, store: Union[str, Path]):
+        """Copy the group to another store with the chunk layout and encoding of the
+        GeoTiffConverter"""
+        assert layout in CHUNK_LAYOUTS, f"layout must be one of {list(CHUNK_LAYOUTS)}"
+
+        source = self._s3_store() if self.in_s3 else self.raster_obj.local_path()
+        ds = xr.open_zarr(store=source, group=self.raster_obj.group, consolidated=True)
+        ds = ds.chunk(chunk_sizes(CHUNK_LAYOUTS[layout], dict(ds.sizes)))
+
+        # Drop the chunks of the source store so that the new ones are used
+        for name in ds.variables:
+            ds[name].encoding.pop('chunks', None)
+            ds[name].encoding.pop('preferred_chunks', None)
+        encoding = zarr_encoding(self.raster_obj)
+        ds[self.raster_obj.variable()].encoding.update(encoding)
+        # The values are checked chunk by chunk while they are written
+        if 'scale_factor' in encoding:
+            xda = ds[self.raster_obj.variable()]
+            ds[self.raster_obj.variable()] = xda.copy(data=xda.data.map_blocks(
+                check_quantization, encoding['scale_factor'], encoding['add_offset'],
+                encoding['dtype'], dtype=xda.dtype))
+
+        ds.to_zarr(store=store, group=self.raster_obj.group, mode='w', consolidated=False)
+        mark_written(store, self.raster_obj.group)
+        zarr.consolidate_metadata(store)
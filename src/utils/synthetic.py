@@ -0,0 +1,123 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import xarray as xr
+import geopandas as gpd
+from shapely.geometry import box, MultiPolygon
+
+from utils.data import RasterData, LandCoverData
+
+
+def _grid(width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Pixel centers of a global lon/lat grid"""
+    x_resolution, y_resolution = 360 / width, 180 / height
+    x = -180 + x_resolution * (np.arange(width) + .5)
+    y = 90 - y_resolution * (np.arange(height) + .5)
+    return x, y
+
+
+def synthetic_raster(raster_metadata: RasterData, width: int = 1440, height: int = 720,
+                     chunks: Dict[str, int] = None, nodata: float = .05,
+                     seed: int = 0) -> xr.Dataset:
+    """Global (depth, time, lat, lon) dataset shaped like the group of raster_metadata, as
+    returned by ZarrData.read_as_xarray, with random values and a fraction of nodata pixels"""
+    rng = np.random.default_rng(seed)
+    depths = list(raster_metadata.depths().keys())
+    times = raster_metadata.times()
+    x, y = _grid(width, height)
+
+    # Values drift in time so that the change histograms aren't empty
+    values = rng.normal(50, 10, (len(depths), 1, height, width)) + \
+        np.cumsum(rng.normal(0, 1, (len(depths), len(times), height, width)), axis=1)
+    values[:, :, rng.random((height, width)) < nodata] = np.nan
+
+    ds = xr.Dataset({raster_metadata.variable(): (('depth', 'time', 'lat', 'lon'),
+                                                  values.astype('float32'))},
+                    coords={'depth': depths, 'time': times, 'lat': y, 'lon': x})
+    return ds.chunk(chunks or {'lat': 360, 'lon': 360})
+
+
+def synthetic_land_cover(group_type: str = 'recent', width: int = 1440, height: int = 720,
+                         chunks: Dict[str, int] = None, scenarios: List[str] = None,
+                         seed: int = 0) -> xr.Dataset:
+    """Global (time, y, x) dataset shaped like LandCoverRasterData.read_data: stocks and
+    land cover of 2000 and 2018 for 'recent', land cover of 2018 and the stocks change of
+    every scenario for 'future'"""
+    rng = np.random.default_rng(seed)
+    codes = np.array([int(code) for code in LandCoverData().child_parent().keys()])
+    x, y = _grid(width, height)
+
+    land_cover = rng.choice(codes, (2, height, width)).astype('float32')
+    # Most of the pixels keep their land cover
+    unchanged = rng.random((height, width)) < .8
+    land_cover[1][unchanged] = land_cover[0][unchanged]
+
+    if group_type == 'recent':
+        times = np.array(['2000-12-31', '2018-12-31'], dtype='datetime64[ns]')
+        stocks = rng.normal(50, 10, (2, height, width)).astype('float32')
+        ds = xr.Dataset({'stocks': (('time', 'y', 'x'), stocks),
+                         'land-cover': (('time', 'y', 'x'), land_cover)},
+                        coords={'time': times, 'y': y, 'x': x})
+    else:
+        times = np.array(['2018-12-31'], dtype='datetime64[ns]')
+        ds = xr.Dataset({'land-cover': (('time', 'y', 'x'), land_cover[1:]),
+                         **{scenario: (('y', 'x'),
+                                       rng.normal(0, 3, (height, width)).astype('float32'))
+                            for scenario in scenarios or []}},
+                        coords={'time': times, 'y': y, 'x': x})
+    return ds.chunk(chunks or {'y': 360, 'x': 360})
+
+
+def synthetic_polygons(n_polygons: int = 100, size: float = 5., n_antimeridian: int = 0,
+                       n_parents: int = 10, gid_0: str = None, seed: int = 0
+                       ) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """Level 1 and level 0 layers shaped like VectorData.read_data.
+
+    Level 1 has n_polygons non overlapping squares of about size x size degrees, the first
+    n_antimeridian of them split in two by the antimeridian. Level 0 has the envelope of the
+    children of every id_0.
+    """
+    rng = np.random.default_rng(seed)
+    # Non overlapping cells of a global grid of size x size degrees. The first and last columns
+    # are left to the antimeridian polygons, which take half of each in rows of their own.
+    columns, rows = int(360 // size), int(160 // size)
+    assert n_polygons - n_antimeridian <= (columns - 2) * rows and n_antimeridian <= rows, \
+        "too many polygons of that size"
+    antimeridian_rows = rng.choice(rows, n_antimeridian, replace=False)
+    cells = rng.choice((columns - 2) * rows, n_polygons - n_antimeridian, replace=False)
+
+    geometries = []
+    half = size / 2
+    for row in antimeridian_rows:
+        ymin = -80 + row * size
+        geometries.append(MultiPolygon([box(180 - half, ymin, 180, ymin + size),
+                                        box(-180, ymin, -180 + half, ymin + size)]))
+    for cell in cells:
+        ymin = -80 + (cell // (columns - 2)) * size
+        xmin = -180 + (cell % (columns - 2) + 1) * size
+        geometries.append(box(xmin, ymin, xmin + size, ymin + size))
+
+    id_0 = np.sort(rng.integers(0, n_parents, n_polygons))
+    gdf_1 = gpd.GeoDataFrame({'index': np.arange(n_polygons), 'id': np.arange(n_polygons),
+                              'id_0': id_0, 'gid_0': gid_0},
+                             geometry=geometries, crs='EPSG:4326')
+
+    parents = gdf_1.dissolve('id_0').envelope
+    gdf_0 = gpd.GeoDataFrame({'index': np.arange(len(parents)), 'id_0': parents.index,
+                              'gid_0': gid_0},
+                             geometry=parents.values, crs='EPSG:4326')
+    return gdf_1, gdf_0
+
+
+def synthetic_transitions(n_dicts: int = 1000, seed: int = 0) -> List[Dict[str, Dict[str, float]]]:
+    """{land cover: {land cover: stocks change}} dictionaries like the land_cover column of
+    the recent land cover statistics, each with a random subset of the transitions"""
+    rng = np.random.default_rng(seed)
+    codes = list(LandCoverData().child_parent().keys())
+    dicts = []
+    for _ in range(n_dicts):
+        keys = rng.choice(codes, rng.integers(1, len(codes) + 1), replace=False)
+        dicts.append({str(key): {str(code): float(rng.normal()) for code in
+                                 rng.choice(codes, rng.integers(1, len(codes) + 1), replace=False)}
+                      for key in keys})
+    return dicts
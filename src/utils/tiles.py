@@ -0,0 +1,149 @@
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+import shapely
+import xarray as xr
+
+from utils.data import RasterData
+from utils.zonal import LabelAccumulator, iter_blocks
+
+
+class TileQuery:
+    """Zonal statistics of arbitrary geometries from per-tile aggregates.
+
+    The tiles are the coarse pixels of an overview level written by
+    utils.raster.write_overviews, which hold the sums, counts and change histograms of
+    their pixels for every depth and time step. Tiles fully covered by a geometry are
+    added from these aggregates and only the pixels of the tiles on its boundary are read.
+    """
+    def __init__(self, raster_data: xr.Dataset, overviews: Dict[int, xr.Dataset],
+                 raster_metadata: RasterData, factor: int = 16):
+        assert factor in overviews, f"there is no overview with factor {factor}"
+
+        self.raster_metadata = raster_metadata
+        self.factor = factor
+        self.depths = list(raster_metadata.depths().keys())
+        self.overview = overviews[factor].sel(depth=self.depths)
+        self.ds_var = raster_data[raster_metadata.variable()].sel(depth=self.depths)
+        self.ds_var = self.ds_var.transpose('depth', 'time', 'lat', 'lon')
+
+        times = raster_metadata.times()
+        years = raster_metadata.years()
+        time_index = raster_data.indexes['time']
+        self.time_indexes = (time_index.get_loc(times[0]), time_index.get_loc(times[-1]))
+        self.metadata = {"years": [years[0], years[-1]],
+                         "variable": raster_metadata.variable(),
+                         "group_type": raster_metadata.dataset}
+
+        # Pixel centers and tile edges
+        self.lon = raster_data['lon'].values
+        self.lat = raster_data['lat'].values
+        self.dx = self.lon[1] - self.lon[0]
+        self.dy = self.lat[1] - self.lat[0]
+        self.tile_lon = self.lon[0] - self.dx / 2 + \
+            np.arange(self.overview.sizes['lon'] + 1) * factor * self.dx
+        self.tile_lat = self.lat[0] - self.dy / 2 + \
+            np.arange(self.overview.sizes['lat'] + 1) * factor * self.dy
+
+    def _tile_window(self, geometry) -> Dict[str, slice]:
+        """Tiles intersecting the bounding box of a geometry"""
+        xmin, ymin, xmax, ymax = geometry.bounds
+        window = {}
+        for name, edges, low, high in [('lon', self.tile_lon, xmin, xmax),
+                                       ('lat', self.tile_lat, ymin, ymax)]:
+            lower = np.minimum(edges[:-1], edges[1:])
+            upper = np.maximum(edges[:-1], edges[1:])
+            tiles = np.flatnonzero((upper >= low) & (lower <= high))
+            window[name] = slice(tiles[0], tiles[-1] + 1) if len(tiles) else slice(0, 0)
+        return window
+
+    def accumulate(self, geometry, data_types: Sequence[str] = ('change', 'time_series')
+                   ) -> LabelAccumulator:
+        """Accumulator with the statistics of a geometry as label 0"""
+        accumulator = LabelAccumulator([0], len(self.depths), self.ds_var.sizes['time'],
+                                       data_types=data_types, bins=self.raster_metadata.bins(),
+                                       time_indexes=self.time_indexes)
+        window = self._tile_window(geometry)
+        lat_tiles = np.arange(self.overview.sizes['lat'])[window['lat']]
+        lon_tiles = np.arange(self.overview.sizes['lon'])[window['lon']]
+        if not len(lat_tiles) or not len(lon_tiles):
+            return accumulator
+
+        # Classify the tiles as fully covered, on the boundary or outside the geometry,
+        # preparing a copy as preparing changes the geometry of the caller
+        geometry = shapely.from_wkb(shapely.to_wkb(geometry))
+        shapely.prepare(geometry)
+        lon_edges = self.tile_lon[lon_tiles[0]:lon_tiles[-1] + 2]
+        lat_edges = self.tile_lat[lat_tiles[0]:lat_tiles[-1] + 2]
+        x0, y0 = np.meshgrid(lon_edges[:-1], lat_edges[:-1])
+        x1, y1 = np.meshgrid(lon_edges[1:], lat_edges[1:])
+        tiles = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1),
+                            np.maximum(x0, x1), np.maximum(y0, y1))
+        covered = shapely.contains(geometry, tiles)
+        boundary = shapely.intersects(geometry, tiles) & ~covered
+
+        # Fully covered tiles from their aggregates
+        if covered.any():
+            overview = self.overview.isel(**window).load()
+            aggregates = {
+                'sum': overview['sum'].transpose('depth', 'time', 'lat', 'lon').values,
+                'count': overview['count'].transpose('depth', 'time', 'lat', 'lon').values,
+                'sum_diff': overview['sum_diff'].transpose('depth', 'lat', 'lon').values,
+                'count_diff': overview['count_diff'].transpose('depth', 'lat', 'lon').values,
+                'hist': overview['hist'].transpose('depth', 'bin', 'lat', 'lon').values}
+            accumulator.update_aggregates(aggregates, np.where(covered, 0., np.nan))
+
+        # Boundary tiles from their pixels whose centers are within the geometry
+        if boundary.any():
+            self._accumulate_boundary(accumulator, geometry, boundary, lat_tiles, lon_tiles)
+
+        return accumulator
+
+    def _accumulate_boundary(self, accumulator: LabelAccumulator, geometry,
+                             boundary: np.ndarray, lat_tiles: np.ndarray, lon_tiles: np.ndarray):
+        """Add the pixels of the boundary tiles reading each chunk of the raster once, for all
+        the boundary tiles in it"""
+        # Pixels of the tiles window
+        y_window = slice(lat_tiles[0] * self.factor,
+                         min((lat_tiles[-1] + 1) * self.factor, len(self.lat)))
+        x_window = slice(lon_tiles[0] * self.factor,
+                         min((lon_tiles[-1] + 1) * self.factor, len(self.lon)))
+        ds_window = self.ds_var[:, :, y_window, x_window]
+
+        for y_slice, x_slice in iter_blocks(ds_window):
+            # Pixels of the chunk that belong to a boundary tile
+            rows = np.arange(y_slice.start, y_slice.stop)
+            columns = np.arange(x_slice.start, x_slice.stop)
+            in_boundary = boundary[rows[:, None] // self.factor, columns[None, :] // self.factor]
+            if not in_boundary.any():
+                continue
+
+            # Only read the rows and columns of the chunk with boundary pixels
+            y_indexes = np.flatnonzero(in_boundary.any(axis=1))
+            x_indexes = np.flatnonzero(in_boundary.any(axis=0))
+            in_boundary = in_boundary[y_indexes[0]:y_indexes[-1] + 1,
+                                      x_indexes[0]:x_indexes[-1] + 1]
+            y_block = slice(rows[y_indexes[0]], rows[y_indexes[-1]] + 1)
+            x_block = slice(columns[x_indexes[0]], columns[x_indexes[-1]] + 1)
+
+            lon, lat = np.meshgrid(self.lon[x_window][x_block], self.lat[y_window][y_block])
+            labels_block = np.full(in_boundary.shape, np.nan)
+            labels_block[in_boundary] = np.where(
+                shapely.contains_xy(geometry, lon[in_boundary], lat[in_boundary]), 0., np.nan)
+            if np.isnan(labels_block).all():
+                continue
+
+            values = ds_window[:, :, y_block, x_block].values
+            if self.raster_metadata.unit_divisor() != 1:
+                values = values / self.raster_metadata.unit_divisor()
+            accumulator.update(values, labels_block)
+
+    def query(self, geometry, data_types: Sequence[str] = ('change', 'time_series')
+              ) -> Dict[str, pd.DataFrame]:
+        """Change and/or time_series rows of a geometry, with the same layout as the ones
+        of ZonalStatistics.compute"""
+        accumulator = self.accumulate(geometry, data_types)
+        return {data_type: pd.DataFrame(accumulator.to_records(data_type, [0], self.depths,
+                                                               self.metadata))
+                for data_type in data_types}
@@ -1,6 +1,6 @@
 import os
 
-import s3fs
+import numpy as np
 import rioxarray
 import xarray as xr
 import pandas as pd
@@ -9,6 +9,10 @@ from shapely.ops import split
 from dotenv import load_dotenv
 from shapely.geometry import LineString, Polygon, MultiPolygon
 
+from utils.clients import s3_map
+from utils.instrumentation import instrument_store
+from utils.land_cover import LandCoverCodes, land_cover_transitions, recent_lc_statistics
+
 # Load .env variables
 load_dotenv()
 
@@ -22,13 +26,15 @@ def multiply_dict_values(dictionary, factor):
     return dictionary
 
 
-def read_zarr_from_s3(access_key_id, secret_accsess_key, dataset, group=None):
+def read_zarr_from_s3(access_key_id, secret_accsess_key, dataset, group=None, chunk_cache=None):
     # AWS S3 path
     s3_path = f's3://soils-revealed/{dataset}.zarr'
     
-    # Initilize the S3 file system
-    s3 = s3fs.S3FileSystem(key=access_key_id, secret=secret_accsess_key)
-    store = s3fs.S3Map(root=s3_path, s3=s3, check=False)
+    # S3 file system shared with the other readers
+    store = instrument_store(s3_map(s3_path, access_key_id, secret_accsess_key))
+    # Read the chunks through an utils.cache.ChunkCache
+    if chunk_cache:
+        store = chunk_cache.wrap(store)
     
     # Read Zarr file
     if group:
@@ -40,7 +46,8 @@ def read_zarr_from_s3(access_key_id, secret_accsess_key, dataset, group=None):
 
 
 def read_zarr_from_local_dir(path, group=None):
-    # Read Zarr file
+    # Read Zarr file, through a store counting the bytes read if instrumented
+    path = instrument_store(path)
     if group:
         with xr.open_zarr(store=path, group=group, consolidated=True) as ds:
             return ds
@@ -51,59 +58,19 @@ def read_zarr_from_local_dir(path, group=None):
         
              
 def get_recent_lc_statistics(ds, raster_metadata):
-    # Filter dataset 
-    df = pd.concat([ds.isel(time=0).to_dataframe().reset_index().drop(
-                            columns=['x', 'y', 'time']).rename(columns={'stocks': 'stocks_2000', 'land-cover': 'land_cover_2000'}),
-                    ds.isel(time=1).to_dataframe().reset_index().drop(
-                            columns=['x', 'y', 'time', 'mask']).rename(columns={'stocks': 'stocks_2018', 'land-cover': 'land_cover_2018'})], axis=1)
-    # Filter rows where columns A and B have equal values
-    df = df[df['land_cover_2000'] != df['land_cover_2018']]
-    df['stocks_change'] = df['stocks_2018'] - df['stocks_2000']
-    # Remove rows where mask is null
-    df = df[~df['mask'].isnull()]
-    # Remove rows with 0 change
-    df = df[(df['stocks_change'] != 0.) & (~df['stocks_change'].isnull())]
-    # Add category names
-    df = df[['land_cover_2018', 'land_cover_2000', 'stocks_change']]
-    df['land_cover_2000'] = df['land_cover_2000'].astype(int).astype(str)
-    df['land_cover_2018'] = df['land_cover_2018'].astype(int).astype(str)
-    df['land_cover_group_2000'] = df['land_cover_2000'].map(raster_metadata.child_parent())
-    df['land_cover_group_2018'] = df['land_cover_2018'].map(raster_metadata.child_parent())
+    codes = LandCoverCodes(raster_metadata)
 
-    # Create final data
-    indicators = {'land_cover_groups': ['land_cover_group_2000', 'land_cover_group_2018'], 
-                'land_cover': ['land_cover_2000', 'land_cover_2018'],
-                'land_cover_group_2018': ['land_cover_2000', 'land_cover_group_2018']}
+    # Keep pixels inside the geometry
+    mask = ds['mask'].transpose('y', 'x').values
+    valid = ~np.isnan(mask)
+    stocks = ds['stocks'].transpose('time', 'y', 'x').values[:, valid]
+    land_cover = ds['land-cover'].transpose('time', 'y', 'x').values[:, valid]
 
-    data = {}
-    for name, indicator in indicators.items():
-        # Grouping the DataFrame by land cover 2000 and 2018, and applying the aggregation function to 'stocks_change'
-        grouped_df = df.groupby([indicator[0], indicator[1]])['stocks_change'].sum().reset_index()
-        grouped_2018_df = grouped_df.groupby([indicator[1]])['stocks_change'].sum().reset_index()
-            
-        data_tmp = {}
-        for category in grouped_2018_df.sort_values('stocks_change')[indicator[1]]:
-            records = grouped_df[grouped_df[indicator[1]] == category].sort_values('stocks_change')
-            records = dict(zip(records[indicator[0]], records['stocks_change']))
+    # Transition matrix of stocks change between land cover in 2000 and 2018
+    sums, counts = land_cover_transitions(land_cover[0], land_cover[1], stocks[1] - stocks[0],
+                                          codes)
 
-            data_tmp[category] = records
-            
-        data[name] = data_tmp
-        
-        
-    # Reorganize land cover data
-    children = list(data['land_cover'].keys())
-    parent = [raster_metadata.child_parent()[child]for child in children]
-    child_dict = dict(zip(children, parent))
-
-    land_cover_dict = {}
-    for parent_id in list(data['land_cover_groups'].keys()):
-        child_ids = [key for key, value in child_dict.items() if value == parent_id]
-        land_cover_dict[parent_id] = {id: data['land_cover'][id] for id in child_ids}
-        
-    data['land_cover'] = land_cover_dict
-    
-    return data
+    return recent_lc_statistics(sums[0], counts[0], codes)
     
     
 def get_future_lc_statistics(ds, raster_metadata, scenarios):
@@ -234,11 +201,14 @@ def sum_two_dicts(dict1, dict2):
 
 
 def sum_dicts(list_dicts):
-    for n in range(len(list_dicts)-1):
-        if n == 0:
-            result_dict = sum_two_dicts(list_dicts[n], list_dicts[n+1])
-        else:
-            result_dict = sum_two_dicts(result_dict, list_dicts[n+1])
+    # Add every dictionary to a single result in one pass instead of copying the partial
+    # sum for each of them
+    result_dict = {}
+    for dictionary in list_dicts:
+        for key, values in dictionary.items():
+            result = result_dict.setdefault(key, {})
+            for subkey, value in values.items():
+                result[subkey] = result.get(subkey, 0) + value
                 
     return result_dict
 
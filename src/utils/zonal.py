@@ -0,0 +1,362 @@
+import warnings
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import geopandas as gpd
+
+
+def iter_blocks(da: xr.DataArray, x_coor_name: str = 'lon', y_coor_name: str = 'lat'
+                ) -> Iterator[Tuple[slice, slice]]:
+    """Yield (y, x) index slices following the spatial chunks of a DataArray"""
+    if da.chunks:
+        y_chunks = da.chunks[da.get_axis_num(y_coor_name)]
+        x_chunks = da.chunks[da.get_axis_num(x_coor_name)]
+    else:
+        y_chunks = (da.sizes[y_coor_name],)
+        x_chunks = (da.sizes[x_coor_name],)
+
+    y_edges = np.cumsum((0,) + tuple(y_chunks))
+    x_edges = np.cumsum((0,) + tuple(x_chunks))
+    for y_start, y_stop in zip(y_edges[:-1], y_edges[1:]):
+        for x_start, x_stop in zip(x_edges[:-1], x_edges[1:]):
+            yield slice(int(y_start), int(y_stop)), slice(int(x_start), int(x_stop))
+
+
+def iter_tiles(da: xr.DataArray, x_coor_name: str = 'lon', y_coor_name: str = 'lat',
+               max_pixels: Optional[int] = None) -> Iterator[Tuple[slice, slice]]:
+    """Yield (y, x) index slices following the spatial chunks of a DataArray, with the
+    chunks larger than max_pixels split into strips of at most max_pixels pixels"""
+    for y_slice, x_slice in iter_blocks(da, x_coor_name, y_coor_name):
+        height = y_slice.stop - y_slice.start
+        width = x_slice.stop - x_slice.start
+        if not max_pixels or height * width <= max_pixels:
+            yield y_slice, x_slice
+            continue
+
+        tile_width = min(width, max_pixels)
+        tile_height = max(1, max_pixels // tile_width)
+        for y_start in range(y_slice.start, y_slice.stop, tile_height):
+            for x_start in range(x_slice.start, x_slice.stop, tile_width):
+                yield (slice(y_start, min(y_start + tile_height, y_slice.stop)),
+                       slice(x_start, min(x_start + tile_width, x_slice.stop)))
+
+
+def _add_at(target: np.ndarray, positions: np.ndarray, values: np.ndarray, axis: int = -1):
+    """Unbuffered in place addition of values at repeated positions of an axis"""
+    np.add.at(np.moveaxis(target, axis, 0), positions, np.moveaxis(values, axis, 0))
+
+
+def label_positions(labels: np.ndarray, labels_block: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Flat pixel indexes of a mask block that belong to one of the sorted labels and the
+    positions of their labels"""
+    labels_block = np.asarray(labels_block, dtype='float64').ravel()
+    pixels = np.flatnonzero(~np.isnan(labels_block))
+    if not len(pixels) or not len(labels):
+        return pixels[:0], pixels[:0]
+
+    positions = np.searchsorted(labels, labels_block[pixels])
+    positions = np.minimum(positions, len(labels) - 1)
+    known = labels[positions] == labels_block[pixels]
+
+    return pixels[known], positions[known]
+
+
+def bin_indexes(values: np.ndarray, bins: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Mask of the values within the bins and their bin indexes, with the same binning as
+    np.histogram: the last bin includes its right edge"""
+    in_range = ~np.isnan(values) & (values >= bins[0]) & (values <= bins[-1])
+    indexes = np.searchsorted(bins, values[in_range], side='right') - 1
+    return in_range, np.minimum(indexes, len(bins) - 2)
+
+
+def coarsen_aggregates(values: np.ndarray, factor: int, bins: List[np.ndarray],
+                       time_indexes: Tuple[int, int] = (0, -1)) -> Dict[str, np.ndarray]:
+    """Sums, counts and change histograms of (depth, time, y, x) values over blocks of
+    factor x factor pixels. y and x must be multiples of the factor.
+
+    The aggregates are exact sums of the pixel statistics, so the statistics of a region
+    made of whole coarse pixels are the same as the ones computed from the pixels.
+    """
+    n_depths, n_times, ny, nx = values.shape
+    cy, cx = ny // factor, nx // factor
+    n_bins = max(len(depth_bins) - 1 for depth_bins in bins)
+
+    blocks = values.reshape(n_depths, n_times, cy, factor, cx, factor)
+    valid = ~np.isnan(blocks)
+    diff = values[:, time_indexes[1]] - values[:, time_indexes[0]]
+    diff_blocks = diff.reshape(n_depths, cy, factor, cx, factor)
+    valid_diff = ~np.isnan(diff_blocks)
+
+    hist = np.zeros((n_depths, n_bins, cy, cx), dtype='int32')
+    cells = np.arange(cy * cx).reshape(cy, 1, cx, 1)
+    cells = np.broadcast_to(cells, (cy, factor, cx, factor)).reshape(ny, nx)
+    for n in range(n_depths):
+        in_range, indexes = bin_indexes(diff[n], bins[n])
+        hist[n] = np.bincount(indexes * cy * cx + cells[in_range],
+                              minlength=n_bins * cy * cx).reshape(n_bins, cy, cx)
+
+    return {'sum': np.where(valid, blocks, 0).sum(axis=(3, 5)),
+            'count': valid.sum(axis=(3, 5)).astype('int32'),
+            'sum_diff': np.where(valid_diff, diff_blocks, 0).sum(axis=(2, 4)),
+            'count_diff': valid_diff.sum(axis=(2, 4)).astype('int32'),
+            'hist': hist}
+
+
+def overview_factors(gdf: gpd.GeoDataFrame, resolution: float, factors: Sequence[int],
+                     tolerance: float) -> np.ndarray:
+    """Coarsest overview factor of each geometry whose boundary pixels, the ones that can
+    be wrongly assigned, are at most a tolerance fraction of its area. 1 is full resolution."""
+    with warnings.catch_warnings():
+        # Areas and lengths in degrees are fine, only their ratio to the resolution is used
+        warnings.simplefilter('ignore', UserWarning)
+        area = gdf.geometry.area.to_numpy()
+        perimeter = gdf.geometry.length.to_numpy()
+    result = np.ones(len(gdf), dtype='int64')
+    for factor in sorted(factors):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            boundary_fraction = perimeter * factor * resolution / area
+        result[boundary_fraction <= tolerance] = factor
+    return result
+
+
+class LabelAccumulator:
+    """Per-label sums, counts and histograms of a (depth, time, y, x) variable.
+
+    Blocks of values are added together with the block of the rasterized mask, so
+    the statistics of every label are accumulated with one bincount per block. Weighted
+    accumulators add the pixels with weights, e.g. their covered area, so counts and
+    histograms are sums of weights instead of numbers of pixels.
+    """
+    def __init__(self, labels: Sequence, n_depths: int, n_times: int,
+                 data_types: Sequence[str] = ('change', 'time_series'),
+                 bins: List[np.ndarray] = None, time_indexes: Tuple[int, int] = (0, -1),
+                 weighted: bool = False):
+        assert all(data_type in ['change', 'time_series'] for data_type in data_types), \
+            "data_types must be 'change' and/or 'time_series'"
+        assert 'change' not in data_types or bins is not None, "bins are required for 'change'"
+
+        self.labels = np.unique(np.asarray(labels, dtype='float64'))
+        self.n_depths = n_depths
+        self.n_times = n_times
+        self.data_types = list(data_types)
+        self.bins = bins
+        self.time_indexes = time_indexes
+        self.weighted = weighted
+
+        n_labels = len(self.labels)
+        count_dtype = 'float64' if weighted else 'int64'
+        if 'time_series' in self.data_types:
+            self.sums = np.zeros((n_depths, n_times, n_labels))
+            self.counts = np.zeros((n_depths, n_times, n_labels), dtype=count_dtype)
+        if 'change' in self.data_types:
+            self.sum_diff = np.zeros((n_depths, n_labels))
+            self.count_diff = np.zeros((n_depths, n_labels), dtype=count_dtype)
+            self.hist = [np.zeros((n_labels, len(bins[n]) - 1), dtype=count_dtype)
+                         for n in range(n_depths)]
+
+    @classmethod
+    def combine(cls, accumulators: List['LabelAccumulator']) -> 'LabelAccumulator':
+        """Merge accumulators of the same raster, e.g. computed for chunks of geometries"""
+        first = accumulators[0]
+        labels = np.unique(np.concatenate([accumulator.labels for accumulator in accumulators]))
+        result = cls(labels, first.n_depths, first.n_times, first.data_types, first.bins,
+                     first.time_indexes, first.weighted)
+        for accumulator in accumulators:
+            result._add(accumulator, np.searchsorted(labels, accumulator.labels))
+        return result
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, depths: List[str], data_types: Sequence[str],
+                   bins: List[np.ndarray] = None, index_column_name: str = 'index',
+                   weighted: bool = False) -> 'LabelAccumulator':
+        """Accumulator with the values of rows returned by ZonalStatistics.compute"""
+        df = df[df[index_column_name].notna() & df['depth'].isin(depths)]
+        n_times = len(df['sum_values'].iloc[0]) if 'time_series' in data_types and len(df) else 0
+        accumulator = cls(df[index_column_name], len(depths), n_times, data_types, bins,
+                          weighted=weighted)
+
+        for n, depth in enumerate(depths):
+            df_depth = df[df['depth'] == depth]
+            if 'change' in data_types:
+                df_change = df_depth[df_depth['sum_diff'].notna()]
+                positions = np.searchsorted(accumulator.labels,
+                                            df_change[index_column_name].astype(float))
+                accumulator.sum_diff[n, positions] = df_change['sum_diff'].astype(float)
+                accumulator.count_diff[n, positions] = df_change['count_diff'].astype(
+                    accumulator.count_diff.dtype)
+                if len(df_change):
+                    accumulator.hist[n][positions] = np.stack(df_change['counts'].tolist())
+            if 'time_series' in data_types:
+                df_series = df_depth[df_depth['sum_values'].notna()]
+                positions = np.searchsorted(accumulator.labels,
+                                            df_series[index_column_name].astype(float))
+                if len(df_series):
+                    accumulator.sums[n, :, positions] = np.stack(df_series['sum_values'].tolist())
+                    accumulator.counts[n, :, positions] = np.stack(
+                        df_series['count_values'].tolist())
+
+        return accumulator
+
+    def _add(self, other: 'LabelAccumulator', positions: np.ndarray):
+        """Add the statistics of other at the given label positions"""
+        if 'time_series' in self.data_types:
+            _add_at(self.sums, positions, other.sums)
+            _add_at(self.counts, positions, other.counts)
+        if 'change' in self.data_types:
+            _add_at(self.sum_diff, positions, other.sum_diff)
+            _add_at(self.count_diff, positions, other.count_diff)
+            for n in range(self.n_depths):
+                _add_at(self.hist[n], positions, other.hist[n], axis=0)
+
+    def aggregate(self, labels: Sequence, parents: Sequence) -> 'LabelAccumulator':
+        """Reduce the statistics of the labels into the ones of their parents, e.g. the
+        level 1 geometries into their level 0 geometries"""
+        labels = np.asarray(labels, dtype='float64')
+        parents = np.asarray(parents, dtype='float64')
+        _, first = np.unique(labels, return_index=True)
+        labels, parents = labels[first], parents[first]
+
+        known = np.isin(labels, self.labels) & ~np.isnan(parents)
+        labels, parents = labels[known], parents[known]
+
+        result = LabelAccumulator(parents, self.n_depths, self.n_times, self.data_types,
+                                  self.bins, self.time_indexes, self.weighted)
+        child = self._subset(labels)
+        result._add(child, np.searchsorted(result.labels, parents))
+        return result
+
+    def _subset(self, labels: np.ndarray) -> 'LabelAccumulator':
+        """Accumulator with the statistics of some of the sorted labels"""
+        positions = np.searchsorted(self.labels, np.asarray(labels, dtype='float64'))
+        result = LabelAccumulator([], self.n_depths, self.n_times, self.data_types, self.bins,
+                                  self.time_indexes, self.weighted)
+        result.labels = self.labels[positions]
+        if 'time_series' in self.data_types:
+            result.sums = self.sums[..., positions]
+            result.counts = self.counts[..., positions]
+        if 'change' in self.data_types:
+            result.sum_diff = self.sum_diff[..., positions]
+            result.count_diff = self.count_diff[..., positions]
+            result.hist = [hist[positions] for hist in self.hist]
+        return result
+
+    def has_labels(self, labels_block: np.ndarray) -> bool:
+        return len(label_positions(self.labels, labels_block)[0]) > 0
+
+    def update(self, values: np.ndarray, labels_block: np.ndarray, weights: np.ndarray = None):
+        """Add a (depth, time, y, x) block of values labelled by a (y, x) mask block, with
+        the (y, x) weights of the pixels if the accumulator is weighted"""
+        assert self.weighted == (weights is not None), \
+            "weights must be given if and only if the accumulator is weighted"
+        pixels, positions = label_positions(self.labels, labels_block)
+        if not len(pixels):
+            return
+
+        n_labels = len(self.labels)
+        values = np.asarray(values, dtype='float64')
+        values = values.reshape(values.shape[0], values.shape[1], -1)[:, :, pixels]
+        if self.weighted:
+            weights = np.asarray(weights, dtype='float64').ravel()[pixels]
+
+        for n in range(self.n_depths):
+            if 'time_series' in self.data_types:
+                depth_values = values[n]
+                valid = ~np.isnan(depth_values)
+                flat = (np.arange(self.n_times)[:, None] * n_labels + positions[None, :])[valid]
+                size = self.n_times * n_labels
+                pixel_weights = np.broadcast_to(weights, depth_values.shape)[valid] \
+                    if self.weighted else None
+                sums = depth_values[valid] * pixel_weights if self.weighted else depth_values[valid]
+                self.sums[n] += np.bincount(flat, weights=sums,
+                                            minlength=size).reshape(self.n_times, n_labels)
+                self.counts[n] += np.bincount(flat, weights=pixel_weights,
+                                              minlength=size).reshape(self.n_times, n_labels)
+
+            if 'change' in self.data_types:
+                # Get difference between two dates
+                diff = values[n, self.time_indexes[1]] - values[n, self.time_indexes[0]]
+                valid = ~np.isnan(diff)
+                pixel_weights = weights[valid] if self.weighted else None
+                sums = diff[valid] * pixel_weights if self.weighted else diff[valid]
+                self.sum_diff[n] += np.bincount(positions[valid], weights=sums,
+                                                minlength=n_labels)
+                self.count_diff[n] += np.bincount(positions[valid], weights=pixel_weights,
+                                                  minlength=n_labels)
+
+                n_bins = len(self.bins[n]) - 1
+                in_range, indexes = bin_indexes(diff, self.bins[n])
+                self.hist[n] += np.bincount(positions[in_range] * n_bins + indexes,
+                                            weights=weights[in_range] if self.weighted else None,
+                                            minlength=n_labels * n_bins).reshape(n_labels, n_bins)
+
+    def update_aggregates(self, aggregates: Dict[str, np.ndarray], labels_block: np.ndarray):
+        """Add a block of coarse pixels of an overview, see coarsen_aggregates"""
+        pixels, positions = label_positions(self.labels, labels_block)
+        if not len(pixels):
+            return
+
+        n_labels = len(self.labels)
+        for n in range(self.n_depths):
+            if 'time_series' in self.data_types:
+                sums = aggregates['sum'][n].reshape(self.n_times, -1)[:, pixels]
+                counts = aggregates['count'][n].reshape(self.n_times, -1)[:, pixels]
+                for t in range(self.n_times):
+                    self.sums[n, t] += np.bincount(positions, weights=sums[t], minlength=n_labels)
+                    self.counts[n, t] += np.bincount(positions, weights=counts[t],
+                                                     minlength=n_labels).astype(self.counts.dtype)
+
+            if 'change' in self.data_types:
+                self.sum_diff[n] += np.bincount(positions, minlength=n_labels,
+                                                weights=aggregates['sum_diff'][n].ravel()[pixels])
+                self.count_diff[n] += np.bincount(
+                    positions, weights=aggregates['count_diff'][n].ravel()[pixels],
+                    minlength=n_labels).astype(self.count_diff.dtype)
+                n_bins = len(self.bins[n]) - 1
+                hist = aggregates['hist'][n, :n_bins].reshape(n_bins, -1)[:, pixels]
+                for b in range(n_bins):
+                    self.hist[n][:, b] += np.bincount(
+                        positions, weights=hist[b], minlength=n_labels).astype(self.hist[n].dtype)
+
+    def to_records(self, data_type: str, indexes: Sequence, depths: List[str],
+                   metadata: Dict) -> List[Dict]:
+        """Rows with the same layout as the ones returned by ZonalStatistics.compute"""
+        assert data_type in self.data_types, f"{data_type} has not been accumulated"
+
+        records = []
+        for index in indexes:
+            position = np.searchsorted(self.labels, float(index))
+            for n, depth in enumerate(depths):
+                if data_type == 'change':
+                    sum_diff = self.sum_diff[n, position]
+                    count_diff = self.count_diff[n, position]
+                    mean_diff = sum_diff / count_diff if count_diff != 0 else sum_diff
+                    records.append({
+                        "index": index,
+                        "counts": self.hist[n][position].tolist(),
+                        "bins": self.bins[n].tolist(),
+                        "sum_diff": sum_diff,
+                        "count_diff": count_diff,
+                        "mean_diff": mean_diff,
+                        "depth": depth,
+                        **metadata
+                    })
+                elif data_type == 'time_series':
+                    sums = self.sums[n, :, position]
+                    counts = self.counts[n, :, position]
+                    if all(elem == 0 for elem in counts):
+                        values = sums
+                    else:
+                        with np.errstate(divide='ignore', invalid='ignore'):
+                            values = sums / counts
+                    records.append({
+                        "index": index,
+                        "sum_values": sums.tolist(),
+                        "count_values": counts.tolist(),
+                        "mean_values": values.tolist(),
+                        "depth": depth,
+                        **metadata
+                    })
+
+        return records